@@ -1,12 +1,26 @@
 from portfolio_functions import *
+import argparse
+import sys
 
 
-def main():
+def main(
+    config_file_path=None,
+    outputs=None,
+    output_securities=None,
+    plot_types=None,
+    force_plots=False,
+):
     # ------------------- portfolio parameters ------------------- #
 
     # currency in which the portfolio data will be analyzed
+    # or list of currencies, e.g. ["EUR", "USD", "GBP"], to print tables and create plots in each of them, values are calculated in the first one and converted to the others
     analysis_currency = "EUR"
 
+    # currency in which exchange rates of all currencies are downloaded, e.g. "USD", exchange rates to analysis currency are derived from them
+    # so that changing analysis currency or analyzing portfolios in different currencies does not need new downloads
+    # None downloads exchange rates directly to analysis currency
+    fx_base_currency = None
+
     # tickers and the corresponding currencies of securities in portfolio to download from yahoo finance
     tickers_and_currencies = {
         "VWCE.DE": "EUR",
@@ -27,6 +41,14 @@ def main():
         "GOLD": ["4GLD", "IGLN"],
     }
 
+    # cash to allocate to whole units of securities to get as close as possible to the model weights without selling anything
+    # set to None to not allocate any contribution
+    contribution = None
+
+    # fee as a fraction of the value of each purchase and fixed fee of each purchase of a security
+    contribution_fee_rate = 0
+    contribution_fixed_fee = 0
+
     # path to folder with portfolio data files
     data_folder_path = "data"
 
@@ -60,80 +82,263 @@ def main():
     # using this variable we can calculate portfolio values from the real beginning of the portfolio or with omitting some of the first transactions if needed
     first_transaction_date = "2019-07-29"
 
+    # number of rows of portfolio data files to read and convert at once, set to None to read whole files at once
+    ingestion_chunk_size = 100000
+
+    # print number of rows and parse time of each portfolio data file
+    print_ingestion_report = False
+
     # analysis start and end date to take portfolio values only from this period
     # start date should be the same or later than first_transaction_date
     start_date = "2019-07-29"
     end_date = datetime.datetime.now().strftime("%Y-%m-%d")
 
+    # calendar period of money-weighted (XIRR) and time-weighted (TWR) returns, "year", "quarter" or "month"
+    # set to None to print returns only for the whole analysis period
+    returns_period = "year"
+
+    # number of calendar periods in each rolling window of returns, set to None to print returns of single calendar periods
+    returns_rolling_periods = None
+
+    # numbers of daily returns in rolling windows of volatility, Sharpe and Sortino ratios, returns and maximum drawdowns
+    risk_windows = [63, 252]
+
+    # annual risk free rate used in Sharpe and Sortino ratios
+    risk_free_rate = 0
+
     # which column to use for open, high, low, close prices
     ohlc = "close"
 
+    # resolution of portfolio data in tables and plots, "day", "week", "month" or "year"
+    # lower resolutions take the last values of each period and the deepest drawdowns, values and risk metrics are always calculated daily
+    resolution = "day"
+
     # folder path to save plots
     plots_folder_path = "portfolio plots"
 
-    # ------------------- portfolio analysis ------------------- #
+    # maximum number of points of each plotted line, longer lines keep the minimum and the maximum of each bucket of neighbouring points
+    # 2000 points give two points per pixel of the 1000 pixels wide plots, set to None to plot all points
+    plots_max_points = 2000
 
-    # take securities names from tickers_and_currencies dictionary
-    securities = [
-        security_name.split(".")[0] for security_name in tickers_and_currencies
-    ]
+    # remove plots of securities which are no longer in tickers_and_currencies from plots folder
+    prune_plots = True
 
-    # take tickers and currencies from tickers_and_currencies dictionary
-    tickers = [*tickers_and_currencies.keys()]
-    currencies_securities = [*tickers_and_currencies.values()]
+    # folder path to save calculated portfolio values, next runs recalculate them only from the earliest date affected by new prices or transactions
+    # set to None to calculate all portfolio values from scratch
+    portfolio_state_folder_path = "portfolio state"
 
-    # take currencies from transaction_payments dictionary
-    currencies_transation_payments = [*transaction_payments.values()]
+    # folder path to export computed portfolio values, securities data and exchange rates to .arrow files, which can be loaded with load_portfolio_export
+    # set to None to not export anything
+    export_folder_path = "portfolio export"
 
-    # take currencies from fee_payments dictionary
-    currencies_fee_payments = [*fee_payments.values()]
+    # compression of exported files, "zstd", "lz4" or "uncompressed", uncompressed files are bigger but are memory-mapped without copying
+    export_compression = "zstd"
 
-    # combine currencies of securities and payments
-    currencies = (
-        currencies_securities + currencies_transation_payments + currencies_fee_payments
-    )
+    # method of matching sold units with bought lots to calculate cost basis and realized and unrealized profits, "fifo" sells the oldest lots first and "average" sells at the average cost of held units
+    # set to None to not match lots
+    lot_matching = "fifo"
 
-    # take distinct currencies
-    distinct_currencies = list(set(currencies))
+    # engine to calculate portfolio values with, "arrays" keeps data in numpy arrays and "pandas" uses DataFrame operations, both give the same results
+    calculation_engine = "arrays"
 
-    # download securities data and exchange rates from yahoo finance in a daily frequency
-    securities_data, exchange_rates = download_yahoo(
-        tickers, distinct_currencies, ohlc, analysis_currency, securities
-    )
+    # number of worker processes to render plots in parallel, 1 renders plots one after another and None uses all CPUs
+    plots_workers = None
+
+    # name of the market data provider, "yahoo" downloads data from yahoo finance and "replay" reads data recorded in local .csv files
+    market_data_provider = "yahoo"
+
+    # keyword options of the market data provider, e.g. {"replay_folder_path": "market data replay"} for the replay provider
+    market_data_provider_options = {}
+
+    # maximum number of symbols fetched at once, so that a slow symbol does not delay the others
+    market_data_fetch_workers = 8
+
+    # number of seconds to wait for a response for each fetched symbol
+    market_data_fetch_timeout_s = 30
+
+    # number of additional attempts after a failed fetch of a symbol, each waiting twice as long as the previous one starting with the delay in seconds
+    market_data_fetch_retries = 2
+    market_data_fetch_retry_delay_s = 1
+
+    # folder path to cache downloaded market data, set to None to always download the whole history
+    market_data_cache_folder_path = "market data cache"
+
+    # number of hours after which cached market data is refreshed with the newest data
+    market_data_cache_max_age_hours = 12
+
+    # remove cached market data before the analysis to download the whole history again
+    clear_cache = False
+
+    # use only cached market data without downloading anything
+    offline = False
+
+    # number of worker processes to analyze many portfolios in parallel, 1 analyzes portfolios one after another and None uses all CPUs
+    portfolios_workers = 1
+
+    # path to .json file where wall time, CPU time, memory and size of data of each pipeline stage will be saved and printed
+    # set to None to run the analysis without instrumentation
+    instrumentation_report_file_path = None
 
-    # calculate values of securities in analysis currency
-    for ticker, currency in tickers_and_currencies.items():
-        security_name = ticker.split(".")[0]
-        currency_pair = currency + analysis_currency
-        securities_data[security_name] = (
-            securities_data[security_name] * exchange_rates[currency_pair]
+    # trace peak memory allocated by each pipeline stage, it slows down the analysis
+    trace_memory = False
+
+    # names of pipeline stages to profile, e.g. ["prepare_portfolio_data", "create_plots"], profiles are saved to "stages profiles" folder
+    profile_stages = []
+
+    # ------------------- portfolio analysis ------------------- #
+
+    # collect portfolio parameters into a single configuration
+    portfolio_config = {
+        "name": "PORTFOLIO",
+        "analysis_currency": analysis_currency,
+        "fx_base_currency": fx_base_currency,
+        "tickers_and_currencies": tickers_and_currencies,
+        "weights": weights,
+        "weight_groups": weight_groups,
+        "data_folder_path": data_folder_path,
+        "portfolio_data_files_names_and_payments_columns": portfolio_data_files_names_and_payments_columns,
+        "transaction_payments": transaction_payments,
+        "fee_payments": fee_payments,
+        "first_transaction_date": first_transaction_date,
+        "ingestion_chunk_size": ingestion_chunk_size,
+        "print_ingestion_report": print_ingestion_report,
+        "start_date": start_date,
+        "end_date": end_date,
+        "ohlc": ohlc,
+        "plots_folder_path": plots_folder_path,
+        "portfolio_state_folder_path": portfolio_state_folder_path,
+        "calculation_engine": calculation_engine,
+        "lot_matching": lot_matching,
+        "export_folder_path": export_folder_path,
+        "export_compression": export_compression,
+        "contribution": contribution,
+        "contribution_fee_rate": contribution_fee_rate,
+        "contribution_fixed_fee": contribution_fixed_fee,
+        "returns_period": returns_period,
+        "returns_rolling_periods": returns_rolling_periods,
+        "risk_windows": risk_windows,
+        "risk_free_rate": risk_free_rate,
+        "resolution": resolution,
+        "plots_max_points": plots_max_points,
+        "prune_plots": prune_plots,
+    }
+
+    # collect settings of the whole analysis run
+    analysis_settings = {
+        "plots_workers": plots_workers,
+        "market_data_provider": market_data_provider,
+        "market_data_provider_options": market_data_provider_options,
+        "market_data_fetch_workers": market_data_fetch_workers,
+        "market_data_fetch_timeout_s": market_data_fetch_timeout_s,
+        "market_data_fetch_retries": market_data_fetch_retries,
+        "market_data_fetch_retry_delay_s": market_data_fetch_retry_delay_s,
+        "market_data_cache_folder_path": market_data_cache_folder_path,
+        "market_data_cache_max_age_hours": market_data_cache_max_age_hours,
+        "clear_cache": clear_cache,
+        "offline": offline,
+        "portfolios_workers": portfolios_workers,
+        "instrumentation_report_file_path": instrumentation_report_file_path,
+        "trace_memory": trace_memory,
+        "profile_stages": profile_stages,
+    }
+
+    # configurations of all portfolios to analyze, more portfolios can be added to share a single market data download
+    portfolios_configs = [portfolio_config]
+
+    # take parameters from config file instead of the ones above if specified
+    if config_file_path:
+        portfolios_configs, analysis_settings = load_config_file(
+            config_file_path, portfolio_config, analysis_settings
         )
 
-    # prepare portfolio data for analysis using downloaded data and portfolio data files
-    portfolio_data = prepare_portfolio_data(
-        securities_data,
-        exchange_rates,
-        transaction_payments,
-        fee_payments,
-        analysis_currency,
-        portfolio_data_files_names_and_payments_columns,
-        data_folder_path,
-        first_transaction_date,
-    )
+    # select outputs of all portfolios if specified, e.g. outputs=["weights"] for a quick check what should be bought
+    # work needed only for not selected outputs is skipped, all outputs, securities and plot types are used if None
+    for portfolio_config in portfolios_configs:
+        if outputs is not None:
+            portfolio_config["outputs"] = outputs
+        if output_securities is not None:
+            portfolio_config["output_securities"] = output_securities
+        if plot_types is not None:
+            portfolio_config["plot_types"] = plot_types
+        if force_plots:
+            portfolio_config["force_plots"] = True
+
+    # start measuring pipeline stages
+    if analysis_settings["instrumentation_report_file_path"]:
+        start_instrumentation(
+            analysis_settings["trace_memory"], analysis_settings["profile_stages"]
+        )
 
-    # run portfolio analysis
-    portfolio_analysis(
-        portfolio_data,
-        securities_data,
-        analysis_currency,
-        securities,
-        weights,
-        weight_groups,
-        start_date,
-        end_date,
-        plots_folder_path,
+    # remove cached market data if requested
+    if (
+        analysis_settings["clear_cache"]
+        and analysis_settings["market_data_cache_folder_path"]
+    ):
+        clear_market_data_cache(
+            analysis_settings["market_data_cache_folder_path"],
+            provider=analysis_settings["market_data_provider"],
+        )
+
+    # download securities data and exchange rates for all portfolios at once in a daily frequency and run analysis of each portfolio
+    failed_portfolios = batch_portfolio_analysis(
+        portfolios_configs,
+        analysis_settings["market_data_cache_folder_path"],
+        analysis_settings["market_data_cache_max_age_hours"],
+        analysis_settings["offline"],
+        analysis_settings["market_data_provider"],
+        analysis_settings["market_data_provider_options"],
+        analysis_settings["portfolios_workers"],
+        analysis_settings["plots_workers"],
+        analysis_settings["market_data_fetch_workers"],
+        analysis_settings["market_data_fetch_timeout_s"],
+        analysis_settings["market_data_fetch_retries"],
+        analysis_settings["market_data_fetch_retry_delay_s"],
     )
 
+    # print and save measurements of pipeline stages
+    if analysis_settings["instrumentation_report_file_path"]:
+        stages = stop_instrumentation()
+        print_instrumentation_report(stages)
+        save_instrumentation_report(
+            stages, analysis_settings["instrumentation_report_file_path"]
+        )
+
+    return failed_portfolios
+
 
 if __name__ == "__main__":
-    main()
+    # command line arguments override the parameters specified in main
+    parser = argparse.ArgumentParser(description="Portfolio analysis")
+    parser.add_argument(
+        "--config",
+        dest="config_file_path",
+        help="path to .json file with parameters named as in main(), the parameters in main() are used if not specified",
+    )
+    parser.add_argument(
+        "--outputs",
+        nargs="+",
+        choices=OUTPUTS,
+        help="outputs to produce, all outputs are produced if not specified",
+    )
+    parser.add_argument(
+        "--securities",
+        dest="output_securities",
+        nargs="+",
+        help="names of securities shown in status and drawdowns tables and plots, e.g. VWCE ISAC",
+    )
+    parser.add_argument(
+        "--plot-types",
+        dest="plot_types",
+        nargs="+",
+        choices=PLOT_TYPES,
+        help="types of plots to create, all types are created if not specified",
+    )
+    parser.add_argument(
+        "--force-plots",
+        action="store_true",
+        help="render all plots, otherwise only plots with changed data or styling are rendered",
+    )
+
+    # exit with an error status if any portfolio could not be analyzed, so that scheduled runs notice failures
+    if main(**vars(parser.parse_args())):
+        sys.exit(1)
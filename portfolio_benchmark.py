@@ -0,0 +1,633 @@
+from portfolio_functions import *
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# heavy dependencies which must not be imported together with portfolio_functions
+LAZY_MODULES = ["matplotlib", "yfinance"]
+
+# dependencies which are needed by portfolio_functions anyway, their import time is not counted in the budget
+REQUIRED_MODULES = ["numpy", "pandas"]
+
+
+def generate_benchmark_data(
+    folder_path, securities_number, brokers_number, transactions_number, years, seed=0
+):
+    """
+    Generates deterministic synthetic prices, exchange rates and broker .csv files in the same layout as files in data folder
+
+    Parameters
+    ----------
+    folder_path : str
+        Path to folder where generated market data and portfolio data files will be saved
+    securities_number : int
+        Number of securities in portfolio
+    brokers_number : int
+        Number of brokers, each with its own portfolio data file
+    transactions_number : int
+        Number of transactions in all portfolio data files
+    years : int
+        Number of years of market data and transactions
+    seed : int
+        Seed of the random numbers generator (default is 0)
+
+    Returns
+    -------
+    dict
+        Dictionary with portfolio parameters as specified in portfolio.py for generated data
+    """
+    random_generator = np.random.default_rng(seed)
+
+    # market data on business days ending on a fixed date so generated data does not depend on the current date
+    dates = pd.bdate_range(end="2023-12-29", periods=261 * years, name="Date")
+
+    # securities are quoted in different currencies and assigned to brokers and weight groups in turns
+    currencies = ["EUR", "USD", "GBP"]
+    securities = [f"SEC{index}" for index in range(securities_number)]
+    tickers_and_currencies = {
+        f"{security_name}.BM": currencies[index % len(currencies)]
+        for index, security_name in enumerate(securities)
+    }
+    weight_groups_names = ["STOCKS", "BONDS", "GOLD"]
+    weight_groups = {
+        weight_group_name: securities[index :: len(weight_groups_names)]
+        for index, weight_group_name in enumerate(weight_groups_names)
+        if securities[index :: len(weight_groups_names)]
+    }
+
+    # random walk of close prices and exchange rates with open, high and low prices around them
+    replay_folder_path = os.path.join(folder_path, "market data replay")
+    symbols = list(tickers_and_currencies) + ["USDEUR=X", "GBPEUR=X"]
+    close_prices = np.exp(
+        np.cumsum(random_generator.normal(0, 0.01, (len(dates), len(symbols))), axis=0)
+    )
+    close_prices[:, : len(securities)] *= random_generator.uniform(
+        10, 500, len(securities)
+    )
+    market_data = {}
+    for index, symbol in enumerate(symbols):
+        close = close_prices[:, index]
+        spread = random_generator.uniform(0, 0.005, (len(dates), 2))
+        market_data[symbol] = pd.DataFrame(
+            {
+                "Open": close * (1 + spread[:, 0] - spread[:, 1]),
+                "High": close * (1 + spread[:, 0]),
+                "Low": close * (1 - spread[:, 1]),
+                "Close": close,
+            },
+            index=dates,
+        )
+    record_market_data(market_data, replay_folder_path)
+
+    # prices of securities in EUR used to calculate transaction payments
+    exchange_rates = {
+        "EUR": np.ones(len(dates)),
+        "USD": close_prices[:, -2],
+        "GBP": close_prices[:, -1],
+    }
+    securities_prices = np.column_stack(
+        [
+            close_prices[:, index] * exchange_rates[currency]
+            for index, currency in enumerate(tickers_and_currencies.values())
+        ]
+    )
+
+    # transactions on random dates for random securities of each broker
+    data_folder_path = os.path.join(folder_path, "data")
+    os.makedirs(data_folder_path, exist_ok=True)
+    portfolio_data_files_names_and_payments_columns = {}
+    for broker_index in range(brokers_number):
+        broker_securities_indexes = np.arange(
+            broker_index, securities_number, brokers_number
+        )
+        if len(broker_securities_indexes) == 0:
+            continue
+
+        broker_transactions_number = transactions_number // brokers_number
+        dates_indexes = np.sort(
+            random_generator.integers(0, len(dates), broker_transactions_number)
+        )
+        securities_indexes = random_generator.integers(
+            0, len(broker_securities_indexes), broker_transactions_number
+        )
+        counts = random_generator.integers(1, 10, broker_transactions_number)
+
+        # count of the bought security is in its column and the other securities columns are 0
+        broker_counts = np.zeros(
+            (broker_transactions_number, len(broker_securities_indexes)), dtype=int
+        )
+        broker_counts[np.arange(broker_transactions_number), securities_indexes] = (
+            counts
+        )
+
+        # transaction payment is a count multiplied by a price of the security in EUR
+        transactions = (
+            counts
+            * securities_prices[
+                dates_indexes, broker_securities_indexes[securities_indexes]
+            ]
+        )
+
+        portfolio_data_file_name = f"portfolio_broker{broker_index + 1}.csv"
+        broker_data = pd.DataFrame(
+            broker_counts,
+            columns=[securities[index] for index in broker_securities_indexes],
+            index=dates[dates_indexes],
+        )
+        broker_data.insert(0, "transaction", transactions)
+        broker_data.insert(1, "trx_fee", 3)
+        broker_data.to_csv(os.path.join(data_folder_path, portfolio_data_file_name))
+        portfolio_data_files_names_and_payments_columns[portfolio_data_file_name] = {
+            TRANSACTION_PAYMENT_COLUMN_NAME: "transaction",
+            FEE_PAYMENT_COLUMN_NAME: "trx_fee",
+        }
+
+    return {
+        "analysis_currency": "EUR",
+        "tickers_and_currencies": tickers_and_currencies,
+        "weights": {
+            weight_group_name: 100 / len(weight_groups)
+            for weight_group_name in weight_groups
+        },
+        "weight_groups": weight_groups,
+        "data_folder_path": data_folder_path,
+        "portfolio_data_files_names_and_payments_columns": portfolio_data_files_names_and_payments_columns,
+        "transaction_payments": {"transaction": "EUR"},
+        "fee_payments": {"trx_fee": "EUR"},
+        "first_transaction_date": dates[0].strftime("%Y-%m-%d"),
+        "start_date": dates[0].strftime("%Y-%m-%d"),
+        "end_date": dates[-1].strftime("%Y-%m-%d"),
+        "ohlc": "close",
+        "plots_folder_path": os.path.join(folder_path, "portfolio plots"),
+        "replay_folder_path": replay_folder_path,
+    }
+
+
+def measure_stage(stages_results, stage_name, stage_function, repeats, measure_memory):
+    """
+    Measures wall time, CPU time and peak memory of a single pipeline stage
+
+    Parameters
+    ----------
+    stages_results : dict
+        Dictionary where measurements of the stage will be added under stage_name key
+    stage_name : str
+        Name of the stage
+    stage_function : function
+        Function without parameters running the stage, it is called once for each repeat
+    repeats : int
+        Number of runs of the stage, the fastest run is taken as a result
+    measure_memory : bool
+        Whether to run the stage once more with tracing memory allocations to measure peak memory
+
+    Returns
+    -------
+    object
+        Result of the last run of the stage
+    """
+    wall_times = []
+    cpu_times = []
+    for _ in range(repeats):
+        wall_start_time = time.perf_counter()
+        cpu_start_time = time.process_time()
+        result = stage_function()
+        wall_times.append(time.perf_counter() - wall_start_time)
+        cpu_times.append(time.process_time() - cpu_start_time)
+
+    # peak memory is measured in a separate run as tracing memory allocations slows down the stage
+    peak_memory = None
+    if measure_memory:
+        tracemalloc.start()
+        stage_function()
+        peak_memory = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+
+    stages_results[stage_name] = {
+        "wall_time_s": min(wall_times),
+        "cpu_time_s": min(cpu_times),
+        "peak_memory_mb": peak_memory,
+    }
+
+    return result
+
+
+def measure_import_time(module_name, repeats):
+    """
+    Measures time of importing module in fresh Python processes, so that nothing is imported in advance
+
+    Parameters
+    ----------
+    module_name : str
+        Name of the module to import
+    repeats : int
+        Number of Python processes importing the module, the fastest import is taken as a result
+
+    Returns
+    -------
+    dict
+        Dictionary with the whole import time, import time without REQUIRED_MODULES and LAZY_MODULES imported with the module
+    """
+    # the required modules are imported first to measure import time of the module itself separately
+    import_code = (
+        "import json, sys, time\n"
+        "start_time = time.perf_counter()\n"
+        f"import {', '.join(REQUIRED_MODULES)}\n"
+        "required_time = time.perf_counter()\n"
+        f"import {module_name}\n"
+        "end_time = time.perf_counter()\n"
+        "print(json.dumps([end_time - start_time, end_time - required_time, "
+        f"[module for module in {LAZY_MODULES!r} if module in sys.modules]]))"
+    )
+
+    import_times = []
+    own_import_times = []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", import_code],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout
+        import_time, own_import_time, loaded_lazy_modules = json.loads(output)
+        import_times.append(import_time)
+        own_import_times.append(own_import_time)
+
+    return {
+        "import_time_s": min(import_times),
+        "own_import_time_s": min(own_import_times),
+        "loaded_lazy_modules": loaded_lazy_modules,
+    }
+
+
+def run_benchmark(
+    securities_number,
+    brokers_number,
+    transactions_number,
+    years,
+    repeats=3,
+    measure_memory=True,
+    include_plots=True,
+):
+    """
+    Runs each stage of portfolio analysis pipeline on generated data and measures it
+
+    Parameters
+    ----------
+    securities_number : int
+        Number of securities in portfolio
+    brokers_number : int
+        Number of brokers, each with its own portfolio data file
+    transactions_number : int
+        Number of transactions in all portfolio data files
+    years : int
+        Number of years of market data and transactions
+    repeats : int
+        Number of runs of each stage, the fastest run is taken as a result (default is 3)
+    measure_memory : bool
+        Whether to measure peak memory of each stage (default is True)
+    include_plots : bool
+        Whether to measure plots creation which is the slowest stage (default is True)
+
+    Returns
+    -------
+    dict
+        Dictionary with measurements of each stage
+    """
+    stages_results = {}
+
+    with tempfile.TemporaryDirectory() as folder_path:
+        portfolio_config = generate_benchmark_data(
+            folder_path, securities_number, brokers_number, transactions_number, years
+        )
+        analysis_currency = portfolio_config["analysis_currency"]
+        securities, tickers, distinct_currencies = portfolio_symbols(portfolio_config)
+
+        # list of columns for portfolio different values for each security
+        securities_count = [col + COUNT_SUFFIX for col in securities]
+        securities_value = [col + VALUE_SUFFIX for col in securities]
+        securities_unit_value = [col + UNIT_VALUE_SUFFIX for col in securities]
+        securities_expense = [col + EXPENSE_SUFFIX for col in securities]
+        securities_profit = [col + PROFIT_SUFFIX for col in securities]
+        securities_drawdown = [col + DRAWDOWN_SUFFIX for col in securities]
+
+        # market data is replayed from generated files so the download does not depend on network
+        securities_data, exchange_rates = measure_stage(
+            stages_results,
+            "download_yahoo",
+            lambda: download_yahoo(
+                tickers,
+                distinct_currencies,
+                portfolio_config["ohlc"],
+                analysis_currency,
+                securities,
+                provider="replay",
+                provider_options={
+                    "replay_folder_path": portfolio_config["replay_folder_path"]
+                },
+            ),
+            repeats,
+            measure_memory,
+        )
+
+        # calculate values of securities in analysis currency
+        securities_data = convert_securities_data(
+            securities_data,
+            exchange_rates,
+            [*portfolio_config["tickers_and_currencies"].values()],
+            analysis_currency,
+        )
+
+        portfolio_data = measure_stage(
+            stages_results,
+            "prepare_portfolio_data",
+            lambda: prepare_portfolio_data(
+                securities_data,
+                exchange_rates,
+                portfolio_config["transaction_payments"],
+                portfolio_config["fee_payments"],
+                analysis_currency,
+                portfolio_config["portfolio_data_files_names_and_payments_columns"],
+                portfolio_config["data_folder_path"],
+                portfolio_config["first_transaction_date"],
+            ),
+            repeats,
+            measure_memory,
+        )
+
+        # each engine gets a copy of portfolio data as it adds columns to it
+        for calculation_engine, calculate in PORTFOLIO_VALUES_ENGINES.items():
+            calculated_portfolio_data = measure_stage(
+                stages_results,
+                f"calculate_portfolio_values_{calculation_engine}",
+                lambda: calculate(
+                    portfolio_data.copy(),
+                    securities,
+                    securities_count,
+                    securities_value,
+                    securities_unit_value,
+                    securities_expense,
+                    securities_profit,
+                    securities_drawdown,
+                ),
+                repeats,
+                measure_memory,
+            )
+
+        # printed tables are discarded
+        printing_stages = {
+            "print_portfolio_status": lambda: print_portfolio_status(
+                calculated_portfolio_data,
+                analysis_currency,
+                securities,
+                securities_count,
+                securities_value,
+                securities_expense,
+                securities_profit,
+            ),
+            "print_portfolio_weights_and_goal": lambda: print_portfolio_weights_and_goal(
+                calculated_portfolio_data,
+                analysis_currency,
+                portfolio_config["weights"],
+                portfolio_config["weight_groups"],
+                securities,
+                securities_count,
+                securities_value,
+                securities_unit_value,
+            ),
+            "print_portfolio_performance": lambda: print_portfolio_performance(
+                calculated_portfolio_data, analysis_currency
+            ),
+            "print_portfolio_drawdowns": lambda: print_portfolio_drawdowns(
+                calculated_portfolio_data, securities, securities_value
+            ),
+        }
+        with contextlib.redirect_stdout(io.StringIO()):
+            for stage_name, print_function in printing_stages.items():
+                measure_stage(
+                    stages_results, stage_name, print_function, repeats, measure_memory
+                )
+
+        # plots are rendered only once as it is the slowest stage
+        if include_plots:
+            measure_stage(
+                stages_results,
+                "create_plots",
+                lambda: create_plots(
+                    calculated_portfolio_data,
+                    securities_data,
+                    portfolio_config["plots_folder_path"],
+                    analysis_currency,
+                    securities,
+                    securities_value,
+                    securities_expense,
+                    securities_profit,
+                ),
+                1,
+                False,
+            )
+
+        # size of the data processed by the stages
+        stages_results["rows"] = {
+            "portfolio_data": len(portfolio_data),
+            "calculated_portfolio_data": len(calculated_portfolio_data),
+        }
+
+    return stages_results
+
+
+def run_allocation_benchmark(
+    securities_number, groups_number, contribution, repeats=3, seed=0
+):
+    """
+    Runs allocation of a contribution to whole units of securities of random portfolio and measures it
+
+    Parameters
+    ----------
+    securities_number : int
+        Number of securities in portfolio
+    groups_number : int
+        Number of weight groups, securities are assigned to them at random
+    contribution : float
+        Cash to allocate to whole units of securities
+    repeats : int
+        Number of runs of the allocation, the fastest run is taken as a result (default is 3)
+    seed : int
+        Seed of the random numbers generator (default is 0)
+
+    Returns
+    -------
+    dict
+        Dictionary with measurements of the allocation
+    """
+    random_generator = np.random.default_rng(seed)
+    unit_values = random_generator.uniform(5, 500, securities_number)
+    current_values = unit_values * random_generator.integers(0, 100, securities_number)
+    membership = np.zeros((securities_number, groups_number))
+    membership[
+        np.arange(securities_number),
+        random_generator.integers(0, groups_number, securities_number),
+    ] = 1
+    weights = random_generator.uniform(0, 1, groups_number)
+
+    stages_results = {}
+    measure_stage(
+        stages_results,
+        "allocate_contribution",
+        lambda: allocate_contribution(
+            contribution, unit_values, current_values, membership, weights, 0.001, 1
+        ),
+        repeats,
+        False,
+    )
+
+    return stages_results
+
+
+def main():
+    # ------------------- benchmark parameters ------------------- #
+
+    # scenarios to benchmark with number of securities, brokers, transactions and years of generated data
+    scenarios = [
+        {"securities": 6, "brokers": 3, "transactions": 300, "years": 5},
+        {"securities": 20, "brokers": 3, "transactions": 5000, "years": 10},
+        {"securities": 50, "brokers": 5, "transactions": 50000, "years": 20},
+    ]
+
+    # scenarios of allocation of a contribution to whole units with number of securities, weight groups and contribution
+    allocation_scenarios = [
+        {"securities": 200, "groups": 20, "contribution": 1e5},
+        {"securities": 2000, "groups": 200, "contribution": 1e5},
+        {"securities": 5000, "groups": 500, "contribution": 1e7},
+    ]
+
+    # number of runs of each stage, the fastest run is taken as a result
+    repeats = 3
+
+    # measure peak memory of each stage in an additional run
+    measure_memory = True
+
+    # measure plots creation which is the slowest stage
+    include_plots = True
+
+    # label of the benchmarked version to compare results between versions
+    label = ""
+
+    # path to .json file where results will be saved
+    results_file_path = "benchmark_results.json"
+
+    # maximum time of importing portfolio_functions without numpy and pandas which it needs anyway
+    # the benchmark fails if the budget is exceeded or if matplotlib or yfinance are imported with portfolio_functions
+    import_time_budget_s = 0.1
+
+    # ------------------- benchmark ------------------- #
+
+    # measure cold start of portfolio_functions before anything else
+    import_results = measure_import_time("portfolio_functions", repeats)
+    import_table = pd.DataFrame(
+        {
+            "IMPORT TIME [s]": [import_results["import_time_s"]],
+            "IMPORT TIME WITHOUT NUMPY AND PANDAS [s]": [
+                import_results["own_import_time_s"]
+            ],
+            "BUDGET [s]": [import_time_budget_s],
+        },
+        index=["portfolio_functions"],
+    )
+    import_table.index.name = "IMPORT"
+    print(import_table.to_markdown(tablefmt="psql", floatfmt=".3f"))
+
+    results = {
+        "label": label,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "import": {**import_results, "budget_s": import_time_budget_s},
+        "scenarios": [],
+        "allocation_scenarios": [],
+    }
+    for scenario in scenarios:
+        stages_results = run_benchmark(
+            scenario["securities"],
+            scenario["brokers"],
+            scenario["transactions"],
+            scenario["years"],
+            repeats,
+            measure_memory,
+            include_plots,
+        )
+        results["scenarios"].append({"parameters": scenario, "stages": stages_results})
+
+        # print wall time and peak memory of each stage of the scenario
+        scenario_table = pd.DataFrame(
+            {
+                stage_name: [
+                    stage_results["wall_time_s"],
+                    stage_results["cpu_time_s"],
+                    stage_results["peak_memory_mb"],
+                ]
+                for stage_name, stage_results in stages_results.items()
+                if stage_name != "rows"
+            },
+            index=["WALL TIME [s]", "CPU TIME [s]", "PEAK MEMORY [MB]"],
+        ).T
+        scenario_table.index.name = (
+            f"BENCHMARK {scenario['securities']} SECURITIES, {scenario['brokers']} BROKERS, "
+            f"{scenario['transactions']} TRANSACTIONS, {scenario['years']} YEARS"
+        )
+        print(scenario_table.to_markdown(tablefmt="psql", floatfmt=".3f"))
+
+    # print wall time of allocation of each scenario
+    for scenario in allocation_scenarios:
+        stages_results = run_allocation_benchmark(
+            scenario["securities"],
+            scenario["groups"],
+            scenario["contribution"],
+            repeats,
+        )
+        results["allocation_scenarios"].append(
+            {"parameters": scenario, "stages": stages_results}
+        )
+    allocation_table = pd.DataFrame(
+        {
+            "WALL TIME [s]": [
+                allocation_result["stages"]["allocate_contribution"]["wall_time_s"]
+                for allocation_result in results["allocation_scenarios"]
+            ],
+            "CPU TIME [s]": [
+                allocation_result["stages"]["allocate_contribution"]["cpu_time_s"]
+                for allocation_result in results["allocation_scenarios"]
+            ],
+        },
+        index=[
+            f"{scenario['securities']} SECURITIES, {scenario['groups']} GROUPS, {scenario['contribution']:.0f} CONTRIBUTION"
+            for scenario in allocation_scenarios
+        ],
+    )
+    allocation_table.index.name = "BENCHMARK ALLOCATION"
+    print(allocation_table.to_markdown(tablefmt="psql", floatfmt=".3f"))
+
+    with open(results_file_path, "w") as results_file:
+        json.dump(results, results_file, indent=4)
+
+    # enforce the import time budget after the results are saved
+    if import_results["loaded_lazy_modules"]:
+        raise RuntimeError(
+            f"portfolio_functions imports {', '.join(import_results['loaded_lazy_modules'])} at module load"
+        )
+    if import_results["own_import_time_s"] > import_time_budget_s:
+        raise RuntimeError(
+            f"portfolio_functions import takes {import_results['own_import_time_s']:.3f} s, "
+            f"which exceeds the budget of {import_time_budget_s:.3f} s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,29 @@
-import matplotlib.pyplot as plt
-import yfinance as yf
+# matplotlib and yfinance are imported only when plots are rendered or data is downloaded, as importing them takes longer than the whole analysis of cached data
 import pandas as pd
+import numpy as np
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
 import datetime
+import functools
+import hashlib
+import inspect
+import io
+import json
+import sys
+import time
+import traceback
+import tracemalloc
+import warnings
 import os
 
+# resource module is available only on Unix systems
+try:
+    import resource
+except ImportError:
+    resource = None
+
 
 # transaction payments column name
 TRANSACTION_PAYMENT_COLUMN_NAME = "TRANSACTION_PAYMENT"
@@ -27,9 +47,397 @@ SINCE_INCEPTION_SUFFIX = "_SINCE_INCEPTION"
 VALUE_AND_EXPENSE_SUFFIX = "_VALUE_AND_EXPENSE"
 DRAWDOWN_SUFFIX = "_DRAWDOWN"
 
+# suffixes for columns of the lots ledger with cost basis of held lots and realized and unrealized profits
+COST_BASIS_SUFFIX = "_COST_BASIS"
+REALIZED_PROFIT_SUFFIX = "_REALIZED_PROFIT"
+UNREALIZED_PROFIT_SUFFIX = "_UNREALIZED_PROFIT"
+
+# methods of matching sold units of a security with its bought lots
+LOT_MATCHING_METHODS = ["fifo", "average"]
+
+# number of securities whose units are the cheapest to give up and of securities with the biggest shortfalls
+# which are tried in each exchange of units of the contribution allocation
+ALLOCATION_EXCHANGE_CANDIDATES = 32
+
+# suffixes for columns with rolling risk metrics, followed by the window length
+VOLATILITY_SUFFIX = "_VOLATILITY"
+SHARPE_RATIO_SUFFIX = "_SHARPE_RATIO"
+SORTINO_RATIO_SUFFIX = "_SORTINO_RATIO"
+ROLLING_RETURN_SUFFIX = "_ROLLING_RETURN"
+ROLLING_MAX_DRAWDOWN_SUFFIX = "_ROLLING_MAX_DRAWDOWN"
+
+# extension of files with cached market data
+MARKET_DATA_CACHE_EXTENSION = ".parquet"
+
+# names of files with saved portfolio state for incremental updates
+PORTFOLIO_VALUES_FILE_NAME = "portfolio_values.parquet"
+TRANSACTIONS_FINGERPRINT_FILE_NAME = "transactions_fingerprint.parquet"
+PORTFOLIO_STATE_FILE_NAME = "portfolio_state.json"
+LOTS_LEDGER_FILE_NAME = "lots_ledger.parquet"
+LOTS_STATE_FILE_NAME = "lots_state.json"
+
+# version of the calculation of saved portfolio values, it has to be increased after changing how the values are calculated
+# version 2 subtracts sells from expenses of securities
+PORTFOLIO_STATE_VERSION = 2
+
+# transactions fingerprint column name
+TRANSACTIONS_FINGERPRINT_COLUMN_NAME = "FINGERPRINT"
+
+# resolutions of portfolio data and the corresponding pandas period frequencies, daily data is not aggregated
+RESOLUTIONS = {"day": None, "week": "W", "month": "M", "year": "Y"}
+
+# name of files with saved aggregates of portfolio values, formatted with resolution
+PORTFOLIO_AGGREGATES_FILE_NAME = "portfolio_values_{}.parquet"
+
+# names of exported tables of computed results, each saved to a separate .arrow file
+EXPORT_TABLES = ["portfolio_data", "securities_data", "exchange_rates"]
+
+# version of the layout of exported tables, it has to be increased after changing the exported columns or their meaning
+# version 2 subtracts sells from expenses of securities and adds columns of the lots ledger
+EXPORT_SCHEMA_VERSION = 2
+
+# outputs of the analysis which can be selected, work needed only for not selected outputs is skipped
+OUTPUTS = ["status", "weights", "performance", "drawdowns", "risk", "plots", "export"]
+
+# parameters of portfolios with folders where each portfolio saves its own files
+PORTFOLIO_FOLDERS_PARAMETERS = [
+    "plots_folder_path",
+    "export_folder_path",
+    "portfolio_state_folder_path",
+]
+
+# types of plots which can be selected
+PLOT_TYPES = ["expense_value", "profit", "drawdown", "performance"]
+
+# name of file in plots folder with fingerprints of data and styling of rendered plots
+PLOTS_MANIFEST_FILE_NAME = "plots_manifest.json"
+
+# version of the look of plots, it has to be increased after changing generate_plot to render all plots again
+PLOTS_STYLE_VERSION = 1
+
+# calendar periods of returns and the corresponding pandas period frequencies
+RETURNS_PERIODS = {"year": "Y", "quarter": "Q", "month": "M"}
+
+
+# state of pipeline stages instrumentation, see start_instrumentation function
+INSTRUMENTATION = {
+    "enabled": False,
+    "trace_memory": False,
+    "profile_stages": [],
+    "profile_folder_path": None,
+    "stages": [],
+    "active_stages": [],
+    "profiling": False,
+}
+
+
+def start_instrumentation(
+    trace_memory=False, profile_stages=None, profile_folder_path="stages profiles"
+):
+    """
+    Starts measuring wall time, CPU time, memory and size of data of each instrumented pipeline stage
+
+    Parameters
+    ----------
+    trace_memory : bool
+        Whether to trace peak memory allocated by each stage, it slows down the pipeline (default is False)
+    profile_stages : list
+        List of stages names to profile, profiles are saved to profile_folder_path as .prof files readable by pstats module (default is None)
+    profile_folder_path : str
+        Path to folder where profiles of stages will be saved (default is "stages profiles")
+
+    Returns
+    -------
+    None
+    """
+    INSTRUMENTATION.update(
+        {
+            "enabled": True,
+            "trace_memory": trace_memory,
+            "profile_stages": profile_stages or [],
+            "profile_folder_path": profile_folder_path,
+            "stages": [],
+            "active_stages": [],
+            "profiling": False,
+        }
+    )
+
+    if trace_memory:
+        tracemalloc.start()
+
+
+def stop_instrumentation():
+    """
+    Stops measuring pipeline stages
+
+    Returns
+    -------
+    list
+        List of dictionaries with measurements of each stage in order of their start
+    """
+    if INSTRUMENTATION["trace_memory"]:
+        tracemalloc.stop()
+
+    INSTRUMENTATION["enabled"] = False
+
+    return INSTRUMENTATION["stages"]
+
+
+def data_shape(result, args):
+    """
+    Takes number of rows and columns of the data produced or processed by a stage
+
+    Parameters
+    ----------
+    result : object
+        Value returned by the stage
+    args : tuple
+        Arguments of the stage
+
+    Returns
+    -------
+    tuple
+        Number of rows and columns of the first DataFrame in the result or in the arguments, None values if there is no DataFrame
+    """
+    results = result if isinstance(result, tuple) else (result,)
+    for value in results + args:
+        if isinstance(value, pd.DataFrame):
+            return value.shape
+
+    return None, None
+
+
+def instrumented(stage_function):
+    """
+    Decorates pipeline stage function to measure it when instrumentation is started
+
+    Parameters
+    ----------
+    stage_function : function
+        Function of the pipeline stage, its name is used as the stage name
+
+    Returns
+    -------
+    function
+        Function which measures the stage and returns the same value as stage_function
+    """
+
+    @functools.wraps(stage_function)
+    def instrumented_stage_function(*args, **kwargs):
+        if not INSTRUMENTATION["enabled"]:
+            return stage_function(*args, **kwargs)
+
+        stage_name = stage_function.__name__
+        stage = {"stage": stage_name, "depth": len(INSTRUMENTATION["active_stages"])}
+        INSTRUMENTATION["stages"].append(stage)
+
+        # peak memory of the parent stage is kept before resetting it for this stage
+        if INSTRUMENTATION["trace_memory"]:
+            if INSTRUMENTATION["active_stages"]:
+                parent_stage = INSTRUMENTATION["active_stages"][-1]
+                parent_stage["peak_allocated"] = max(
+                    parent_stage["peak_allocated"], tracemalloc.get_traced_memory()[1]
+                )
+            tracemalloc.reset_peak()
+        stage["peak_allocated"] = 0
+        INSTRUMENTATION["active_stages"].append(stage)
+
+        # only one profiler can be active so stages nested in a profiled stage are not profiled separately
+        profiler = None
+        if (
+            stage_name in INSTRUMENTATION["profile_stages"]
+            and not INSTRUMENTATION["profiling"]
+        ):
+            profiler = cProfile.Profile()
+            INSTRUMENTATION["profiling"] = True
+            profiler.enable()
+
+        wall_start_time = time.perf_counter()
+        cpu_start_time = time.process_time()
+        try:
+            result = stage_function(*args, **kwargs)
+        finally:
+            stage["wall_time_s"] = time.perf_counter() - wall_start_time
+            stage["cpu_time_s"] = time.process_time() - cpu_start_time
+
+            if profiler is not None:
+                profiler.disable()
+                INSTRUMENTATION["profiling"] = False
+                os.makedirs(INSTRUMENTATION["profile_folder_path"], exist_ok=True)
+                stage["profile"] = os.path.join(
+                    INSTRUMENTATION["profile_folder_path"],
+                    f"{len(INSTRUMENTATION['stages']):03d}_{stage_name}.prof",
+                )
+                profiler.dump_stats(stage["profile"])
+
+            INSTRUMENTATION["active_stages"].pop()
+
+            # peak memory of the stage includes peaks of its nested stages and is passed to the parent stage
+            peak_allocated = None
+            if INSTRUMENTATION["trace_memory"]:
+                stage["peak_allocated"] = max(
+                    stage["peak_allocated"], tracemalloc.get_traced_memory()[1]
+                )
+                peak_allocated = stage["peak_allocated"] / 2**20
+                if INSTRUMENTATION["active_stages"]:
+                    parent_stage = INSTRUMENTATION["active_stages"][-1]
+                    parent_stage["peak_allocated"] = max(
+                        parent_stage["peak_allocated"], stage["peak_allocated"]
+                    )
+                tracemalloc.reset_peak()
+            stage["peak_allocated_mb"] = peak_allocated
+            del stage["peak_allocated"]
+
+            # maximum resident set size of the process so far (in kilobytes on Linux and in bytes on macOS)
+            stage["peak_rss_mb"] = (
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                / (2**20 if sys.platform == "darwin" else 2**10)
+                if resource is not None
+                else None
+            )
+
+        stage["rows"], stage["columns"] = data_shape(result, args)
+
+        return result
+
+    return instrumented_stage_function
+
+
+def print_instrumentation_report(stages):
+    """
+    Prints measurements of pipeline stages with nested stages indented
+
+    Parameters
+    ----------
+    stages : list
+        List of dictionaries with measurements of each stage returned by stop_instrumentation
+
+    Returns
+    -------
+    None
+    """
+    # measurements are formatted in advance as some of them may be missing
+    instrumentation_report = pd.DataFrame(
+        [
+            [
+                f"{stage['wall_time_s']:.3f}",
+                f"{stage['cpu_time_s']:.3f}",
+                f"{stage['peak_rss_mb']:.1f}" if stage["peak_rss_mb"] else "",
+                (
+                    f"{stage['peak_allocated_mb']:.1f}"
+                    if stage["peak_allocated_mb"]
+                    else ""
+                ),
+                stage["rows"] if stage["rows"] is not None else "",
+                stage["columns"] if stage["columns"] is not None else "",
+            ]
+            for stage in stages
+        ],
+        index=["  " * stage["depth"] + stage["stage"] for stage in stages],
+        columns=[
+            "WALL TIME [s]",
+            "CPU TIME [s]",
+            "PEAK RSS [MB]",
+            "PEAK ALLOCATED [MB]",
+            "ROWS",
+            "COLUMNS",
+        ],
+    )
+    instrumentation_report.index.name = "STAGES"
+    print(instrumentation_report.to_markdown(tablefmt="psql"))
+
+
+def save_instrumentation_report(stages, report_file_path):
+    """
+    Saves measurements of pipeline stages to .json file
+
+    Parameters
+    ----------
+    stages : list
+        List of dictionaries with measurements of each stage returned by stop_instrumentation
+    report_file_path : str
+        Path to .json file where measurements will be saved
+
+    Returns
+    -------
+    None
+    """
+    with open(report_file_path, "w") as report_file:
+        json.dump(
+            {
+                "created": datetime.datetime.now().isoformat(timespec="seconds"),
+                "stages": stages,
+            },
+            report_file,
+            indent=4,
+        )
+
+
+def downsample_line(values, max_points=None):
+    """
+    Selects points of a line keeping its shape with the minimum and the maximum of each bucket of neighbouring points
+
+    Parameters
+    ----------
+    values : ndarray
+        Array with values of the line, missing values are NaN
+    max_points : int
+        Maximum number of selected points, at least 4, all points are selected if not specified (default is None)
+
+    Returns
+    -------
+    ndarray
+        Sorted positions of the selected points, always with the first and the last point
+    """
+    points_count = len(values)
+    if max_points is None or points_count <= max_points:
+        return np.arange(points_count)
+    if max_points < 4:
+        raise ValueError(
+            f"Maximum number of plotted points must be at least 4, got {max_points}"
+        )
+
+    # inner points are split into buckets of the same size, each bucket gives its minimum and maximum
+    # so peaks, troughs and drawdown extremes stay in the plot while the first and the last point are kept as they are
+    buckets_count = (max_points - 2) // 2
+    bucket_size = -(-(points_count - 2) // buckets_count)
+    buckets = np.full(buckets_count * bucket_size, np.nan)
+    buckets[: points_count - 2] = values[1:-1]
+    buckets = buckets.reshape(buckets_count, bucket_size)
+
+    # missing values are never the extremes, a bucket without any value gives its first point to keep the gap in the line
+    bucket_starts = np.arange(buckets_count) * bucket_size + 1
+    minimum_points = bucket_starts + np.argmin(
+        np.where(np.isnan(buckets), np.inf, buckets), axis=1
+    )
+    maximum_points = bucket_starts + np.argmax(
+        np.where(np.isnan(buckets), -np.inf, buckets), axis=1
+    )
+
+    # trailing buckets may contain only padding
+    return np.unique(
+        np.concatenate(
+            [
+                [0],
+                np.minimum(
+                    np.concatenate([minimum_points, maximum_points]), points_count - 2
+                ),
+                [points_count - 1],
+            ]
+        )
+    )
+
 
+@instrumented
 def generate_plot(
-    data, folder_path, column1, column2, title, type, analysis_currency=None
+    data,
+    folder_path,
+    column1,
+    column2,
+    title,
+    type,
+    analysis_currency=None,
+    max_points=None,
 ):
     """
     Plot data from data DataFrame and save it to folder_path with title.png name
@@ -50,11 +458,18 @@ def generate_plot(
         Type of the plot to generate (expense_value, profit, drawdown, performance)
     analysis_currency : str
         Currency to analyze (default is None)
+    max_points : int
+        Maximum number of points of each plotted line, all points are plotted if not specified (default is None)
 
     Returns
     -------
-    None
+    int
+        Number of points of the plotted columns
+    int
+        Number of actually plotted points
     """
+    import matplotlib.pyplot as plt
+
     # prepare path to save plot by adding title and extension to folder_path
     path = os.path.join(folder_path, f"{title}.png")
 
@@ -72,24 +487,220 @@ def generate_plot(
     plt.title(f"{title}\n{start_date} - {end_date}")
     plt.grid(True)
 
+    # downsample each line separately to keep its own peaks and troughs
+    lines = {}
+    for column in [column1, column2] if type == "expense_value" else [column1]:
+        values = data[column].to_numpy(dtype=float)
+        points = downsample_line(values, max_points)
+        lines[column] = (data.index[points], values[points])
+
     # plot one line for profit or two lines for expense and value
     if type == "expense_value":
-        plt.plot(data.index, data[column1], label="Expense value", color="mediumblue")
-        plt.plot(data.index, data[column2], label="Real value", color="darkorange")
+        plt.plot(*lines[column1], label="Expense value", color="mediumblue")
+        plt.plot(*lines[column2], label="Real value", color="darkorange")
         plt.legend()
     elif type == "profit":
-        plt.plot(data.index, data[column1], color="darkblue")
+        plt.plot(*lines[column1], color="darkblue")
         plt.axhline(y=0, color="black", linestyle="--")
     elif type == "drawdown":
-        plt.plot(data.index, data[column1], color="dimgray")
+        plt.plot(*lines[column1], color="dimgray")
         plt.axhline(y=0, color="black", linestyle="--")
     elif type == "performance":
-        plt.plot(data.index, data[column1], color="darkgreen")
+        plt.plot(*lines[column1], color="darkgreen")
 
     plt.savefig(path)
     plt.close()
 
+    return len(data) * len(lines), sum(len(x) for x, _ in lines.values())
+
+
+def init_plot_worker():
+    """
+    Prepares worker process for plots rendering by switching matplotlib to the non-interactive backend
+
+    Returns
+    -------
+    None
+    """
+    # pyplot is already imported if the worker is forked from a process which rendered plots
+    # otherwise the backend is only set for the future import to not import matplotlib in workers which do not render plots
+    if "matplotlib.pyplot" in sys.modules:
+        sys.modules["matplotlib.pyplot"].switch_backend("Agg")
+    else:
+        os.environ["MPLBACKEND"] = "Agg"
+
+
+def render_plots(plots, plots_workers=1):
+    """
+    Renders plots one after another or in parallel using a pool of worker processes
+
+    Parameters
+    ----------
+    plots : list
+        List of dictionaries with generate_plot arguments for each plot
+    plots_workers : int
+        Number of worker processes to render plots with, plots are rendered one after another if it is 1 and all CPUs are used if it is None (default is 1)
+
+    Returns
+    -------
+    dict
+        Dictionary with titles of plots which failed to render as keys and the corresponding errors as values
+    """
+    failed_plots = {}
+
+    # numbers of points of the plotted columns and of actually plotted points for each rendered plot
+    plots_points = {}
+
+    if plots_workers == 1:
+        for plot in plots:
+            try:
+                plots_points[plot["title"]] = generate_plot(**plot)
+            except Exception as error:
+                failed_plots[plot["title"]] = error
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=plots_workers, initializer=init_plot_worker
+        ) as executor:
+            futures = {
+                executor.submit(generate_plot, **plot): plot["title"] for plot in plots
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    plots_points[futures[future]] = future.result()
+                except Exception as error:
+                    failed_plots[futures[future]] = error
+
+    # report plots which failed to render without aborting the other plots
+    for title, error in failed_plots.items():
+        warnings.warn(f"Plot {title} could not be rendered: {error!r}")
+
+    print_plots_downsampling(plots, plots_points)
+
+    return failed_plots
+
+
+def print_plots_downsampling(plots, plots_points):
+    """
+    Prints reduction of the number of plotted points by downsampling for each type of plots, nothing is printed if no plot was downsampled
+
+    Parameters
+    ----------
+    plots : list
+        List of dictionaries with generate_plot arguments for each plot
+    plots_points : dict
+        Dictionary with titles of rendered plots as keys and tuples with numbers of points of the plotted columns and of actually plotted points as values
+
+    Returns
+    -------
+    None
+    """
+    if all(
+        points == plotted_points for points, plotted_points in plots_points.values()
+    ):
+        return
+
+    # sum points of rendered plots of each type in the order of the plots
+    plots_downsampling = pd.DataFrame(
+        [
+            [plot["type"], *plots_points[plot["title"]]]
+            for plot in plots
+            if plot["title"] in plots_points
+        ],
+        columns=["TYPE", "POINTS", "PLOTTED POINTS"],
+    )
+    plots_downsampling["PLOTS"] = 1
+    plots_downsampling = plots_downsampling.groupby("TYPE", sort=False)[
+        ["PLOTS", "POINTS", "PLOTTED POINTS"]
+    ].sum()
+    plots_downsampling.loc["SUM"] = plots_downsampling.sum()
+    plots_downsampling["REDUCTION [%]"] = (
+        1 - plots_downsampling["PLOTTED POINTS"] / plots_downsampling["POINTS"]
+    ) * 100
+
+    plots_downsampling.index = plots_downsampling.index.str.upper()
+    plots_downsampling.index.name = "PLOTS DOWNSAMPLING"
+    print(
+        plots_downsampling.to_markdown(
+            tablefmt="psql", floatfmt=("", ".0f", ".0f", ".0f", ".2f")
+        )
+    )
+
+
+def plot_fingerprint(plot):
+    """
+    Calculates fingerprint of data and styling of a plot
+
+    Parameters
+    ----------
+    plot : dict
+        Dictionary with generate_plot arguments of the plot
+
+    Returns
+    -------
+    str
+        Hexadecimal hash of plotted data with dates and of the other generate_plot arguments
+    """
+    fingerprint = hashlib.sha256()
+    fingerprint.update(
+        pd.util.hash_pandas_object(plot["data"], index=True).to_numpy().tobytes()
+    )
+
+    # arguments other than data decide about columns, labels, colors and number of points of the plot
+    arguments = {key: value for key, value in plot.items() if key != "data"}
+    fingerprint.update(
+        json.dumps(
+            [PLOTS_STYLE_VERSION, list(plot["data"].columns), arguments],
+            sort_keys=True,
+            default=str,
+        ).encode()
+    )
+
+    return fingerprint.hexdigest()
+
+
+def load_plots_manifest(plots_folder_path):
+    """
+    Loads fingerprints of plots rendered in previous runs
+
+    Parameters
+    ----------
+    plots_folder_path : str
+        Path to folder where plots are saved
+
+    Returns
+    -------
+    dict
+        Dictionary with titles of plots as keys and dictionaries with fingerprint and security of each plot as values, empty if there is no manifest
+    """
+    manifest_file_path = os.path.join(plots_folder_path, PLOTS_MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_file_path):
+        return {}
+
+    with open(manifest_file_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_plots_manifest(plots_folder_path, plots_manifest):
+    """
+    Saves fingerprints of rendered plots to compare them with plots of the next run
+
+    Parameters
+    ----------
+    plots_folder_path : str
+        Path to folder where plots are saved
+    plots_manifest : dict
+        Dictionary with titles of plots as keys and dictionaries with fingerprint and security of each plot as values
+
+    Returns
+    -------
+    None
+    """
+    manifest_file_path = os.path.join(plots_folder_path, PLOTS_MANIFEST_FILE_NAME)
+    with open(manifest_file_path, "w") as manifest_file:
+        json.dump(plots_manifest, manifest_file, indent=4, sort_keys=True)
 
+
+@instrumented
 def create_plots(
     portfolio_data,
     securities_data,
@@ -99,6 +710,11 @@ def create_plots(
     securities_value,
     securities_expense,
     securities_profit,
+    plots_workers=1,
+    plot_types=None,
+    plots_max_points=None,
+    force_plots=False,
+    prune_securities=None,
 ):
     """
     Manages plots creation for expenses, values and profits for each security and portfolio as a whole
@@ -121,90 +737,176 @@ def create_plots(
         List of securities expense names
     securities_profit : list
         List of securities profit names
+    plots_workers : int
+        Number of worker processes to render plots with, plots are rendered one after another if it is 1 and all CPUs are used if it is None (default is 1)
+    plot_types : list
+        List of types of plots from PLOT_TYPES to create, all types are created if not specified (default is None)
+    plots_max_points : int
+        Maximum number of points of each plotted line, longer lines are downsampled keeping minimum and maximum of each bucket of neighbouring points (default is None)
+    force_plots : bool
+        Whether to render all plots, otherwise only plots with data or styling changed since they were rendered last time are rendered (default is False)
+    prune_securities : list
+        List of all securities names of the portfolio, plots of other securities rendered in previous runs are removed, nothing is removed if not specified (default is None)
 
     Returns
     -------
-    None
+    dict
+        Dictionary with titles of plots which failed to render as keys and the corresponding errors as values
     """
+    plot_types = select_names(plot_types, PLOT_TYPES, "plot type")
+
     # create plots folder if it does not exist
     if not os.path.exists(plots_folder_path):
         os.makedirs(plots_folder_path)
 
+    # arguments of generate_plot for each plot
+    # data of each plot is limited to the plotted columns to pass as little data as possible to worker processes
+    plots = []
+
     # plot for expense and value for each security
-    for security_name, security_value, security_expense in zip(
-        securities, securities_value, securities_expense
-    ):
-        generate_plot(
-            data=portfolio_data,
-            folder_path=plots_folder_path,
-            column1=security_expense,
-            column2=security_value,
-            title=security_name + VALUE_AND_EXPENSE_SUFFIX,
-            type="expense_value",
-            analysis_currency=analysis_currency,
-        )
+    if "expense_value" in plot_types:
+        for security_name, security_value, security_expense in zip(
+            securities, securities_value, securities_expense
+        ):
+            plots.append(
+                dict(
+                    data=portfolio_data[[security_expense, security_value]],
+                    folder_path=plots_folder_path,
+                    column1=security_expense,
+                    column2=security_value,
+                    title=security_name + VALUE_AND_EXPENSE_SUFFIX,
+                    type="expense_value",
+                    analysis_currency=analysis_currency,
+                )
+            )
 
     # one line plot for profit for each security
-    for security_name, security_expense, security_profit in zip(
-        securities, securities_expense, securities_profit
-    ):
-        # take only rows with positive values from expense column to plot only data when security was bought
-        # the already bought security has cummulated expense since the first buy
-        portfolio_data_truncated = portfolio_data[portfolio_data[security_expense] > 0]
-
-        generate_plot(
-            data=portfolio_data_truncated,
-            folder_path=plots_folder_path,
-            column1=security_profit,
-            column2=None,
-            title=security_name + PROFIT_SUFFIX,
-            type="profit",
-            analysis_currency=analysis_currency,
-        )
+    if "profit" in plot_types:
+        for security_name, security_expense, security_profit in zip(
+            securities, securities_expense, securities_profit
+        ):
+            # take only rows with positive values from expense column to plot only data when security was bought
+            # the already bought security has cummulated expense since the first buy
+            portfolio_data_truncated = portfolio_data[
+                portfolio_data[security_expense] > 0
+            ]
+
+            plots.append(
+                dict(
+                    data=portfolio_data_truncated[[security_profit]],
+                    folder_path=plots_folder_path,
+                    column1=security_profit,
+                    column2=None,
+                    title=security_name + PROFIT_SUFFIX,
+                    type="profit",
+                    analysis_currency=analysis_currency,
+                )
+            )
 
     # plot for profit for portfolio as a whole
-    generate_plot(
-        data=portfolio_data,
-        folder_path=plots_folder_path,
-        column1=PORTFOLIO + PROFIT_SUFFIX,
-        column2=None,
-        title=PORTFOLIO + PROFIT_SUFFIX,
-        type="profit",
-        analysis_currency=analysis_currency,
-    )
+    if "profit" in plot_types:
+        plots.append(
+            dict(
+                data=portfolio_data[[PORTFOLIO + PROFIT_SUFFIX]],
+                folder_path=plots_folder_path,
+                column1=PORTFOLIO + PROFIT_SUFFIX,
+                column2=None,
+                title=PORTFOLIO + PROFIT_SUFFIX,
+                type="profit",
+                analysis_currency=analysis_currency,
+            )
+        )
 
     # plot for expense and value for portfolio as a whole
-    generate_plot(
-        data=portfolio_data,
-        folder_path=plots_folder_path,
-        column1=PORTFOLIO + EXPENSE_SUFFIX,
-        column2=PORTFOLIO + VALUE_SUFFIX,
-        title=PORTFOLIO + VALUE_AND_EXPENSE_SUFFIX,
-        type="expense_value",
-        analysis_currency=analysis_currency,
-    )
+    if "expense_value" in plot_types:
+        plots.append(
+            dict(
+                data=portfolio_data[
+                    [PORTFOLIO + EXPENSE_SUFFIX, PORTFOLIO + VALUE_SUFFIX]
+                ],
+                folder_path=plots_folder_path,
+                column1=PORTFOLIO + EXPENSE_SUFFIX,
+                column2=PORTFOLIO + VALUE_SUFFIX,
+                title=PORTFOLIO + VALUE_AND_EXPENSE_SUFFIX,
+                type="expense_value",
+                analysis_currency=analysis_currency,
+            )
+        )
 
     # plot portfolio drawdowns
-    generate_plot(
-        data=portfolio_data,
-        folder_path=plots_folder_path,
-        column1=PORTFOLIO + DRAWDOWN_SUFFIX,
-        column2=None,
-        title=PORTFOLIO + DRAWDOWN_SUFFIX,
-        type="drawdown",
-    )
+    if "drawdown" in plot_types:
+        plots.append(
+            dict(
+                data=portfolio_data[[PORTFOLIO + DRAWDOWN_SUFFIX]],
+                folder_path=plots_folder_path,
+                column1=PORTFOLIO + DRAWDOWN_SUFFIX,
+                column2=None,
+                title=PORTFOLIO + DRAWDOWN_SUFFIX,
+                type="drawdown",
+            )
+        )
 
     # one line plot each security performance
-    for security_name in securities:
-        generate_plot(
-            data=securities_data,
-            folder_path=plots_folder_path,
-            column1=security_name,
-            column2=None,
-            title=security_name + SINCE_INCEPTION_SUFFIX,
-            type="performance",
-            analysis_currency=analysis_currency,
-        )
+    if "performance" in plot_types:
+        for security_name in securities:
+            plots.append(
+                dict(
+                    data=securities_data[[security_name]],
+                    folder_path=plots_folder_path,
+                    column1=security_name,
+                    column2=None,
+                    title=security_name + SINCE_INCEPTION_SUFFIX,
+                    type="performance",
+                    analysis_currency=analysis_currency,
+                )
+            )
+
+    # downsample lines of all plots to the same maximum number of points
+    for plot in plots:
+        plot["max_points"] = plots_max_points
+
+    # render only plots which are missing or whose data or styling changed since the last run
+    plots_manifest = load_plots_manifest(plots_folder_path)
+    plots_fingerprints = {plot["title"]: plot_fingerprint(plot) for plot in plots}
+    changed_plots = [
+        plot
+        for plot in plots
+        if force_plots
+        or plots_manifest.get(plot["title"], {}).get("fingerprint")
+        != plots_fingerprints[plot["title"]]
+        or not os.path.exists(os.path.join(plots_folder_path, f"{plot['title']}.png"))
+    ]
+
+    failed_plots = render_plots(changed_plots, plots_workers)
+
+    # plots which failed to render are rendered again in the next run
+    plots_suffixes = {
+        "expense_value": VALUE_AND_EXPENSE_SUFFIX,
+        "profit": PROFIT_SUFFIX,
+        "drawdown": DRAWDOWN_SUFFIX,
+        "performance": SINCE_INCEPTION_SUFFIX,
+    }
+    for plot in changed_plots:
+        if plot["title"] in failed_plots:
+            plots_manifest.pop(plot["title"], None)
+        else:
+            plots_manifest[plot["title"]] = {
+                "fingerprint": plots_fingerprints[plot["title"]],
+                "security": plot["title"][: -len(plots_suffixes[plot["type"]])],
+            }
+
+    # remove plots of securities which are no longer in the portfolio, other files in plots folder are left untouched
+    if prune_securities is not None:
+        for title, plot_entry in list(plots_manifest.items()):
+            if plot_entry["security"] not in [*prune_securities, PORTFOLIO]:
+                plot_path = os.path.join(plots_folder_path, f"{title}.png")
+                if os.path.exists(plot_path):
+                    os.remove(plot_path)
+                del plots_manifest[title]
+
+    save_plots_manifest(plots_folder_path, plots_manifest)
+
+    return failed_plots
 
 
 def portfolio_period_to_analysis(
@@ -237,714 +939,3879 @@ def portfolio_period_to_analysis(
     return portfolio_data
 
 
-def download_yahoo(tickers, distinct_currencies, ohlc, analysis_currency, securities):
+def fetch_yahoo(symbols, start_date=None, timeout=10):
     """
-    Downloads data from yahoo finance for tickers and currencies
+    Fetches all open, high, low, close data from yahoo finance for symbols
 
     Parameters
     ----------
-    tickers : list
-        List of tickers to download
-    distinct_currencies : str
-        Currencies to download
-    ohlc : str
-        Open, High, Low, Close data to download
-    analysis_currency : str
-        Currency in which the analysis will be done
-    securities : list
-        List of securities names
+    symbols : list
+        List of tickers or currency pairs in yahoo finance format (e.g. EURUSD=X) to fetch
+    start_date : str
+        Date from which the data will be fetched, the whole history is fetched if not specified (default is None)
+    timeout : float
+        Number of seconds to wait for a response from yahoo finance (default is 10)
 
     Returns
     -------
-    DataFrame
-        DataFrame with downloaded data for tickers
-    DataFrame
-        DataFrame with downloaded exchange rates for currencies
+    dict
+        Dictionary with symbols as keys and DataFrames with fetched data as values
     """
-    # convert ohlc to upper case first letter and lower case the rest
-    ohlc = ohlc[0].upper() + ohlc[1:].lower()
-
-    # download securities data from yahoo finance
-    yahoo_securities_data = yf.download(tickers, period="max")[ohlc]
-    df_securities = pd.DataFrame(yahoo_securities_data)
+    import yfinance as yf
 
-    # set columns order to a specified one in order to correctly set columns names later
-    df_securities = df_securities[tickers]
+    if start_date:
+        yahoo_data = yf.download(symbols, start=start_date, timeout=timeout)
+    else:
+        yahoo_data = yf.download(symbols, period="max", timeout=timeout)
 
-    # set index name to DATE and set columns names to securities names
-    df_securities.index.name = DATE
-    df_securities.columns = securities
+    # split fetched data into separate DataFrames for each symbol
+    # columns are indexed by data fields and symbols unless a single symbol is fetched with older yfinance versions
+    symbols_data = {}
+    for symbol in symbols:
+        if isinstance(yahoo_data.columns, pd.MultiIndex):
+            symbol_data = yahoo_data.xs(symbol, axis=1, level=1)
+        else:
+            symbol_data = yahoo_data
+        symbols_data[symbol] = symbol_data.dropna(how="all")
 
-    # create list of currency pairs to download exchange rates for
-    distinct_currency_pairs = [
-        currency + analysis_currency for currency in distinct_currencies
-    ]
+    return symbols_data
 
-    # remove currency pair which is the same as analysis currency
-    distinct_currency_pairs.remove(analysis_currency * 2)
 
-    # if currency pairs are specified then download exchange rates for them else set exchange rates to None
-    distinct_currency_pairs_format = [
-        currency + "=X" for currency in distinct_currency_pairs
-    ]
+def fetch_replay(symbols, start_date=None, replay_folder_path="market data replay"):
+    """
+    Fetches recorded open, high, low, close data for symbols from local .csv files to replay it without network access
 
-    # download exchange rates from yahoo finance if there are any distinct currency pairs different than analysis currency
-    # if distinct_currency_pairs_format:
-    yahoo_currencies_data = yf.download(distinct_currency_pairs_format, period="max")[
-        ohlc
-    ]
-
-    # check if yahoo_currencies_data is a Series or DataFrame
-    if isinstance(yahoo_currencies_data, pd.Series):
-        # create DataFrame with downloaded exchange rate and set column name to currency pair
-        exchange_rates = pd.DataFrame(yahoo_currencies_data)
-        exchange_rates.columns = distinct_currency_pairs
-    else:
-        # set columns order to a specified one in order to correctly set columns names later
-        exchange_rates = yahoo_currencies_data[distinct_currency_pairs_format]
-        exchange_rates.columns = distinct_currency_pairs
+    Parameters
+    ----------
+    symbols : list
+        List of tickers or currency pairs in yahoo finance format (e.g. EURUSD=X) to fetch
+    start_date : str
+        Date from which the data will be fetched, the whole history is fetched if not specified (default is None)
+    replay_folder_path : str
+        Path to folder with recorded .csv files named after symbols (default is "market data replay")
 
-    # if there is analysis currency in distinct currencies then add column with exchange rates equal to 1.0
-    if distinct_currencies.index(analysis_currency) != -1:
-        analysis_currency_exchange_rates = pd.Series(
-            [1.0 for _ in range(len(df_securities.index))],
-            index=df_securities.index,
-            name=analysis_currency * 2,
-        )
-        exchange_rates = pd.concat(
-            [exchange_rates, analysis_currency_exchange_rates], axis=1
+    Returns
+    -------
+    dict
+        Dictionary with symbols as keys and DataFrames with recorded data as values
+    """
+    symbols_data = {}
+    for symbol in symbols:
+        symbol_data = pd.read_csv(
+            os.path.join(replay_folder_path, f"{symbol}.csv"),
+            index_col=0,
+            parse_dates=True,
         )
 
-    return df_securities, exchange_rates
+        # take only the data from start_date as a real provider would do
+        if start_date:
+            symbol_data = symbol_data[
+                symbol_data.index >= datetime.datetime.strptime(start_date, "%Y-%m-%d")
+            ]
 
+        symbols_data[symbol] = symbol_data
 
-def load_portfolio_transactions_data(
-    portfolio_data_file_name,
-    data_folder_path,
-    exchange_rates,
-    transaction_payment_list,
-    fee_payment_list,
-    analysis_currency,
+    return symbols_data
+
+
+def fetch_http(
+    symbols, start_date=None, url="http://localhost:8000/{symbol}.csv", timeout=10
 ):
     """
-    Loads data from .csv file with portfolio transactions data
+    Fetches open, high, low, close data for symbols from .csv files served over HTTP, e.g. recorded data shared by a local server
 
     Parameters
     ----------
-    portfolio_data_file_name : str
-        Name of the .csv file with portfolio data
-    data_folder_path : str
-        Path to folder where portfolio data files are stored
-    exchange_rates : DataFrame
-        DataFrame with exchange rates
-    transaction_payment_list : list
-        List with transaction payment column as a first element and its currency as a second element
-    fee_payment_list : list
-        List with fee payment column as a first element and its currency as a second element
-    analysis_currency : str
-        Currency which will be used for analysis
+    symbols : list
+        List of tickers or currency pairs in yahoo finance format (e.g. EURUSD=X) to fetch
+    start_date : str
+        Date from which the data will be fetched, the whole history is fetched if not specified (default is None)
+    url : str
+        URL of .csv file formatted with symbol, the files have the same format as files recorded by record_market_data (default is "http://localhost:8000/{symbol}.csv")
+    timeout : float
+        Number of seconds to wait for a response from the server (default is 10)
 
     Returns
     -------
-    DataFrame
-        DataFrame with portfolio transactions data converted to analysis currency
+    dict
+        Dictionary with symbols as keys and DataFrames with fetched data as values
     """
-    portfolio_data = pd.read_csv(
-        os.path.join(data_folder_path, portfolio_data_file_name),
-        index_col=0,
-        low_memory=False,
-    )
-    portfolio_data.index = pd.to_datetime(portfolio_data.index, format="%Y-%m-%d")
-    portfolio_data.index.name = DATE
+    import urllib.parse
+    import urllib.request
 
-    # convert transaction and fee payments to analysis currency
-    transaction_column_name = transaction_payment_list[0]
-    fee_column_name = fee_payment_list[0]
+    symbols_data = {}
+    for symbol in symbols:
+        with urllib.request.urlopen(
+            url.format(symbol=urllib.parse.quote(symbol)), timeout=timeout
+        ) as response:
+            symbol_data = pd.read_csv(response, index_col=0, parse_dates=True)
 
-    transaction_currency_pair = transaction_payment_list[1] + analysis_currency
-    fee_currency_pair = fee_payment_list[1] + analysis_currency
+        # take only the data from start_date as a real provider would do
+        if start_date:
+            symbol_data = symbol_data[
+                symbol_data.index >= datetime.datetime.strptime(start_date, "%Y-%m-%d")
+            ]
 
-    # convert transaction and fee payments to analysis currency and assign them to a new column
-    # to resolve an issue that Pandas cannot reindex on an axis with duplicate labels I will do it in a loop
-    for index in portfolio_data.index:
-        portfolio_data.loc[index, TRANSACTION_PAYMENT_COLUMN_NAME] = (
-            portfolio_data.loc[index, transaction_column_name]
-            * exchange_rates.loc[index, transaction_currency_pair]
-        )
+        symbols_data[symbol] = symbol_data
 
-        portfolio_data.loc[index, FEE_PAYMENT_COLUMN_NAME] = (
-            portfolio_data.loc[index, fee_column_name]
-            * exchange_rates.loc[index, fee_currency_pair]
-        )
+    return symbols_data
 
-    return portfolio_data
 
+def record_market_data(market_data, replay_folder_path):
+    """
+    Records market data to local .csv files which can be replayed later with the replay provider
 
-def prepare_portfolio_data(
-    securities_data,
-    exchange_rates,
-    transaction_payments,
-    fee_payments,
-    analysis_currency,
-    portfolio_data_files_names_and_payments_columns,
-    data_folder_path,
-    first_transaction_date,
-):
+    Parameters
+    ----------
+    market_data : dict
+        Dictionary with symbols as keys and DataFrames with market data as values
+    replay_folder_path : str
+        Path to folder where recorded .csv files will be saved
+
+    Returns
+    -------
+    None
     """
-    Prepares portfolio data for analysis
+    # create replay folder if it does not exist
+    if not os.path.exists(replay_folder_path):
+        os.makedirs(replay_folder_path)
+
+    for symbol, symbol_data in market_data.items():
+        symbol_data.to_csv(os.path.join(replay_folder_path, f"{symbol}.csv"))
+
+
+# market data providers available by name
+# each provider is a function taking list of symbols, start date (None for the whole history) and provider specific keyword options
+# providers which send requests take timeout keyword option with the number of seconds to wait for a response
+# it returns dictionary with symbols as keys and DataFrames with open, high, low, close columns indexed by dates as values
+MARKET_DATA_PROVIDERS = {
+    "yahoo": fetch_yahoo,
+    "replay": fetch_replay,
+    "http": fetch_http,
+}
+
+# providers which must not be called from many threads at once, symbols are fetched with them one after another
+# yfinance keeps downloaded data in module globals, so concurrent downloads can mix up or drop data of symbols
+SERIAL_MARKET_DATA_PROVIDERS = ["yahoo"]
+
+
+def register_market_data_provider(provider_name, fetch_function, thread_safe=True):
+    """
+    Registers a new market data provider which can be used by its name to download market data
 
     Parameters
     ----------
-    securities_data : DataFrame
-        DataFrame with securities data
-    exchange_rates : DataFrame
-        DataFrame with exchange rates
-    transaction_payments : dict
-        Dictionary with transaction payments columns and their currencies
-    fee_payments : dict
-        Dictionary with fee payments columns and their currencies
-    analysis_currency : str
-        Currency in which the analysis will be done
-    portfolio_data_files_names_and_payments_columns : dict
-        Dictionary with portfolio data files names and corresponding payments columns (buy/sold and fees)
-    data_folder_path : str
-        Path to folder where portfolio data files are stored
-    first_transaction_date : str
-        First transaction date
+    provider_name : str
+        Name of the provider
+    fetch_function : function
+        Function with the same parameters and return value as fetch_yahoo, it may take additional keyword options
+    thread_safe : bool
+        Whether the provider can be called from many threads at once, symbols are fetched with it one after another otherwise (default is True)
 
     Returns
     -------
-    DataFrame
-        DataFrame with portfolio data prepared for analysis
+    None
     """
-    # take only rows of DataFrame indexed from first_transaction_date
-    securities_data = securities_data[
-        securities_data.index
-        >= datetime.datetime.strptime(first_transaction_date, "%Y-%m-%d")
-    ].copy()
+    MARKET_DATA_PROVIDERS[provider_name] = fetch_function
+    if thread_safe and provider_name in SERIAL_MARKET_DATA_PROVIDERS:
+        SERIAL_MARKET_DATA_PROVIDERS.remove(provider_name)
+    elif not thread_safe and provider_name not in SERIAL_MARKET_DATA_PROVIDERS:
+        SERIAL_MARKET_DATA_PROVIDERS.append(provider_name)
 
-    # fill NaN values with previous values as we assume that if there is no value for a day it means that the stock market was closed that day and the value is the same as the previous day
-    securities_data = securities_data.fillna(method="ffill")
 
-    # just in case if there are still NaN values as the first rows of the DataFrame we fill them with 0
-    securities_data = securities_data.fillna(0)
+def market_data_cache_folder_path(cache_folder_path, provider="yahoo"):
+    """
+    Prepares path to the folder with cached market data of the provider
 
-    # load portfolio data from .csv files where dates, securities and values of transactions are stored and concatenate them into one DataFrame
-    portfolio_data = pd.DataFrame()
-    for (
-        portfolio_data_file_name,
-        payment_columns,
-    ) in portfolio_data_files_names_and_payments_columns.items():
-        # take column which specifies the transaction payment currency, find a currency and create a list with column name and currency
-        transaction_column = payment_columns.get(TRANSACTION_PAYMENT_COLUMN_NAME)
-        transaction_currency = transaction_payments.get(transaction_column)
-        transaction_payment_list = [transaction_column, transaction_currency]
+    Parameters
+    ----------
+    cache_folder_path : str
+        Path to folder where market data is cached
+    provider : str
+        Name of the market data provider from MARKET_DATA_PROVIDERS (default is "yahoo")
 
-        # take column which specifies the fee payment currency, find a currency and create a list with column name and currency
-        fee_column = payment_columns.get(FEE_PAYMENT_COLUMN_NAME)
-        fee_currency = fee_payments.get(fee_column)
-        fee_payment_list = [fee_column, fee_currency]
+    Returns
+    -------
+    str
+        Path to the folder with cached market data of the provider
+    """
+    # data of different providers is cached separately so that it is never mixed
+    # data of yahoo stays in the cache folder itself, so that caches created before remain valid
+    if provider == "yahoo":
+        return cache_folder_path
 
-        # load part of portfolio data from .csv file
-        portfolio_data_part = load_portfolio_transactions_data(
-            portfolio_data_file_name,
-            data_folder_path,
-            exchange_rates,
-            transaction_payment_list,
-            fee_payment_list,
-            analysis_currency,
-        )
+    return os.path.join(cache_folder_path, provider)
 
-        # concatenate part of portfolio data with the rest of portfolio data
-        portfolio_data = pd.concat([portfolio_data, portfolio_data_part])
 
-    # merge raw securities data with portfolio data
-    portfolio_data = securities_data.join(portfolio_data, rsuffix=COUNT_SUFFIX)
+def market_data_cache_file_path(cache_folder_path, symbol):
+    """
+    Prepares path to the cache file with market data for symbol
 
-    # sort index in ascending order to ensure that the dates are in the desired order
-    portfolio_data = portfolio_data.sort_index()
+    Parameters
+    ----------
+    cache_folder_path : str
+        Path to folder where market data is cached
+    symbol : str
+        Ticker or currency pair in yahoo finance format
 
-    return portfolio_data
+    Returns
+    -------
+    str
+        Path to the cache file
+    """
+    return os.path.join(cache_folder_path, f"{symbol}{MARKET_DATA_CACHE_EXTENSION}")
 
 
-def print_portfolio_status(
-    portfolio_data,
-    analysis_currency,
-    securities,
-    securities_count,
-    securities_value,
-    securities_expense,
-    securities_profit,
-):
+def clear_market_data_cache(cache_folder_path, symbols=None, provider="yahoo"):
     """
-    Prints portfolio status with current values and profits for each security
+    Removes cached market data so it will be downloaded again with the whole history
 
     Parameters
     ----------
-    portfolio_data : DataFrame
-        DataFrame with portfolio data
-    analysis_currency : str
-        Currency to analyze
-    securities : list
-        List of securities names
-    securities_count : list
-        List of securities count names
-    securities_value : list
-        List of securities value names
-    securities_expense : list
-        List of securities expense names
-    securities_profit : list
-        List of securities profit names
+    cache_folder_path : str
+        Path to folder where market data is cached
+    symbols : list
+        List of tickers or currency pairs to remove from the cache, the whole cache of the provider is removed if not specified (default is None)
+    provider : str
+        Name of the market data provider from MARKET_DATA_PROVIDERS whose cached data is removed (default is "yahoo")
 
     Returns
     -------
     None
     """
-    # take the last row of portfolio_data DataFrame which is the current portfolio status and calculate profit in percentage
-    portfolio_data_current = pd.DataFrame()
-    for (
-        security_name,
-        security_count,
-        security_value,
-        security_expense,
-        security_profit,
-    ) in zip(
-        securities,
-        securities_count,
-        securities_value,
-        securities_expense,
-        securities_profit,
-    ):
-        new_security_column = portfolio_data[
-            [security_count, security_expense, security_value, security_profit]
-        ].iloc[-1]
+    cache_folder_path = market_data_cache_folder_path(cache_folder_path, provider)
 
-        # calculate profit in percentage
-        new_security_column["PROFIT [%]"] = (
-            100
-            * (
-                new_security_column[security_value]
-                - new_security_column[security_expense]
-            )
-            / new_security_column[security_expense]
-        )
+    if not os.path.exists(cache_folder_path):
+        return
 
-        new_security_column = pd.DataFrame(
-            new_security_column.values, columns=[security_name]
-        )
-        new_security_column.index = [
-            "COUNT",
-            "EXPENSE",
-            "VALUE",
-            "PROFIT",
-            "PROFIT [%]",
+    # take all cached symbols if symbols to remove are not specified
+    if symbols is None:
+        symbols = [
+            file_name[: -len(MARKET_DATA_CACHE_EXTENSION)]
+            for file_name in os.listdir(cache_folder_path)
+            if file_name.endswith(MARKET_DATA_CACHE_EXTENSION)
         ]
-        portfolio_data_current = pd.concat(
-            [portfolio_data_current, new_security_column], axis=1
-        )
 
-    portfolio_data_current.index.name = f"PORTFOLIO STATUS [{analysis_currency}]"
-    print(portfolio_data_current.to_markdown(tablefmt="psql", floatfmt=".2f"))
+    for symbol in symbols:
+        cache_file_path = market_data_cache_file_path(cache_folder_path, symbol)
+        if os.path.exists(cache_file_path):
+            os.remove(cache_file_path)
 
 
-def print_portfolio_weights_and_goal(
-    portfolio_data,
-    analysis_currency,
-    weights,
-    weight_groups,
-    securities,
-    securities_count,
-    securities_value,
-    securities_unit_value,
+def fetch_symbol(
+    fetch,
+    symbol,
+    start_date,
+    provider_options,
+    timeout=None,
+    retries=0,
+    retry_delay_s=1,
 ):
     """
-    Prints portfolio current weights and goal proportions for each security group and portfolio as a whole
+    Fetches market data of a single symbol retrying failed requests with exponential backoff
 
     Parameters
     ----------
-    portfolio_data : DataFrame
-        DataFrame with portfolio data
-    analysis_currency : str
-        Currency to analyze
-    weights : dict
-        Dictionary with weights for each security group
-    weight_groups : dict
-        Dictionary with securities names for each security group
-    securities : list
-        List of securities names
-    securities_count : list
-        List of securities count names
-    securities_value : list
-        List of securities value names
-    securities_unit_value : list
-        List of securities unit value names
+    fetch : function
+        Market data provider function from MARKET_DATA_PROVIDERS
+    symbol : str
+        Ticker or currency pair in yahoo finance format to fetch
+    start_date : str
+        Date from which the data will be fetched, the whole history is fetched if it is None
+    provider_options : dict
+        Keyword options passed to the provider
+    timeout : float
+        Number of seconds to wait for a response, passed to the provider as timeout keyword option if it takes it (default is None)
+    retries : int
+        Number of additional attempts after a failed request (default is 0)
+    retry_delay_s : float
+        Number of seconds to wait before the first retry, each next retry waits twice as long (default is 1)
 
     Returns
     -------
-    None
+    DataFrame
+        DataFrame with fetched data of the symbol
+    """
+    # timeout is passed only to providers which send requests and take it
+    if timeout is not None and "timeout" in inspect.signature(fetch).parameters:
+        provider_options = {**provider_options, "timeout": timeout}
+
+    for attempt in range(retries + 1):
+        try:
+            symbol_data = fetch([symbol], start_date, **provider_options).get(symbol)
+
+            # some providers report failed requests only by returning no data
+            if symbol_data is None or symbol_data.empty:
+                raise ValueError(f"No market data returned for {symbol}")
+
+            return symbol_data
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(retry_delay_s * 2**attempt)
+
+
+def fetch_symbols(
+    fetch,
+    symbols_start_dates,
+    provider_options,
+    fetch_workers=1,
+    timeout=None,
+    retries=0,
+    retry_delay_s=1,
+):
     """
-    # for storing current value for each weights group
-    weight_groups_current_values = {}
+    Fetches market data of many symbols one after another or in parallel with a pool of threads, so that a slow or failing symbol does not stall the others
 
-    # calculate current values for each weights group
-    for security_name, security_value in zip(securities, securities_value):
-        security_current_value = portfolio_data[security_value].iloc[-1]
-        weight_group = [
-            key for key, value in weight_groups.items() if security_name in value
-        ][0]
-        weight_groups_current_values.update(
-            {
-                weight_group: security_current_value
-                + weight_groups_current_values.get(weight_group, 0)
+    Parameters
+    ----------
+    fetch : function
+        Market data provider function from MARKET_DATA_PROVIDERS
+    symbols_start_dates : dict
+        Dictionary with symbols as keys and dates from which they will be fetched as values, the whole history is fetched for None dates
+    provider_options : dict
+        Keyword options passed to the provider
+    fetch_workers : int
+        Maximum number of symbols fetched at once, symbols are fetched one after another if it is 1 (default is 1)
+    timeout : float
+        Number of seconds to wait for a response for each request (default is None)
+    retries : int
+        Number of additional attempts after a failed request of each symbol (default is 0)
+    retry_delay_s : float
+        Number of seconds to wait before the first retry (default is 1)
+
+    Returns
+    -------
+    dict
+        Dictionary with fetched symbols as keys and DataFrames with fetched data as values
+    dict
+        Dictionary with symbols which failed to fetch as keys and the corresponding errors as values
+    """
+    symbols_data = {}
+    failed_symbols = {}
+
+    if fetch_workers == 1:
+        for symbol, start_date in symbols_start_dates.items():
+            try:
+                symbols_data[symbol] = fetch_symbol(
+                    fetch,
+                    symbol,
+                    start_date,
+                    provider_options,
+                    timeout,
+                    retries,
+                    retry_delay_s,
+                )
+            except Exception as error:
+                failed_symbols[symbol] = error
+    else:
+        # fetching waits for network, so threads are enough to run requests in parallel
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=fetch_workers
+        ) as executor:
+            futures = {
+                executor.submit(
+                    fetch_symbol,
+                    fetch,
+                    symbol,
+                    start_date,
+                    provider_options,
+                    timeout,
+                    retries,
+                    retry_delay_s,
+                ): symbol
+                for symbol, start_date in symbols_start_dates.items()
             }
-        )
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    symbols_data[futures[future]] = future.result()
+                except Exception as error:
+                    failed_symbols[futures[future]] = error
+
+    return symbols_data, failed_symbols
+
+
+@instrumented
+def download_market_data(
+    symbols,
+    cache_folder_path=None,
+    cache_max_age_hours=12,
+    offline=False,
+    provider="yahoo",
+    provider_options=None,
+    fetch_workers=1,
+    fetch_timeout_s=None,
+    fetch_retries=0,
+    fetch_retry_delay_s=1,
+):
+    """
+    Downloads all open, high, low, close data for symbols using local cache and fetching only the data newer than the last cached date
 
-    # take current portfolio value
-    portfolio_current_value = portfolio_data[PORTFOLIO + VALUE_SUFFIX].iloc[-1]
+    Parameters
+    ----------
+    symbols : list
+        List of tickers or currency pairs in yahoo finance format to download
+    cache_folder_path : str
+        Path to folder where market data is cached, the whole history is always fetched if not specified (default is None)
+    cache_max_age_hours : float
+        Number of hours since the last refresh after which cached data is considered stale and refreshed (default is 12)
+    offline : bool
+        Whether to use only cached data without fetching anything (default is False)
+    provider : str
+        Name of the market data provider from MARKET_DATA_PROVIDERS to fetch data with (default is "yahoo")
+    provider_options : dict
+        Keyword options passed to the provider (default is None)
+    fetch_workers : int
+        Maximum number of symbols fetched at once, symbols are fetched one after another if it is 1 or the provider is in SERIAL_MARKET_DATA_PROVIDERS (default is 1)
+    fetch_timeout_s : float
+        Number of seconds to wait for a response for each request, the provider default is used if not specified (default is None)
+    fetch_retries : int
+        Number of additional attempts after a failed request of each symbol (default is 0)
+    fetch_retry_delay_s : float
+        Number of seconds to wait before the first retry, each next retry waits twice as long (default is 1)
 
-    # for storing current weight deviation for each weights group
-    weight_groups_current_deviation = {}
+    Returns
+    -------
+    dict
+        Dictionary with symbols as keys and DataFrames with market data as values, symbols which failed to fetch and are not cached are missing
+    """
+    if provider not in MARKET_DATA_PROVIDERS:
+        raise ValueError(
+            f"Unknown market data provider {provider}, available providers: {', '.join(MARKET_DATA_PROVIDERS)}"
+        )
 
-    # calculate current weights for each weights group and deviation from ideal weights by subtracting current weight from ideal weight
-    portfolio_current_weights = pd.DataFrame()
-    for weight_group_name, weight_group_values in weight_groups_current_values.items():
-        current_share = 100 * weight_group_values / portfolio_current_value
-        deviation = current_share - weights.get(weight_group_name)
-        weight_groups_current_deviation.update({weight_group_name: deviation})
-        deviation_str = f"{deviation:.2f}" if deviation < 0 else f" {deviation:.2f}"
-
-        # create DataFrame with current weight for a given weight group
-        weight_group_dataframe = pd.DataFrame(
-            [
-                current_share,
-                deviation_str,
-                portfolio_current_value * weights.get(weight_group_name) / 100,
-                weight_group_values,
-            ],
-            columns=[weight_group_name],
-            index=["SHARE [%]", "DEVIATION [% pts]", "IDEAL VALUE", "CURRENT VALUE"],
+    # prepare provider function with its options
+    fetch = MARKET_DATA_PROVIDERS[provider]
+    provider_options = provider_options or {}
+
+    # providers which are not thread safe fetch symbols one after another
+    if provider in SERIAL_MARKET_DATA_PROVIDERS:
+        fetch_workers = 1
+
+    # replayed data is read from local files, so it is never cached to keep replayed runs deterministic and it needs no network
+    if provider == "replay":
+        cache_folder_path = None
+        offline = False
+    elif cache_folder_path is not None:
+        cache_folder_path = market_data_cache_folder_path(cache_folder_path, provider)
+
+    # without cache fetch the whole history of all symbols
+    if cache_folder_path is None:
+        if offline:
+            raise ValueError("Offline mode requires cache_folder_path to be specified")
+        symbols_data, failed_symbols = fetch_symbols(
+            fetch,
+            dict.fromkeys(symbols),
+            provider_options,
+            fetch_workers,
+            fetch_timeout_s,
+            fetch_retries,
+            fetch_retry_delay_s,
         )
+        report_failed_symbols(failed_symbols)
+        return symbols_data
+
+    # create cache folder if it does not exist
+    if not os.path.exists(cache_folder_path):
+        os.makedirs(cache_folder_path)
+
+    # load cached data and take the date to fetch each symbol from
+    symbols_data = {}
+    symbols_to_fetch = {}
+    for symbol in symbols:
+        cache_file_path = market_data_cache_file_path(cache_folder_path, symbol)
+
+        if not os.path.exists(cache_file_path):
+            if offline:
+                raise FileNotFoundError(
+                    f"No cached market data for {symbol} in {cache_folder_path} to use in offline mode"
+                )
+
+            # the whole history is fetched for symbols which are not cached yet
+            symbols_to_fetch[symbol] = None
+            continue
+
+        symbols_data[symbol] = pd.read_parquet(cache_file_path)
 
-        # concatenate DataFrame with current weight for a given weight group with DataFrame with current weights for all weight groups
-        portfolio_current_weights = pd.concat(
-            [portfolio_current_weights, pd.DataFrame(weight_group_dataframe)], axis=1
+        # cache is stale if it was not refreshed for more than cache_max_age_hours
+        cache_age = datetime.datetime.now() - datetime.datetime.fromtimestamp(
+            os.path.getmtime(cache_file_path)
         )
+        if offline or cache_age < datetime.timedelta(hours=cache_max_age_hours):
+            continue
 
-    portfolio_current_weights.index.name = (
-        f"PORTFOLIO CURRENT WEIGHTS [{analysis_currency}]"
+        # fetch stale symbols from the last cached date as the last cached bar could be incomplete
+        symbols_to_fetch[symbol] = symbols_data[symbol].index[-1].strftime("%Y-%m-%d")
+
+    # fetch missing data, stale cached data of symbols which failed to fetch is used as it is
+    fetched_symbols_data, failed_symbols = fetch_symbols(
+        fetch,
+        symbols_to_fetch,
+        provider_options,
+        fetch_workers,
+        fetch_timeout_s,
+        fetch_retries,
+        fetch_retry_delay_s,
     )
-    print(portfolio_current_weights.to_markdown(tablefmt="psql", floatfmt=".2f"))
+    report_failed_symbols(failed_symbols, symbols_data)
+
+    # merge fetched data with cached data overwriting the overlapping dates
+    for symbol, fetched_symbol_data in fetched_symbols_data.items():
+        if symbol in symbols_data:
+            symbol_data = pd.concat([symbols_data[symbol], fetched_symbol_data])
+            symbol_data = symbol_data[
+                ~symbol_data.index.duplicated(keep="last")
+            ].sort_index()
+        else:
+            symbol_data = fetched_symbol_data
+
+        # saving the data also marks the cache as refreshed
+        symbol_data.to_parquet(market_data_cache_file_path(cache_folder_path, symbol))
+        symbols_data[symbol] = symbol_data
+
+    return symbols_data
+
+
+def report_failed_symbols(failed_symbols, cached_symbols_data=None):
+    """
+    Warns about symbols which failed to fetch without aborting the analysis of the other symbols
+
+    Parameters
+    ----------
+    failed_symbols : dict
+        Dictionary with symbols which failed to fetch as keys and the corresponding errors as values
+    cached_symbols_data : dict
+        Dictionary with cached symbols as keys and DataFrames with cached data as values (default is None)
+
+    Returns
+    -------
+    None
+    """
+    for symbol, error in failed_symbols.items():
+        if cached_symbols_data and symbol in cached_symbols_data:
+            warnings.warn(
+                f"Market data for {symbol} could not be refreshed, cached data until {cached_symbols_data[symbol].index[-1]:%Y-%m-%d} is used: {error!r}"
+            )
+        else:
+            warnings.warn(f"Market data for {symbol} could not be fetched: {error!r}")
+
+
+def currency_pairs(distinct_currencies, fx_base_currency):
+    """
+    Prepares currency pairs to download exchange rates for to convert distinct currencies to the base currency
+
+    Parameters
+    ----------
+    distinct_currencies : list
+        Currencies to convert
+    fx_base_currency : str
+        Currency in which exchange rates are downloaded, e.g. analysis currency or a currency quoted against all others like USD
+
+    Returns
+    -------
+    list
+        List of currency pairs without the pair of base currency with itself
+    list
+        List of the same currency pairs in yahoo finance format
+    """
+    # create list of currency pairs to download exchange rates for, base currency is not converted
+    distinct_currency_pairs = [
+        currency + fx_base_currency
+        for currency in distinct_currencies
+        if currency != fx_base_currency
+    ]
+
+    # currency pairs in yahoo finance format
+    distinct_currency_pairs_format = [
+        currency + "=X" for currency in distinct_currency_pairs
+    ]
+
+    return distinct_currency_pairs, distinct_currency_pairs_format
+
+
+def exchange_rates_matrix(market_data, currencies, ohlc, fx_base_currency, index):
+    """
+    Prepares matrix of exchange rates of all currencies to the base currency aligned on dates
+
+    Parameters
+    ----------
+    market_data : dict
+        Dictionary with symbols as keys and DataFrames with all open, high, low, close data as values
+    currencies : list
+        Currencies to take exchange rates for
+    ohlc : str
+        Open, High, Low, Close data to take
+    fx_base_currency : str
+        Currency in which exchange rates are downloaded
+    index : Index
+        Dates which are added to dates of exchange rates, e.g. dates of securities data
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with currencies as columns and value of a unit of each currency in base currency for each date, missing rates are NaN
+    """
+    rates_matrix = pd.concat(
+        [
+            pd.DataFrame(index=index),
+            *[
+                market_data[currency + fx_base_currency + "=X"][ohlc].rename(currency)
+                for currency in currencies
+                if currency != fx_base_currency
+            ],
+        ],
+        axis=1,
+    )
+    rates_matrix[fx_base_currency] = 1.0
+
+    return rates_matrix[currencies]
+
+
+def cross_rates(rates_matrix, analysis_currency):
+    """
+    Derives exchange rates of all currencies to analysis currency from exchange rates to the base currency by triangulation
+
+    Parameters
+    ----------
+    rates_matrix : DataFrame
+        DataFrame with currencies as columns and value of a unit of each currency in base currency returned by exchange_rates_matrix
+    analysis_currency : str
+        Currency in which the analysis will be done
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with exchange rates of currency pairs to analysis currency as columns (e.g. USDEUR), the pair of analysis currency with itself is the last one and equal to 1.0
+    """
+    currencies = [
+        currency for currency in rates_matrix.columns if currency != analysis_currency
+    ]
+
+    # one division of the whole matrix by rates of analysis currency converts all currencies at once
+    exchange_rates = rates_matrix[currencies].div(
+        rates_matrix[analysis_currency], axis=0
+    )
+    exchange_rates[analysis_currency] = 1.0
+    exchange_rates.columns = [
+        currency + analysis_currency for currency in exchange_rates.columns
+    ]
+
+    return exchange_rates
+
+
+def convert_securities_data(
+    securities_data, exchange_rates, securities_currencies, analysis_currency
+):
+    """
+    Converts prices of securities to analysis currency with one multiplication by exchange rates of their currencies
+
+    Parameters
+    ----------
+    securities_data : DataFrame
+        DataFrame with prices of securities in their currencies
+    exchange_rates : DataFrame
+        DataFrame with exchange rates of currency pairs to analysis currency
+    securities_currencies : list
+        List of currencies of securities in the order of securities_data columns
+    analysis_currency : str
+        Currency in which the analysis will be done
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with prices of securities in analysis currency, NaN for dates without exchange rates
+    """
+    securities_exchange_rates = exchange_rates.reindex(securities_data.index)[
+        [currency + analysis_currency for currency in securities_currencies]
+    ]
+
+    return securities_data * securities_exchange_rates.to_numpy()
+
+
+@instrumented
+def select_market_data(
+    market_data,
+    tickers,
+    distinct_currencies,
+    ohlc,
+    analysis_currency,
+    securities,
+    fx_base_currency=None,
+):
+    """
+    Selects securities data and exchange rates for tickers and currencies from downloaded market data
+
+    Parameters
+    ----------
+    market_data : dict
+        Dictionary with symbols as keys and DataFrames with all open, high, low, close data as values
+    tickers : list
+        List of tickers to select
+    distinct_currencies : list
+        Currencies to select exchange rates for
+    ohlc : str
+        Open, High, Low, Close data to select
+    analysis_currency : str
+        Currency in which the analysis will be done
+    securities : list
+        List of securities names
+    fx_base_currency : str
+        Currency in which exchange rates were downloaded, exchange rates to analysis currency are derived from them by triangulation (default is None which means analysis currency)
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with data for tickers
+    DataFrame
+        DataFrame with exchange rates for currencies
+    """
+    # convert ohlc to upper case first letter and lower case the rest
+    ohlc = ohlc[0].upper() + ohlc[1:].lower()
+
+    # take ohlc column of securities data in a specified order and set columns names to securities names
+    df_securities = pd.DataFrame(
+        {
+            security_name: market_data[ticker][ohlc]
+            for ticker, security_name in zip(tickers, securities)
+        }
+    )
+
+    # set index name to DATE
+    df_securities.index.name = DATE
+
+    # take ohlc column of exchange rates to the base currency of all currencies aligned on the same dates
+    # and derive exchange rates to analysis currency from them, so that changing analysis currency does not need new downloads
+    rates_matrix = exchange_rates_matrix(
+        market_data,
+        list(dict.fromkeys([*distinct_currencies, analysis_currency])),
+        ohlc,
+        fx_base_currency or analysis_currency,
+        df_securities.index,
+    )
+    exchange_rates = cross_rates(rates_matrix, analysis_currency)
+
+    return df_securities, exchange_rates
+
+
+@instrumented
+def download_yahoo(
+    tickers,
+    distinct_currencies,
+    ohlc,
+    analysis_currency,
+    securities,
+    cache_folder_path=None,
+    cache_max_age_hours=12,
+    offline=False,
+    provider="yahoo",
+    provider_options=None,
+    fx_base_currency=None,
+):
+    """
+    Downloads data from yahoo finance or other market data provider for tickers and currencies
+
+    Parameters
+    ----------
+    tickers : list
+        List of tickers to download
+    distinct_currencies : str
+        Currencies to download
+    ohlc : str
+        Open, High, Low, Close data to download
+    analysis_currency : str
+        Currency in which the analysis will be done
+    securities : list
+        List of securities names
+    cache_folder_path : str
+        Path to folder where downloaded data is cached, the data is not cached if not specified (default is None)
+    cache_max_age_hours : float
+        Number of hours after which cached data is refreshed (default is 12)
+    offline : bool
+        Whether to use only cached data without downloading anything (default is False)
+    provider : str
+        Name of the market data provider from MARKET_DATA_PROVIDERS (default is "yahoo")
+    provider_options : dict
+        Keyword options passed to the provider (default is None)
+    fx_base_currency : str
+        Currency in which exchange rates are downloaded, exchange rates to analysis currency are derived from them by triangulation (default is None which means analysis currency)
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with downloaded data for tickers
+    DataFrame
+        DataFrame with downloaded exchange rates for currencies
+    """
+    _, distinct_currency_pairs_format = currency_pairs(
+        list(dict.fromkeys([*distinct_currencies, analysis_currency])),
+        fx_base_currency or analysis_currency,
+    )
+
+    # download securities data and exchange rates with all open, high, low, close columns
+    market_data = download_market_data(
+        tickers + distinct_currency_pairs_format,
+        cache_folder_path,
+        cache_max_age_hours,
+        offline,
+        provider,
+        provider_options,
+    )
+
+    return select_market_data(
+        market_data,
+        tickers,
+        distinct_currencies,
+        ohlc,
+        analysis_currency,
+        securities,
+        fx_base_currency,
+    )
+
+
+def convert_payments(payments, exchange_rates, currency_pair):
+    """
+    Converts payments to analysis currency by joining each payment with the exchange rate of its date in one operation
+
+    Parameters
+    ----------
+    payments : Series
+        Series with payments indexed by dates, the dates may be duplicated
+    exchange_rates : DataFrame
+        DataFrame with exchange rates
+    currency_pair : str
+        Currency pair column name from exchange_rates DataFrame to convert payments with
+
+    Returns
+    -------
+    ndarray
+        Array with payments converted to analysis currency in the same order as payments
+    """
+    # fill missing exchange rates with previous values as the exchange market could be closed that day
+    currency_pair_rates = exchange_rates[currency_pair].sort_index().ffill().dropna()
+
+    # take the last available exchange rate for each payment date which also covers dates with no quote (e.g. weekends)
+    # payments dated before the first available exchange rate are left as NaN
+    payments_rates = currency_pair_rates.reindex(payments.index, method="ffill")
+
+    return payments.to_numpy() * payments_rates.to_numpy()
+
+
+@instrumented
+def load_portfolio_transactions_data(
+    portfolio_data_file_name,
+    data_folder_path,
+    exchange_rates,
+    transaction_payment_list,
+    fee_payment_list,
+    analysis_currency,
+    securities=None,
+    chunk_size=None,
+):
+    """
+    Loads data from .csv file with portfolio transactions data
+
+    Parameters
+    ----------
+    portfolio_data_file_name : str
+        Name of the .csv file with portfolio data
+    data_folder_path : str
+        Path to folder where portfolio data files are stored
+    exchange_rates : DataFrame
+        DataFrame with exchange rates
+    transaction_payment_list : list
+        List with transaction payment column as a first element and its currency as a second element
+    fee_payment_list : list
+        List with fee payment column as a first element and its currency as a second element
+    analysis_currency : str
+        Currency which will be used for analysis
+    securities : list
+        List of securities names to load counts columns for, all columns are loaded if not specified (default is None)
+    chunk_size : int
+        Number of rows to read and convert at once, the whole file is read at once if not specified (default is None)
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with portfolio transactions data converted to analysis currency
+    """
+    portfolio_data_file_path = os.path.join(data_folder_path, portfolio_data_file_name)
+
+    transaction_column_name = transaction_payment_list[0]
+    fee_column_name = fee_payment_list[0]
+
+    transaction_currency_pair = transaction_payment_list[1] + analysis_currency
+    fee_currency_pair = fee_payment_list[1] + analysis_currency
+
+    # read only the header to find dates column and securities counts columns
+    header = pd.read_csv(portfolio_data_file_path, nrows=0).columns
+    date_column_name = header[0]
+    counts_columns_names = [
+        column
+        for column in header[1:]
+        if column not in (transaction_column_name, fee_column_name)
+        and (securities is None or column in securities)
+    ]
+
+    # read only needed columns with declared types, dates are parsed separately with a known format
+    portfolio_data_chunks = pd.read_csv(
+        portfolio_data_file_path,
+        usecols=[date_column_name, transaction_column_name, fee_column_name]
+        + counts_columns_names,
+        dtype={
+            date_column_name: str,
+            transaction_column_name: "float64",
+            fee_column_name: "float64",
+            **{column: "float64" for column in counts_columns_names},
+        },
+        chunksize=chunk_size,
+    )
+    if chunk_size is None:
+        portfolio_data_chunks = [portfolio_data_chunks]
+
+    # parse dates and convert transaction and fee payments to analysis currency chunk by chunk
+    converted_chunks = []
+    for portfolio_data_chunk in portfolio_data_chunks:
+        portfolio_data_chunk = portfolio_data_chunk.set_index(date_column_name)
+        portfolio_data_chunk.index = pd.to_datetime(
+            portfolio_data_chunk.index, format="%Y-%m-%d"
+        )
+        portfolio_data_chunk.index.name = DATE
+
+        # convert transaction and fee payments to analysis currency and assign them to new columns
+        portfolio_data_chunk[TRANSACTION_PAYMENT_COLUMN_NAME] = convert_payments(
+            portfolio_data_chunk[transaction_column_name],
+            exchange_rates,
+            transaction_currency_pair,
+        )
+        portfolio_data_chunk[FEE_PAYMENT_COLUMN_NAME] = convert_payments(
+            portfolio_data_chunk[fee_column_name], exchange_rates, fee_currency_pair
+        )
+        converted_chunks.append(portfolio_data_chunk)
+
+    # concatenate converted chunks only once
+    portfolio_data = (
+        pd.concat(converted_chunks)
+        if len(converted_chunks) > 1
+        else converted_chunks[0]
+    )
+
+    # report rows with payments which could not be converted due to missing exchange rates
+    not_converted = (
+        portfolio_data[TRANSACTION_PAYMENT_COLUMN_NAME].isna()
+        & portfolio_data[transaction_column_name].notna()
+    ) | (
+        portfolio_data[FEE_PAYMENT_COLUMN_NAME].isna()
+        & portfolio_data[fee_column_name].notna()
+    )
+    if not_converted.any():
+        not_converted_dates = portfolio_data.index[not_converted].strftime("%Y-%m-%d")
+        warnings.warn(
+            f"{not_converted.sum()} rows of {portfolio_data_file_name} could not be converted to {analysis_currency} "
+            f"due to missing exchange rates: {', '.join(not_converted_dates)}"
+        )
+
+    return portfolio_data
+
+
+@instrumented
+def prepare_portfolio_data(
+    securities_data,
+    exchange_rates,
+    transaction_payments,
+    fee_payments,
+    analysis_currency,
+    portfolio_data_files_names_and_payments_columns,
+    data_folder_path,
+    first_transaction_date,
+    chunk_size=None,
+    print_ingestion_report=False,
+):
+    """
+    Prepares portfolio data for analysis
+
+    Parameters
+    ----------
+    securities_data : DataFrame
+        DataFrame with securities data
+    exchange_rates : DataFrame
+        DataFrame with exchange rates
+    transaction_payments : dict
+        Dictionary with transaction payments columns and their currencies
+    fee_payments : dict
+        Dictionary with fee payments columns and their currencies
+    analysis_currency : str
+        Currency in which the analysis will be done
+    portfolio_data_files_names_and_payments_columns : dict
+        Dictionary with portfolio data files names and corresponding payments columns (buy/sold and fees)
+    data_folder_path : str
+        Path to folder where portfolio data files are stored
+    first_transaction_date : str
+        First transaction date
+    chunk_size : int
+        Number of rows of portfolio data files to read and convert at once, whole files are read at once if not specified (default is None)
+    print_ingestion_report : bool
+        Whether to print number of rows and parse time of each portfolio data file (default is False)
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with portfolio data prepared for analysis
+    """
+    # take only rows of DataFrame indexed from first_transaction_date
+    securities_data = securities_data[
+        securities_data.index
+        >= datetime.datetime.strptime(first_transaction_date, "%Y-%m-%d")
+    ].copy()
+
+    # fill NaN values with previous values as we assume that if there is no value for a day it means that the stock market was closed that day and the value is the same as the previous day
+    securities_data = securities_data.fillna(method="ffill")
+
+    # just in case if there are still NaN values as the first rows of the DataFrame we fill them with 0
+    securities_data = securities_data.fillna(0)
+
+    # load portfolio data from .csv files where dates, securities and values of transactions are stored
+    portfolio_data_parts = []
+    ingestion_report = {}
+    for (
+        portfolio_data_file_name,
+        payment_columns,
+    ) in portfolio_data_files_names_and_payments_columns.items():
+        # take column which specifies the transaction payment currency, find a currency and create a list with column name and currency
+        transaction_column = payment_columns.get(TRANSACTION_PAYMENT_COLUMN_NAME)
+        transaction_currency = transaction_payments.get(transaction_column)
+        transaction_payment_list = [transaction_column, transaction_currency]
+
+        # take column which specifies the fee payment currency, find a currency and create a list with column name and currency
+        fee_column = payment_columns.get(FEE_PAYMENT_COLUMN_NAME)
+        fee_currency = fee_payments.get(fee_column)
+        fee_payment_list = [fee_column, fee_currency]
+
+        # load part of portfolio data from .csv file with counts columns only for analyzed securities
+        parse_start_time = time.perf_counter()
+        portfolio_data_part = load_portfolio_transactions_data(
+            portfolio_data_file_name,
+            data_folder_path,
+            exchange_rates,
+            transaction_payment_list,
+            fee_payment_list,
+            analysis_currency,
+            list(securities_data.columns),
+            chunk_size,
+        )
+        ingestion_report[portfolio_data_file_name] = [
+            len(portfolio_data_part),
+            time.perf_counter() - parse_start_time,
+        ]
+        portfolio_data_parts.append(portfolio_data_part)
+
+    # concatenate parts of portfolio data from all files into one DataFrame at once
+    portfolio_data = pd.concat(portfolio_data_parts)
+
+    # print number of rows and parse time of each portfolio data file
+    if print_ingestion_report:
+        ingestion_report = pd.DataFrame.from_dict(
+            ingestion_report, orient="index", columns=["ROWS", "PARSE TIME [s]"]
+        )
+        ingestion_report.index.name = "PORTFOLIO DATA FILES"
+        print(
+            ingestion_report.to_markdown(tablefmt="psql", floatfmt=("", ".0f", ".3f"))
+        )
+
+    # merge raw securities data with portfolio data
+    portfolio_data = securities_data.join(portfolio_data, rsuffix=COUNT_SUFFIX)
+
+    # sort index in ascending order to ensure that the dates are in the desired order
+    portfolio_data = portfolio_data.sort_index()
+
+    return portfolio_data
+
+
+@instrumented
+def print_portfolio_status(
+    portfolio_data,
+    analysis_currency,
+    securities,
+    securities_count,
+    securities_value,
+    securities_expense,
+    securities_profit,
+):
+    """
+    Prints portfolio status with current values and profits for each security
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio data
+    analysis_currency : str
+        Currency to analyze
+    securities : list
+        List of securities names
+    securities_count : list
+        List of securities count names
+    securities_value : list
+        List of securities value names
+    securities_expense : list
+        List of securities expense names
+    securities_profit : list
+        List of securities profit names
+
+    Returns
+    -------
+    None
+    """
+    # take the last row of portfolio_data DataFrame which is the current portfolio status and calculate profit in percentage
+    portfolio_data_current = pd.DataFrame()
+    for (
+        security_name,
+        security_count,
+        security_value,
+        security_expense,
+        security_profit,
+    ) in zip(
+        securities,
+        securities_count,
+        securities_value,
+        securities_expense,
+        securities_profit,
+    ):
+        new_security_column = portfolio_data[
+            [security_count, security_expense, security_value, security_profit]
+        ].iloc[-1]
+
+        # calculate profit in percentage
+        new_security_column["PROFIT [%]"] = (
+            100
+            * (
+                new_security_column[security_value]
+                - new_security_column[security_expense]
+            )
+            / new_security_column[security_expense]
+        )
+
+        new_security_column = pd.DataFrame(
+            new_security_column.values, columns=[security_name]
+        )
+        new_security_column.index = [
+            "COUNT",
+            "EXPENSE",
+            "VALUE",
+            "PROFIT",
+            "PROFIT [%]",
+        ]
+        portfolio_data_current = pd.concat(
+            [portfolio_data_current, new_security_column], axis=1
+        )
+
+    portfolio_data_current.index.name = f"PORTFOLIO STATUS [{analysis_currency}]"
+    print(portfolio_data_current.to_markdown(tablefmt="psql", floatfmt=".2f"))
+
+
+@instrumented
+def print_portfolio_lots(portfolio_data, analysis_currency, securities, method):
+    """
+    Prints cost basis of held lots and realized and unrealized profits for each security
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio data joined with the lots ledger
+    analysis_currency : str
+        Currency to analyze
+    securities : list
+        List of securities names
+    method : str
+        Method from LOT_MATCHING_METHODS which was used to match sold units with bought lots
+
+    Returns
+    -------
+    None
+    """
+    # take the last row of portfolio_data DataFrame which is the current state of lots
+    portfolio_data_current = portfolio_data.iloc[-1]
+    counts = portfolio_data_current[
+        [col + COUNT_SUFFIX for col in securities]
+    ].to_numpy()
+    cost_basis = portfolio_data_current[
+        [col + COST_BASIS_SUFFIX for col in securities]
+    ].to_numpy()
+
+    # average cost of held units, there is no average cost without held units
+    with np.errstate(divide="ignore", invalid="ignore"):
+        average_cost = np.where(counts != 0, cost_basis / counts, np.nan)
+
+    portfolio_lots = pd.DataFrame(
+        [
+            counts,
+            cost_basis,
+            average_cost,
+            portfolio_data_current[
+                [col + UNREALIZED_PROFIT_SUFFIX for col in securities]
+            ].to_numpy(),
+            portfolio_data_current[
+                [col + REALIZED_PROFIT_SUFFIX for col in securities]
+            ].to_numpy(),
+        ],
+        index=[
+            "COUNT",
+            "COST BASIS",
+            "AVERAGE COST",
+            "UNREALIZED PROFIT",
+            "REALIZED PROFIT",
+        ],
+        columns=securities,
+    )
+
+    portfolio_lots.index.name = f"LOTS {method.upper()} [{analysis_currency}]"
+    print(portfolio_lots.to_markdown(tablefmt="psql", floatfmt=".2f"))
+
+
+def weight_groups_membership(securities, weight_groups):
+    """
+    Creates matrix of membership of securities in weight groups
+
+    Parameters
+    ----------
+    securities : list
+        List of securities names
+    weight_groups : dict
+        Dictionary with securities names for each security group
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with securities names as index, weight groups names as columns and 1 where a security belongs to a group or 0 otherwise
+    """
+    # pairs of indexes of securities and groups, securities which are not in portfolio are skipped
+    securities_indexes = pd.Index(securities)
+    groups_indexes = []
+    members_indexes = []
+    for group_index, group_securities in enumerate(weight_groups.values()):
+        group_members_indexes = securities_indexes.get_indexer(group_securities)
+        group_members_indexes = group_members_indexes[group_members_indexes >= 0]
+        members_indexes.append(group_members_indexes)
+        groups_indexes.append(np.full(len(group_members_indexes), group_index))
+
+    membership = np.zeros((len(securities), len(weight_groups)))
+    if weight_groups:
+        membership[np.concatenate(members_indexes), np.concatenate(groups_indexes)] = 1
+
+    return pd.DataFrame(membership, index=securities, columns=[*weight_groups.keys()])
+
+
+def water_filling(budgets, current_values, weights, segments):
+    """
+    Divides budget of each segment between its items to get values of the items as close as possible to their weights without taking anything away
+
+    Items of each segment are filled up to a common level of value per weight, the level is found with sorted breakpoints,
+    which are the levels at which items start to be filled, and cumulative sums restarted at each segment.
+
+    Parameters
+    ----------
+    budgets : ndarray
+        Array with budget of each segment
+    current_values : ndarray
+        Array with current value of each item
+    weights : ndarray
+        Array with positive weight of each item within its segment
+    segments : ndarray
+        Array with index of the segment of each item
+
+    Returns
+    -------
+    ndarray
+        Array with amount given to each item
+    """
+    breakpoints = current_values / weights
+    order = np.lexsort((breakpoints, segments))
+    sorted_segments = segments[order]
+    sorted_weights = weights[order]
+    sorted_values = current_values[order]
+
+    # cumulative weights and values of items of each segment up to each breakpoint
+    segments_starts = np.flatnonzero(
+        np.r_[True, sorted_segments[1:] != sorted_segments[:-1]]
+    )
+    segments_lengths = np.diff(np.r_[segments_starts, len(order)])
+    cumulative_weights = np.cumsum(sorted_weights)
+    cumulative_values = np.cumsum(sorted_values)
+    cumulative_weights -= np.repeat(
+        cumulative_weights[segments_starts] - sorted_weights[segments_starts],
+        segments_lengths,
+    )
+    cumulative_values -= np.repeat(
+        cumulative_values[segments_starts] - sorted_values[segments_starts],
+        segments_lengths,
+    )
+
+    # budgets needed to fill items up to each breakpoint grow within a segment, so items below the level are the ones with the budget not exceeded
+    sorted_budgets = budgets[sorted_segments]
+    filled_budgets = breakpoints[order] * cumulative_weights - cumulative_values
+    filled_numbers = np.add.reduceat(
+        (filled_budgets <= sorted_budgets).astype(int), segments_starts
+    )
+    last_filled = segments_starts + np.maximum(filled_numbers, 1) - 1
+    levels = (
+        sorted_budgets[last_filled] + cumulative_values[last_filled]
+    ) / cumulative_weights[last_filled]
+
+    amounts = np.empty_like(sorted_values)
+    amounts[order] = np.maximum(
+        sorted_weights * np.repeat(levels, segments_lengths) - sorted_values, 0
+    )
+
+    return amounts
+
+
+def allocate_contribution(
+    contribution,
+    unit_values,
+    current_values,
+    membership,
+    weights,
+    fee_rate=0,
+    fixed_fee=0,
+):
+    """
+    Allocates cash contribution to whole units of securities to get as close as possible to the desired weights without selling anything
+
+    Ideal values to buy are found by water filling, first of weight groups to their weights and then of securities of each group
+    to equal shares of the group, so that the groups furthest below their weights get the contribution first. Whole units are then
+    bought and exchanged while it reduces the deviation from the ideal values, see allocate_whole_units.
+
+    Parameters
+    ----------
+    contribution : float
+        Cash available for buying securities including fees
+    unit_values : ndarray
+        Array with current unit value of each security
+    current_values : ndarray
+        Array with current value of each security
+    membership : ndarray
+        Array of shape (securities, groups) with 1 where a security belongs to a group or 0 otherwise
+    weights : ndarray
+        Array with weight of each group
+    fee_rate : float
+        Fee as a fraction of the value of each purchase (default is 0)
+    fixed_fee : float
+        Fixed fee of a purchase of each security (default is 0)
+
+    Returns
+    -------
+    ndarray
+        Array with whole counts of securities to buy
+    ndarray
+        Array with fees paid for each security
+    """
+    unit_values = np.asarray(unit_values, dtype=float)
+    current_values = np.asarray(current_values, dtype=float)
+    membership = np.asarray(membership, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+
+    # only securities with a known unit value in groups with a weight can be bought, groups without them get nothing
+    members_securities, members_groups = np.nonzero(membership)
+    buyable_members = (unit_values[members_securities] > 0) & (
+        weights[members_groups] > 0
+    )
+    members_securities = members_securities[buyable_members]
+    members_groups = members_groups[buyable_members]
+    buyable_groups = np.unique(members_groups)
+    buyable = np.zeros(len(unit_values), dtype=bool)
+    buyable[members_securities] = True
+    if not buyable.any():
+        return np.zeros_like(unit_values), np.zeros_like(unit_values)
+    groups_current_values = current_values @ membership
+    unit_costs = unit_values * (1 + fee_rate)
+
+    def ideal_values(budget):
+        # value which can be bought with the budget is divided between groups and then between securities of each group
+        groups_values = np.zeros_like(weights)
+        groups_values[buyable_groups] = water_filling(
+            np.array([max(budget, 0) / (1 + fee_rate)]),
+            groups_current_values[buyable_groups],
+            weights[buyable_groups],
+            np.zeros(len(buyable_groups), dtype=int),
+        )
+        members_values = water_filling(
+            groups_values,
+            current_values[members_securities],
+            np.ones(len(members_securities)),
+            members_groups,
+        )
+        return np.bincount(
+            members_securities, members_values, minlength=len(unit_values)
+        )
+
+    # fixed fees are paid only for bought securities, so the budget is lowered by fixed fees of bought securities until all purchases fit into the contribution
+    # the budget can only decrease with more securities bought, so it takes at most as many allocations as there are securities
+    budget = contribution
+    while True:
+        counts = allocate_whole_units(
+            budget, unit_values, unit_costs, ideal_values(budget), buyable
+        )
+        fees = counts * unit_values * fee_rate + fixed_fee * (counts > 0)
+        spent = (counts * unit_values).sum() + fees.sum()
+        lowered_budget = contribution - fixed_fee * np.count_nonzero(counts)
+        if spent <= contribution or lowered_budget >= budget:
+            return counts, fees
+        budget = lowered_budget
+
+
+def allocate_whole_units(budget, unit_values, unit_costs, ideal_values, buyable):
+    """
+    Allocates budget to whole units of securities buying units and exchanging a unit of one security for units of another while it reduces the deviation from the ideal values
+
+    The deviation is the sum of absolute differences between values of bought units of securities and their ideal values to buy
+    plus the part of the budget not invested in securities, so that unspent cash counts as a deviation too. First affordable units which
+    reduce the deviation the most are bought until no affordable unit reduces it, then a unit of one security is exchanged for units
+    of another while some exchange reduces it. Exchanges are tried only between ALLOCATION_EXCHANGE_CANDIDATES securities with the units
+    which are the cheapest to give up and with the biggest shortfalls. It is a local search, so the result is not always the closest allocation.
+
+    Parameters
+    ----------
+    budget : float
+        Cash available for buying securities
+    unit_values : ndarray
+        Array with current unit value of each security
+    unit_costs : ndarray
+        Array with cost of a single unit of each security including fees proportional to its value
+    ideal_values : ndarray
+        Array with ideal value of each security to buy
+    buyable : ndarray
+        Boolean array with securities which can be bought
+
+    Returns
+    -------
+    ndarray
+        Array with whole counts of securities to buy
+    """
+    counts = np.zeros_like(unit_costs)
+    if budget <= 0 or not buyable.any():
+        return counts
+    buyable_indexes = np.flatnonzero(buyable)
+
+    def buy_units(counts):
+        # a unit reduces the deviation by twice the part of its value which fills the shortfall of its security, so each security
+        # has a block of units filling its shortfall whole, which reduce the deviation by the unit value, and one unit filling the rest
+        counts = counts.copy()
+        left_budget = budget - (counts * unit_costs).sum()
+        shortfalls = np.maximum(ideal_values - counts * unit_values, 0)[buyable_indexes]
+        whole_units = np.floor(shortfalls / unit_values[buyable_indexes])
+        rest_values = shortfalls - whole_units * unit_values[buyable_indexes]
+        candidates_indexes = np.concatenate([buyable_indexes, buyable_indexes])
+        candidates_units = np.concatenate([whole_units, (rest_values > 0) * 1.0])
+        candidates_reductions = np.concatenate(
+            [unit_values[buyable_indexes], rest_values]
+        )
+
+        # units are bought in order of their reductions of the deviation as long as they are affordable, a unit which is not affordable
+        # will never be, so the units are bought by the longest affordable prefix of the order and the not affordable ones are dropped
+        order = np.argsort(-candidates_reductions, kind="stable")
+        order = order[candidates_units[order] > 0]
+        candidates_indexes = candidates_indexes[order]
+        candidates_units = candidates_units[order]
+        while True:
+            affordable = unit_costs[candidates_indexes] <= left_budget
+            candidates_indexes = candidates_indexes[affordable]
+            candidates_units = candidates_units[affordable]
+            if len(candidates_indexes) == 0:
+                return counts
+
+            candidates_costs = candidates_units * unit_costs[candidates_indexes]
+            bought_number = np.searchsorted(
+                np.cumsum(candidates_costs), left_budget, side="right"
+            )
+            np.add.at(
+                counts,
+                candidates_indexes[:bought_number],
+                candidates_units[:bought_number],
+            )
+            left_budget -= candidates_costs[:bought_number].sum()
+
+            # units of the first block which is not affordable whole are bought as long as they are affordable
+            if bought_number < len(candidates_indexes):
+                security_index = candidates_indexes[bought_number]
+                units_number = np.floor(left_budget / unit_costs[security_index])
+                counts[security_index] += units_number
+                left_budget -= units_number * unit_costs[security_index]
+            candidates_indexes = candidates_indexes[bought_number + 1 :]
+            candidates_units = candidates_units[bought_number + 1 :]
+
+    counts = buy_units(counts)
+
+    # exchange a unit of one security for units of another, the deviation as a function of the number of units of the other security
+    # is the lowest at the number of units which fills its shortfall rounded down or up, so only these numbers are tried
+    while True:
+        shortfalls = ideal_values - counts * unit_values
+        left_budget = budget - (counts * unit_costs).sum()
+
+        # a unit given up increases the deviation by twice the part of its value below the desired value
+        sold_indexes = np.flatnonzero(counts)
+        sold_increases = 2 * np.minimum(
+            unit_values[sold_indexes],
+            np.maximum(shortfalls[sold_indexes] + unit_values[sold_indexes], 0),
+        )
+        bought_indexes = buyable_indexes[shortfalls[buyable_indexes] > 0]
+        if len(sold_indexes) == 0 or len(bought_indexes) == 0:
+            return counts
+        sold_order = np.argsort(sold_increases, kind="stable")[
+            :ALLOCATION_EXCHANGE_CANDIDATES
+        ]
+        sold_indexes = sold_indexes[sold_order]
+        sold_increases = sold_increases[sold_order]
+        bought_indexes = bought_indexes[
+            np.argsort(-shortfalls[bought_indexes], kind="stable")[
+                :ALLOCATION_EXCHANGE_CANDIDATES
+            ]
+        ]
+
+        # deviation changes of all pairs of securities given up and bought with the numbers of units filling the shortfall
+        # rounded down and up, limited by the budget left after giving up a unit
+        affordable_units = np.floor(
+            (left_budget + unit_costs[sold_indexes])[:, np.newaxis]
+            / unit_costs[bought_indexes][np.newaxis, :]
+        )
+        filling_units = np.floor(
+            shortfalls[bought_indexes] / unit_values[bought_indexes]
+        )
+        units_numbers = np.minimum(
+            np.maximum(
+                np.stack([filling_units, filling_units + 1])[:, np.newaxis, :], 1
+            ),
+            affordable_units[np.newaxis, :, :],
+        )
+        bought_values = units_numbers * unit_values[bought_indexes]
+        deviation_changes = (
+            sold_increases[np.newaxis, :, np.newaxis]
+            + np.abs(shortfalls[bought_indexes] - bought_values)
+            - shortfalls[bought_indexes]
+            - bought_values
+        )
+        deviation_changes[
+            (units_numbers < 1)
+            | (sold_indexes[:, np.newaxis] == bought_indexes[np.newaxis, :])
+        ] = np.inf
+
+        option_index, sold_index, bought_index = np.unravel_index(
+            np.argmin(deviation_changes), deviation_changes.shape
+        )
+        if deviation_changes[option_index, sold_index, bought_index] >= -1e-9:
+            return counts
+        counts[sold_indexes[sold_index]] -= 1
+        counts[bought_indexes[bought_index]] += units_numbers[
+            option_index, sold_index, bought_index
+        ]
+        counts = buy_units(counts)
+
+
+@instrumented
+def print_portfolio_weights_and_goal(
+    portfolio_data,
+    analysis_currency,
+    weights,
+    weight_groups,
+    securities,
+    securities_count,
+    securities_value,
+    securities_unit_value,
+):
+    """
+    Prints portfolio current weights and goal proportions for each security group and portfolio as a whole
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio data
+    analysis_currency : str
+        Currency to analyze
+    weights : dict
+        Dictionary with weights for each security group
+    weight_groups : dict
+        Dictionary with securities names for each security group
+    securities : list
+        List of securities names
+    securities_count : list
+        List of securities count names
+    securities_value : list
+        List of securities value names
+    securities_unit_value : list
+        List of securities unit value names
+
+    Returns
+    -------
+    None
+    """
+    # membership of securities in weight groups, groups without securities in portfolio are skipped
+    membership = weight_groups_membership(securities, weight_groups)
+    membership = membership.loc[:, membership.any()]
+    weight_groups_names = [*membership.columns]
+    weight_groups_weights = np.array(
+        [weights.get(weight_group_name) for weight_group_name in weight_groups_names]
+    )
+
+    # take current values, counts and unit values of securities
+    securities_current_values = portfolio_data[securities_value].iloc[-1].to_numpy()
+    securities_current_counts = portfolio_data[securities_count].iloc[-1].to_numpy()
+    securities_current_unit_values = (
+        portfolio_data[securities_unit_value].iloc[-1].to_numpy()
+    )
+
+    # calculate current values for each weights group
+    weight_groups_current_values = securities_current_values @ membership.to_numpy()
+
+    # take current portfolio value
+    portfolio_current_value = portfolio_data[PORTFOLIO + VALUE_SUFFIX].iloc[-1]
+
+    # calculate current weights for each weights group and deviation from ideal weights by subtracting current weight from ideal weight
+    current_shares = 100 * weight_groups_current_values / portfolio_current_value
+    deviations = current_shares - weight_groups_weights
+    portfolio_current_weights = pd.DataFrame(
+        [
+            current_shares,
+            [
+                f"{deviation:.2f}" if deviation < 0 else f" {deviation:.2f}"
+                for deviation in deviations
+            ],
+            portfolio_current_value * weight_groups_weights / 100,
+            weight_groups_current_values,
+        ],
+        columns=weight_groups_names,
+        index=["SHARE [%]", "DEVIATION [% pts]", "IDEAL VALUE", "CURRENT VALUE"],
+    )
+    portfolio_current_weights.index.name = (
+        f"PORTFOLIO CURRENT WEIGHTS [{analysis_currency}]"
+    )
+    print(portfolio_current_weights.to_markdown(tablefmt="psql", floatfmt=".2f"))
 
     # find weight group with the biggest (positive) deviation from ideal weight
     # this weight group will be used to calculate new goal values
-    max_deviation_weight_group = max(
-        weight_groups_current_deviation,
-        key=lambda key: weight_groups_current_deviation.get(key) / weights.get(key),
+    max_deviation_weight_group_index = np.argmax(deviations / weight_groups_weights)
+
+    # calculate new goal p.p. value for the weight group with the biggest deviation from ideal weight
+    # new goal p.p. value is calculated by dividing current value for the weight group with the biggest (positive) deviation from ideal weight by ideal weight for that weight group
+    # it results with a new goal percentage point which will be used to calculate new goal values for each weight group
+    new_goal_percentage_point_value = (
+        weight_groups_current_values[max_deviation_weight_group_index]
+        / weight_groups_weights[max_deviation_weight_group_index]
+    )
+
+    # calculate new goal values for each weight group
+    new_goal_values = new_goal_percentage_point_value * weight_groups_weights
+
+    # whole counts of securities to buy for the value lacking to the new goal, weight of each group is split equally between its securities
+    new_goal_counts, _ = allocate_contribution(
+        new_goal_values.sum() - portfolio_current_value,
+        securities_current_unit_values,
+        securities_current_values,
+        membership.to_numpy(),
+        weight_groups_weights,
+    )
+
+    # strings with new goal count and current count for each security in a given weight group
+    securities_indexes = {
+        security_name: index for index, security_name in enumerate(securities)
+    }
+    goal_counts = []
+    current_counts = []
+    for weight_group_name in weight_groups_names:
+        group_securities_indexes = [
+            securities_indexes[security]
+            for security in weight_groups[weight_group_name]
+            if security in securities_indexes
+        ]
+        goal_counts.append(
+            "".join(
+                f"{securities[index]}: {new_goal_counts[index]:.0f}\n"
+                for index in group_securities_indexes
+            )
+        )
+        current_counts.append(
+            "".join(
+                f"{securities[index]}: {securities_current_counts[index]}\n"
+                for index in group_securities_indexes
+            )
+        )
+
+    # create DataFrame with new goal values, current values, new goal count and current count for each weight group
+    portfolio_new_goal = pd.DataFrame(
+        [
+            new_goal_values.round(2),
+            weight_groups_current_values.round(2),
+            goal_counts,
+            current_counts,
+        ],
+        columns=weight_groups_names,
+        index=["VALUE", "CURRENT VALUE", "COUNT TO BUY", "CURRENT COUNT"],
+    )
+
+    # new portfolio goal value is calculated by multiplying new goal p.p. value by 100
+    goal_sum = round(new_goal_percentage_point_value * 100, 2)
+
+    # concatenate new goals DataFrame for all weight groups with DataFrame with portfolio's new goal value and current value
+    portfolio_new_goal = pd.concat(
+        [
+            portfolio_new_goal,
+            pd.DataFrame(
+                [goal_sum, round(portfolio_current_value, 2), *2 * [""]],
+                columns=["SUM"],
+                index=["VALUE", "CURRENT VALUE", "COUNT TO BUY", "CURRENT COUNT"],
+            ),
+        ],
+        axis=1,
+    )
+    portfolio_new_goal.index.name = f"GOAL [{analysis_currency}]"
+    print(portfolio_new_goal.to_markdown(tablefmt="psql", floatfmt=".2f"))
+
+
+@instrumented
+def print_portfolio_contribution(
+    portfolio_data,
+    analysis_currency,
+    weights,
+    weight_groups,
+    securities,
+    securities_value,
+    securities_unit_value,
+    contribution,
+    fee_rate=0,
+    fixed_fee=0,
+):
+    """
+    Prints whole counts of securities to buy for the cash contribution to get as close as possible to the desired weights
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio data
+    analysis_currency : str
+        Currency to analyze
+    weights : dict
+        Dictionary with weights for each security group
+    weight_groups : dict
+        Dictionary with securities names for each security group
+    securities : list
+        List of securities names
+    securities_value : list
+        List of securities value names
+    securities_unit_value : list
+        List of securities unit value names
+    contribution : float
+        Cash available for buying securities including fees
+    fee_rate : float
+        Fee as a fraction of the value of each purchase (default is 0)
+    fixed_fee : float
+        Fixed fee of a purchase of each security (default is 0)
+
+    Returns
+    -------
+    None
+    """
+    membership = weight_groups_membership(securities, weight_groups)
+    unit_values = portfolio_data[securities_unit_value].iloc[-1].to_numpy()
+
+    counts, fees = allocate_contribution(
+        contribution,
+        unit_values,
+        portfolio_data[securities_value].iloc[-1].to_numpy(),
+        membership.to_numpy(),
+        [weights.get(weight_group_name, 0) for weight_group_name in membership.columns],
+        fee_rate,
+        fixed_fee,
+    )
+
+    # show only securities to buy with the sum of values and fees and cash which is left
+    portfolio_contribution = pd.DataFrame(
+        {
+            "COUNT TO BUY": counts,
+            "UNIT VALUE": unit_values,
+            "VALUE": counts * unit_values,
+            "FEE": fees,
+        },
+        index=securities,
+    )
+    portfolio_contribution = portfolio_contribution[counts > 0].astype(object)
+    value_sum = portfolio_contribution["VALUE"].sum()
+    fee_sum = portfolio_contribution["FEE"].sum()
+    portfolio_contribution.loc["SUM"] = ["", "", value_sum, fee_sum]
+    portfolio_contribution.loc["CASH LEFT"] = [
+        "",
+        "",
+        contribution - value_sum - fee_sum,
+        "",
+    ]
+    portfolio_contribution.index.name = (
+        f"CONTRIBUTION {contribution:.2f} [{analysis_currency}]"
+    )
+    print(
+        portfolio_contribution.to_markdown(
+            tablefmt="psql", floatfmt=("", ".0f", ".2f", ".2f", ".2f")
+        )
+    )
+
+
+@instrumented
+def print_portfolio_performance(portfolio_data, analysis_currency):
+    """
+    Prints portfolio performance with current value, expense, profit and profit in percentage
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio data
+    analysis_currency : str
+        Currency of the analysis
+
+    Returns
+    -------
+    None
+    """
+    # take current portfolio value and expense
+    portfolio_current_value = portfolio_data[PORTFOLIO + VALUE_SUFFIX].iloc[-1]
+    portfolio_current_expense = portfolio_data[PORTFOLIO + EXPENSE_SUFFIX].iloc[-1]
+
+    # create DataFrame with portfolio performance
+    portfolio_performance = pd.DataFrame(
+        [
+            portfolio_current_value,
+            portfolio_current_expense,
+            portfolio_current_value - portfolio_current_expense,
+            100
+            * (portfolio_current_value - portfolio_current_expense)
+            / portfolio_current_expense,
+        ],
+        columns=["VALUES"],
+        index=["VALUE", "EXPENSE", "PROFIT", "PROFIT [%]"],
+    )
+    portfolio_performance.index.name = f"PORTFOLIO PERFORMANCE [{analysis_currency}]"
+    print(portfolio_performance.to_markdown(tablefmt="psql", floatfmt=".2f"))
+
+
+def calculate_xirr(cash_flows, years, tolerance=1e-10, max_iterations=100):
+    """
+    Calculates money-weighted annual rates of return (XIRR) of many series of cash flows at once
+
+    All series are solved together with Newton's method on logarithms of growth rates, which falls back to bisection
+    for series whose Newton step leaves the bracket with a sign change of net present value, so every series converges.
+
+    Parameters
+    ----------
+    cash_flows : ndarray
+        Array of shape (events, series) with cash flows, payments into the portfolio are negative and values taken out of it are positive
+    years : ndarray
+        Array broadcastable to cash_flows shape with time of each cash flow in years since the beginning of the series
+    tolerance : float
+        Tolerance of logarithm of growth rate to stop iterating (default is 1e-10)
+    max_iterations : int
+        Maximum number of iterations (default is 100)
+
+    Returns
+    -------
+    ndarray
+        Array with annual rate of return of each series as a fraction, NaN if the rate does not exist
+    """
+    cash_flows = np.asarray(cash_flows, dtype=float)
+    years = np.broadcast_to(np.asarray(years, dtype=float), cash_flows.shape)
+
+    def net_present_values(log_growth_rates):
+        discounts = np.exp(-years * log_growth_rates)
+        return (cash_flows * discounts).sum(axis=0), -(
+            cash_flows * years * discounts
+        ).sum(axis=0)
+
+    with np.errstate(all="ignore"):
+        # rates between -99.9999% and 99900% a year are searched
+        lower = np.full(cash_flows.shape[1], np.log(1e-6))
+        upper = np.full(cash_flows.shape[1], np.log(1e3))
+        lower_values, _ = net_present_values(lower)
+        upper_values, _ = net_present_values(upper)
+        solvable = np.sign(lower_values) * np.sign(upper_values) < 0
+
+        log_growth_rates = np.zeros(cash_flows.shape[1])
+        for _ in range(max_iterations):
+            values, derivatives = net_present_values(log_growth_rates)
+
+            # narrow the bracket keeping the sign change between its ends
+            same_sign_as_lower = np.sign(values) == np.sign(lower_values)
+            lower = np.where(same_sign_as_lower, log_growth_rates, lower)
+            lower_values = np.where(same_sign_as_lower, values, lower_values)
+            upper = np.where(same_sign_as_lower, upper, log_growth_rates)
+
+            # take Newton step if it stays inside the bracket or bisect the bracket otherwise
+            newton_rates = log_growth_rates - values / derivatives
+            new_log_growth_rates = np.where(
+                (newton_rates > lower) & (newton_rates < upper),
+                newton_rates,
+                (lower + upper) / 2,
+            )
+            converged = np.abs(new_log_growth_rates - log_growth_rates) < tolerance
+            log_growth_rates = new_log_growth_rates
+            if (converged | ~solvable).all():
+                break
+
+    return np.where(solvable, np.expm1(log_growth_rates), np.nan)
+
+
+def returns_windows(dates, period=None, rolling_periods=None):
+    """
+    Creates windows of calendar periods or rolling windows of many calendar periods to calculate returns for
+
+    Parameters
+    ----------
+    dates : DatetimeIndex
+        Dates of portfolio data
+    period : str
+        Calendar period of windows, "year", "quarter" or "month", the whole period of dates is a single window if not specified (default is None)
+    rolling_periods : int
+        Number of calendar periods in each rolling window ending at the end of each period, windows are single calendar periods if not specified (default is None)
+
+    Returns
+    -------
+    list
+        List of tuples with label, position of the start date and position of the end date of each window
+    """
+    if period is None:
+        return [("WHOLE PERIOD", 0, len(dates) - 1)]
+
+    # positions of the last date of each calendar period
+    periods = dates.to_period(RETURNS_PERIODS[period])
+    period_ends = np.flatnonzero(np.append(periods[1:] != periods[:-1], True))
+
+    # each window starts at the end of the previous period, so the first period starts at the first date
+    window_starts = np.append(0, period_ends[:-1])
+    if rolling_periods is None:
+        return [
+            (str(periods[end]), start, end)
+            for start, end in zip(window_starts, period_ends)
+        ]
+
+    # rolling windows are created only if there are enough periods before them
+    return [
+        (
+            f"{periods[period_ends[index - rolling_periods + 1]]} - {periods[period_ends[index]]}",
+            window_starts[index - rolling_periods + 1],
+            period_ends[index],
+        )
+        for index in range(rolling_periods - 1, len(period_ends))
+    ]
+
+
+def daily_growth_factors(values, cash_flows):
+    """
+    Calculates daily growth factors of values excluding cash flows of each day
+
+    Parameters
+    ----------
+    values : ndarray
+        Array of shape (dates, columns) with values
+    cash_flows : ndarray
+        Array of shape (dates, columns) with payments into the values on each date
+
+    Returns
+    -------
+    ndarray
+        Array of shape (dates, columns) with growth factors, NaN for the first date and dates following zero values
+    """
+    growth_factors = np.full(values.shape, np.nan)
+    with np.errstate(all="ignore"):
+        growth_factors[1:] = np.where(
+            values[:-1] != 0, (values[1:] - cash_flows[1:]) / values[:-1], np.nan
+        )
+
+    return growth_factors
+
+
+def rolling_max_drawdown(values, window):
+    """
+    Calculates maximum drawdown in each rolling window of values in O(n) regardless of the window length
+
+    Values are split into blocks of the window length. Each window spans the suffix of one block and the prefix of the next one,
+    so its maximum drawdown is combined from running maximums, minimums and drawdowns of that suffix and prefix (van Herk/Gil-Werman algorithm).
+
+    Parameters
+    ----------
+    values : ndarray
+        Array of shape (dates, columns) with positive values
+    window : int
+        Number of values in each window
+
+    Returns
+    -------
+    ndarray
+        Array of shape (dates, columns) with maximum drawdown as a fraction in the window ending at each date, NaN for the first incomplete windows
+    """
+    dates_number, columns_number = values.shape
+    max_drawdowns = np.full(values.shape, np.nan)
+    if window > dates_number:
+        return max_drawdowns
+
+    # pad values with the last value to split them into whole blocks
+    blocks_number = -(-dates_number // window)
+    blocks = np.vstack(
+        [values, np.repeat(values[-1:], blocks_number * window - dates_number, axis=0)]
+    ).reshape(blocks_number, window, columns_number)
+
+    # running maximums, minimums and drawdowns from the start of each block
+    prefix_max = np.maximum.accumulate(blocks, axis=1)
+    prefix_min = np.minimum.accumulate(blocks, axis=1)
+    prefix_max_drawdown = np.minimum.accumulate(blocks / prefix_max - 1, axis=1)
+
+    # running maximums, minimums and drawdowns to the end of each block
+    suffix_max = np.maximum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1]
+    suffix_min = np.minimum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1]
+    suffix_max_drawdown = np.minimum.accumulate(
+        (suffix_min / blocks - 1)[:, ::-1], axis=1
+    )[:, ::-1]
+
+    prefix_max, prefix_min, prefix_max_drawdown, suffix_max, suffix_max_drawdown = (
+        array.reshape(-1, columns_number)
+        for array in (
+            prefix_max,
+            prefix_min,
+            prefix_max_drawdown,
+            suffix_max,
+            suffix_max_drawdown,
+        )
+    )
+
+    # drawdown of a window is the deepest of drawdowns within its suffix part, within its prefix part and from the peak of the suffix part to the trough of the prefix part
+    starts = np.arange(dates_number - window + 1)
+    ends = starts + window - 1
+    max_drawdowns[window - 1 :] = np.minimum(
+        np.minimum(suffix_max_drawdown[starts], prefix_max_drawdown[ends]),
+        prefix_min[ends] / suffix_max[starts] - 1,
+    )
+
+    # windows starting at the start of a block are the whole blocks
+    whole_blocks = starts % window == 0
+    max_drawdowns[ends[whole_blocks]] = suffix_max_drawdown[starts[whole_blocks]]
+
+    return max_drawdowns
+
+
+def calculate_rolling_risk_metrics(
+    portfolio_data,
+    names,
+    values_columns,
+    expenses_columns,
+    windows,
+    risk_free_rate=0,
+    periods_per_year=252,
+):
+    """
+    Calculates rolling volatility, Sharpe ratio, Sortino ratio, return and maximum drawdown of values columns
+
+    Metrics are calculated from daily returns excluding cash flows (changes of cumulative expenses), so contributions
+    do not look like gains. All windows use rolling sums or running extremes, so the cost does not depend on the window length.
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio data
+    names : list
+        List of names of values columns used as prefixes of the returned columns
+    values_columns : list
+        List of values columns
+    expenses_columns : list
+        List of cumulative expenses columns corresponding to values columns, None for columns without cash flows (e.g. unit values)
+    windows : list
+        List of numbers of daily returns in each rolling window
+    risk_free_rate : float
+        Annual risk free rate as a fraction used in Sharpe and Sortino ratios (default is 0)
+    periods_per_year : int
+        Number of dates in a year used to annualize metrics (default is 252)
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with columns named as name, metric suffix and window for each name, metric and window
+    """
+    values = portfolio_data[values_columns].to_numpy(dtype=float)
+    cash_flows = np.zeros_like(values)
+    for index, expenses_column in enumerate(expenses_columns):
+        if expenses_column is not None:
+            cash_flows[1:, index] = np.diff(portfolio_data[expenses_column].to_numpy())
+
+    # daily returns are undefined before the first purchase and growth index does not change then
+    growth_factors = daily_growth_factors(values, cash_flows)
+    daily_returns = pd.DataFrame(
+        growth_factors - 1, index=portfolio_data.index, columns=names
+    )
+    growth_index = np.cumprod(np.nan_to_num(growth_factors, nan=1), axis=0)
+
+    # daily returns above the risk free rate and their downside part
+    excess_returns = daily_returns - (
+        (1 + risk_free_rate) ** (1 / periods_per_year) - 1
+    )
+    downside_squares = excess_returns.clip(upper=0) ** 2
+
+    risk_metrics = {}
+    for window in windows:
+        volatility = daily_returns.rolling(window).std()
+        mean_excess_returns = excess_returns.rolling(window).mean()
+        downside_deviation = np.sqrt(downside_squares.rolling(window).mean())
+
+        # return and drawdown of the growth index are calculated over the window of daily returns and the date before them
+        rolling_returns = np.full(values.shape, np.nan)
+        rolling_returns[window:] = growth_index[window:] / growth_index[:-window] - 1
+        max_drawdowns = rolling_max_drawdown(growth_index, window + 1)
+
+        # windows with dates before the first purchase are left undefined
+        incomplete = daily_returns.isna().rolling(window).max().to_numpy() != 0
+        rolling_returns[incomplete] = np.nan
+        max_drawdowns[incomplete] = np.nan
+
+        for metric_suffix, metric in [
+            (VOLATILITY_SUFFIX, volatility * np.sqrt(periods_per_year)),
+            (
+                SHARPE_RATIO_SUFFIX,
+                mean_excess_returns / volatility * np.sqrt(periods_per_year),
+            ),
+            (
+                SORTINO_RATIO_SUFFIX,
+                mean_excess_returns / downside_deviation * np.sqrt(periods_per_year),
+            ),
+            (ROLLING_RETURN_SUFFIX, rolling_returns),
+            (ROLLING_MAX_DRAWDOWN_SUFFIX, max_drawdowns),
+        ]:
+            metric = np.asarray(metric)
+            for index, name in enumerate(names):
+                risk_metrics[f"{name}{metric_suffix}_{window}"] = metric[:, index]
+
+    return pd.DataFrame(risk_metrics, index=portfolio_data.index)
+
+
+@instrumented
+def print_portfolio_risk(portfolio_data, names, windows):
+    """
+    Prints the latest rolling risk metrics for each security and portfolio as a whole
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio data with rolling risk metrics columns
+    names : list
+        List of names of securities and portfolio
+    windows : list
+        List of numbers of daily returns in each rolling window
+
+    Returns
+    -------
+    None
+    """
+    last_date_data = portfolio_data.iloc[-1]
+
+    # percentages are shown for all metrics except ratios
+    portfolio_risk = pd.DataFrame(
+        {
+            f"{metric_name} {window}{unit}": [
+                scale * last_date_data[f"{name}{metric_suffix}_{window}"]
+                for name in names
+            ]
+            for window in windows
+            for metric_name, metric_suffix, scale, unit in [
+                ("VOLATILITY", VOLATILITY_SUFFIX, 100, " [%]"),
+                ("SHARPE RATIO", SHARPE_RATIO_SUFFIX, 1, ""),
+                ("SORTINO RATIO", SORTINO_RATIO_SUFFIX, 1, ""),
+                ("RETURN", ROLLING_RETURN_SUFFIX, 100, " [%]"),
+                ("MAX DRAWDOWN", ROLLING_MAX_DRAWDOWN_SUFFIX, 100, " [%]"),
+            ]
+        },
+        index=names,
+    ).T
+    portfolio_risk.index.name = "ROLLING RISK"
+    print(portfolio_risk.to_markdown(tablefmt="psql", floatfmt=".2f"))
+
+
+def calculate_returns(portfolio_data, names, values_columns, expenses_columns, windows):
+    """
+    Calculates money-weighted (XIRR) and time-weighted (TWR) returns of many values columns for many windows at once
+
+    Cash flows are the changes of cumulative expenses. Each window starts at the end of its start date with the value
+    of that date invested and ends with the value of its end date taken out. TWR of all windows is calculated from a single
+    cumulative product of daily growth factors and XIRR of all windows and columns is solved together.
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio data
+    names : list
+        List of names of values columns used as columns of the returned DataFrames
+    values_columns : list
+        List of values columns
+    expenses_columns : list
+        List of cumulative expenses columns corresponding to values columns
+    windows : list
+        List of tuples with label, position of the start date and position of the end date of each window as returned by returns_windows
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with XIRR of each window and column as fractions
+    DataFrame
+        DataFrame with TWR of each window and column as fractions
+    """
+    values = portfolio_data[values_columns].to_numpy(dtype=float)
+    expenses = portfolio_data[expenses_columns].to_numpy(dtype=float)
+    cash_flows = np.diff(expenses, axis=0, prepend=expenses[:1])
+
+    labels = [label for label, _, _ in windows]
+    starts = np.array([start for _, start, _ in windows], dtype=int)
+    ends = np.array([end for _, _, end in windows], dtype=int)
+
+    # there is no growth before the first purchase
+    growth_factors = daily_growth_factors(values, cash_flows)
+    cumulative_growth = np.cumprod(np.nan_to_num(growth_factors, nan=1), axis=0)
+    time_weighted_returns = cumulative_growth[ends] / cumulative_growth[starts] - 1
+
+    # only dates with cash flows and starts and ends of windows are needed to calculate XIRR
+    events = np.union1d(
+        np.flatnonzero((cash_flows != 0).any(axis=1)), np.append(starts, ends)
+    )
+    inside = (events[:, np.newaxis] > starts) & (events[:, np.newaxis] <= ends)
+
+    # cash flows of shape (events, windows, columns) with payments as negative values
+    windows_cash_flows = (
+        -cash_flows[events][:, np.newaxis, :] * inside[:, :, np.newaxis]
+    )
+    windows_cash_flows -= (events[:, np.newaxis] == starts)[:, :, np.newaxis] * values[
+        events
+    ][:, np.newaxis, :]
+    windows_cash_flows += (events[:, np.newaxis] == ends)[:, :, np.newaxis] * values[
+        events
+    ][:, np.newaxis, :]
+
+    # time of each cash flow in years since the start of each window
+    dates = portfolio_data.index
+    windows_years = np.clip(
+        (dates[events].to_numpy()[:, np.newaxis] - dates[starts].to_numpy())
+        / np.timedelta64(1, "D")
+        / 365.25,
+        0,
+        None,
+    )
+    windows_years = np.repeat(windows_years[:, :, np.newaxis], values.shape[1], axis=2)
+
+    xirr = calculate_xirr(
+        windows_cash_flows.reshape(len(events), -1),
+        windows_years.reshape(len(events), -1),
+    ).reshape(len(windows), values.shape[1])
+
+    return (
+        pd.DataFrame(xirr, index=labels, columns=names),
+        pd.DataFrame(time_weighted_returns, index=labels, columns=names),
+    )
+
+
+@instrumented
+def print_portfolio_returns(
+    portfolio_data,
+    securities,
+    securities_value,
+    securities_expense,
+    returns_period=None,
+    returns_rolling_periods=None,
+):
+    """
+    Prints money-weighted (XIRR) and time-weighted (TWR) returns for each security and portfolio as a whole
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio data
+    securities : list
+        List of securities names
+    securities_value : list
+        List of securities value names
+    securities_expense : list
+        List of securities expense names
+    returns_period : str
+        Calendar period of returns, "year", "quarter" or "month", only returns of the whole period are printed if not specified (default is None)
+    returns_rolling_periods : int
+        Number of calendar periods in each rolling window, returns of single calendar periods are printed if not specified (default is None)
+
+    Returns
+    -------
+    None
+    """
+    names = securities + [PORTFOLIO]
+    values_columns = securities_value + [PORTFOLIO + VALUE_SUFFIX]
+    expenses_columns = securities_expense + [PORTFOLIO + EXPENSE_SUFFIX]
+
+    # returns of the whole period with annualized TWR
+    xirr, time_weighted_returns = calculate_returns(
+        portfolio_data,
+        names,
+        values_columns,
+        expenses_columns,
+        returns_windows(portfolio_data.index),
+    )
+    # TWR cannot be annualized for data of a single date
+    years = (portfolio_data.index[-1] - portfolio_data.index[0]).days / 365.25
+    if years > 0:
+        annualized_time_weighted_returns = (1 + time_weighted_returns) ** (
+            1 / years
+        ) - 1
+    else:
+        annualized_time_weighted_returns = time_weighted_returns * np.nan
+    portfolio_returns = pd.concat(
+        [
+            100 * xirr,
+            100 * time_weighted_returns,
+            100 * annualized_time_weighted_returns,
+        ]
+    )
+    portfolio_returns.index = ["XIRR", "TWR", "TWR ANNUALIZED"]
+    portfolio_returns.index.name = "RETURNS [%]"
+    print(portfolio_returns.to_markdown(tablefmt="psql", floatfmt=".2f"))
+
+    # returns of calendar periods or rolling windows
+    if returns_period:
+        xirr, time_weighted_returns = calculate_returns(
+            portfolio_data,
+            names,
+            values_columns,
+            expenses_columns,
+            returns_windows(
+                portfolio_data.index, returns_period, returns_rolling_periods
+            ),
+        )
+        windows_name = returns_period.upper()
+        if returns_rolling_periods:
+            windows_name = f"ROLLING {returns_rolling_periods} {windows_name}"
+        for returns_name, returns in [("XIRR", xirr), ("TWR", time_weighted_returns)]:
+            returns = 100 * returns
+            returns.index.name = f"{returns_name} BY {windows_name} [%]"
+            print(returns.to_markdown(tablefmt="psql", floatfmt=".2f"))
+
+
+def calculate_drawdown(values, initial_peak=0):
+    """
+    Calculates drawdown of values series from its running peak in a single pass
+
+    Parameters
+    ----------
+    values : Series
+        Series with values to calculate drawdown for
+    initial_peak : float
+        Peak of values before the first date of the series (default is 0)
+
+    Returns
+    -------
+    Series
+        Series with drawdown for each date as a fraction of the running peak
+    """
+    # running peak is the maximum of all values up to and including a given date
+    running_peak = values.cummax().clip(lower=initial_peak)
+
+    # drawdown is a relative difference between current value and running peak
+    drawdown = (values - running_peak) / running_peak
+
+    # before the first purchase the running peak is 0 so there is no drawdown
+    drawdown[running_peak == 0] = 0
+
+    return drawdown
+
+
+def calculate_drawdown_statistics(portfolio_data, names, values_columns):
+    """
+    Calculates maximum drawdown with its peak, trough and recovery dates and the longest underwater period for each of the values columns
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio data
+    names : list
+        List of names to use as columns of the result
+    values_columns : list
+        List of values column names from portfolio_data DataFrame to calculate statistics for
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with drawdown statistics for each name in columns
+    """
+    drawdown_statistics = pd.DataFrame()
+    for name, values_column in zip(names, values_columns):
+        values = portfolio_data[values_column]
+        drawdown = calculate_drawdown(values)
+
+        # the deepest drawdown and the date when it happened
+        max_drawdown = drawdown.min()
+        trough_date = drawdown.idxmin()
+
+        peak_date = None
+        recovery_date = None
+        if max_drawdown < 0:
+            # peak is the date of the highest value before the trough
+            peak_date = values.loc[:trough_date].idxmax()
+
+            # recovery is the first date after the trough when the value got back to the peak
+            recovered = values.loc[trough_date:] >= values.loc[peak_date]
+            if recovered.any():
+                recovery_date = recovered.idxmax()
+
+        # every underwater period starts at the last date with no drawdown, so the dates with no drawdown enumerate the periods
+        underwater = drawdown < 0
+        underwater_period_id = (~underwater).cumsum()
+        underwater_period_start = (
+            pd.Series(drawdown.index, index=drawdown.index)
+            .groupby(underwater_period_id.values)
+            .first()
+        )
+
+        # underwater period ends at the start of the next period or at the last date if it has not recovered yet
+        underwater_period_end = underwater_period_start.shift(-1).fillna(
+            drawdown.index[-1]
+        )
+        underwater_periods_with_drawdown = underwater.groupby(
+            underwater_period_id.values
+        ).any()
+        underwater_days = (underwater_period_end - underwater_period_start)[
+            underwater_periods_with_drawdown
+        ].dt.days.max()
+
+        new_name_column = pd.DataFrame(
+            [
+                f"{100 * max_drawdown:.2f}",
+                peak_date.strftime("%Y-%m-%d") if peak_date is not None else "",
+                trough_date.strftime("%Y-%m-%d") if peak_date is not None else "",
+                recovery_date.strftime("%Y-%m-%d") if recovery_date is not None else "",
+                0 if pd.isna(underwater_days) else underwater_days,
+            ],
+            columns=[name],
+            index=[
+                "MAX DRAWDOWN [%]",
+                "PEAK DATE",
+                "TROUGH DATE",
+                "RECOVERY DATE",
+                "LONGEST UNDERWATER [days]",
+            ],
+        )
+        drawdown_statistics = pd.concat([drawdown_statistics, new_name_column], axis=1)
+
+    return drawdown_statistics
+
+
+@instrumented
+def print_portfolio_drawdowns(
+    portfolio_data,
+    securities,
+    securities_value,
+):
+    """
+    Prints drawdown statistics for each security and portfolio as a whole
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio data
+    securities : list
+        List of securities names
+    securities_value : list
+        List of securities value names
+
+    Returns
+    -------
+    None
+    """
+    portfolio_drawdowns = calculate_drawdown_statistics(
+        portfolio_data,
+        securities + [PORTFOLIO],
+        securities_value + [PORTFOLIO + VALUE_SUFFIX],
+    )
+    portfolio_drawdowns.index.name = "DRAWDOWNS"
+    print(portfolio_drawdowns.to_markdown(tablefmt="psql", floatfmt=".2f"))
+
+
+@instrumented
+def calculate_portfolio_values(
+    portfolio_data,
+    securities,
+    securities_count,
+    securities_value,
+    securities_unit_value,
+    securities_expense,
+    securities_profit,
+    securities_drawdown,
+    initial_state=None,
+):
+    """
+    Calculates portfolio components' property values for each security and portfolio as a whole and adds them to portfolio_data DataFrame
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio data
+    securities : list
+        List of securities names
+    securities_count : list
+        List of securities count names
+    securities_value : list
+        List of securities value names
+    securities_unit_value : list
+        List of securities unit value names
+    securities_expense : list
+        List of securities expense names
+    securities_profit : list
+        List of securities profit names
+    securities_drawdown : list
+        List of securities drawdown names
+    initial_state : Series
+        Series with portfolio state before the first date of portfolio_data to continue the calculations from, see portfolio_state function (default is None)
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with portfolio data with calculated values
+    """
+    # assign values from securities_count to securities_value and securities_expense as values and expenses will be calculated later using these count values
+    portfolio_data[securities_value] = portfolio_data[securities_count]
+    portfolio_data[securities_expense] = portfolio_data[securities_count]
+
+    # rename columns to more informative names
+    portfolio_data = portfolio_data.rename(
+        columns=dict(zip(securities, securities_unit_value))
+    )
+
+    # temporarily reset index to get rid of duplicate index values
+    portfolio_data = portfolio_data.reset_index()
+
+    # security expense without transaction fee, payments of sells are negative so expense is the net cash invested in the security
+    for security_expense in securities_expense:
+        portfolio_data[security_expense] = portfolio_data[
+            portfolio_data[security_expense].abs() > 0
+        ][TRANSACTION_PAYMENT_COLUMN_NAME]
+
+    # set index back to DATE
+    portfolio_data = portfolio_data.set_index(DATE)
+
+    # separate securities unit values from other columns and drop duplicates in DATE column from these separated securities unit values
+    duplicated_idx = portfolio_data.index.duplicated()
+    unit_values_data = portfolio_data.loc[~duplicated_idx, securities_unit_value].copy()
+
+    # drop securities unit values from portfolio_data DataFrame
+    portfolio_data = portfolio_data.drop(securities_unit_value, axis=1)
+
+    # group by DATE and sum all the values for each DATE
+    portfolio_data = portfolio_data.groupby(DATE).sum()
+
+    # join portfolio_data DataFrame with separated earlier securities unit values
+    portfolio_data = portfolio_data.join(unit_values_data)
+
+    # continue counts and expenses of securities from the initial state by adding them to the first date before cummulative sums
+    if initial_state is not None:
+        first_date = portfolio_data.index[0]
+        portfolio_data.loc[first_date, securities_value] += initial_state[
+            securities_count
+        ].to_numpy()
+        portfolio_data.loc[first_date, securities_count] += initial_state[
+            securities_count
+        ].to_numpy()
+        portfolio_data.loc[first_date, securities_expense] += initial_state[
+            securities_expense
+        ].to_numpy()
+
+    # currently in securities values there is only count of securities securities as an auxiliary column to calculate portfolio values later
+    # we fill NaN values with 0 and calculate cummulative sum to get the number of securities in the portfolio at a given time
+    portfolio_data[securities_value] = (
+        portfolio_data[securities_value].fillna(0).cumsum()
+    )
+
+    # calculate portfolio values for each security using currently stored count of securities and unit value
+    for security_value, security_unit_value in zip(
+        securities_value, securities_unit_value
+    ):
+        portfolio_data[security_value] = (
+            portfolio_data[security_value] * portfolio_data[security_unit_value]
+        )
+
+    # fill all the remaining NaN values with 0
+    portfolio_data = portfolio_data.fillna(0)
+
+    # calculate cummulative sum of expenses and count of securities
+    portfolio_data[securities_expense] = portfolio_data[securities_expense].cumsum()
+    portfolio_data[securities_count] = portfolio_data[securities_count].cumsum()
+
+    # add fees to transaction payments
+    portfolio_data[TRANSACTION_PAYMENT_COLUMN_NAME] = (
+        portfolio_data[TRANSACTION_PAYMENT_COLUMN_NAME]
+        + portfolio_data[FEE_PAYMENT_COLUMN_NAME]
+    )
+
+    # continue portfolio expenses from the initial state
+    if initial_state is not None:
+        portfolio_data.loc[
+            first_date, TRANSACTION_PAYMENT_COLUMN_NAME
+        ] += initial_state[PORTFOLIO + EXPENSE_SUFFIX]
+
+    # calculate cummulative sum of portfolio expenses as a sum of transaction payments and fees
+    portfolio_data[PORTFOLIO + EXPENSE_SUFFIX] = portfolio_data[
+        TRANSACTION_PAYMENT_COLUMN_NAME
+    ].cumsum()
+
+    # calculate portfolio value as a sum of securities values
+    portfolio_data[PORTFOLIO + VALUE_SUFFIX] = portfolio_data[securities_value].sum(
+        axis=1
+    )
+
+    # calculate portfolio profit as a difference between portfolio value and portfolio expense
+    portfolio_data[PORTFOLIO + PROFIT_SUFFIX] = (
+        portfolio_data[PORTFOLIO + VALUE_SUFFIX]
+        - portfolio_data[PORTFOLIO + EXPENSE_SUFFIX]
+    )
+
+    # calculate profit for each security as a difference between security value and security expense
+    for security_value, security_expense, security_profit in zip(
+        securities_value, securities_expense, securities_profit
+    ):
+        portfolio_data[security_profit] = (
+            portfolio_data[security_value] - portfolio_data[security_expense]
+        )
+
+    # peaks of values before the first date are taken from the initial state
+    initial_peaks = (
+        initial_state[securities_value + [PORTFOLIO + VALUE_SUFFIX]]
+        if initial_state is not None
+        else pd.Series(0, index=securities_value + [PORTFOLIO + VALUE_SUFFIX])
+    )
+
+    # calculate portfolio drawdowns using running peak of portfolio value
+    portfolio_data[PORTFOLIO + DRAWDOWN_SUFFIX] = calculate_drawdown(
+        portfolio_data[PORTFOLIO + VALUE_SUFFIX],
+        initial_peaks[PORTFOLIO + VALUE_SUFFIX],
     )
 
-    # calculate new goal p.p. value for the weight group with the biggest deviation from ideal weight
-    # new goal p.p. value is calculated by dividing current value for the weight group with the biggest (positive) deviation from ideal weight by ideal weight for that weight group
-    # it results with a new goal percentage point which will be used to calculate new goal values for each weight group
-    new_goal_percentage_point_value = weight_groups_current_values.get(
-        max_deviation_weight_group
-    ) / weights.get(max_deviation_weight_group)
+    # calculate drawdowns for each security position value
+    for security_value, security_drawdown in zip(securities_value, securities_drawdown):
+        portfolio_data[security_drawdown] = calculate_drawdown(
+            portfolio_data[security_value], initial_peaks[security_value]
+        )
+
+    # concatenate columns to leave into one list
+    columns_to_leave = [
+        securities_count
+        + securities_value
+        + securities_unit_value
+        + securities_expense
+        + securities_profit
+        + securities_drawdown
+        + [
+            PORTFOLIO + VALUE_SUFFIX,
+            PORTFOLIO + EXPENSE_SUFFIX,
+            PORTFOLIO + PROFIT_SUFFIX,
+            PORTFOLIO + DRAWDOWN_SUFFIX,
+        ]
+    ]
+
+    # leave only specified columns
+    portfolio_data = portfolio_data[columns_to_leave[0]]
+
+    return portfolio_data
+
+
+@instrumented
+def calculate_portfolio_values_arrays(
+    portfolio_data,
+    securities,
+    securities_count,
+    securities_value,
+    securities_unit_value,
+    securities_expense,
+    securities_profit,
+    securities_drawdown,
+    initial_state=None,
+):
+    """
+    Calculates the same portfolio values as calculate_portfolio_values keeping counts, unit values and payments in arrays of shape (dates, securities) and creating DataFrame only at the end
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio data
+    securities : list
+        List of securities names
+    securities_count : list
+        List of securities count names
+    securities_value : list
+        List of securities value names
+    securities_unit_value : list
+        List of securities unit value names
+    securities_expense : list
+        List of securities expense names
+    securities_profit : list
+        List of securities profit names
+    securities_drawdown : list
+        List of securities drawdown names
+    initial_state : Series
+        Series with portfolio state before the first date of portfolio_data to continue the calculations from, see portfolio_state function (default is None)
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with portfolio data with calculated values
+    """
+    securities_number = len(securities)
+
+    # dates are sorted so the first row of each date holds its securities unit values
+    first_date_rows = ~portfolio_data.index.duplicated()
+    dates = portfolio_data.index[first_date_rows]
+    unit_values = portfolio_data[securities].to_numpy(dtype=float)[first_date_rows]
+
+    # transactions counts and payments of all rows
+    counts = portfolio_data[securities_count].to_numpy(dtype=float)
+    transaction_payments = portfolio_data[TRANSACTION_PAYMENT_COLUMN_NAME].to_numpy(
+        dtype=float
+    )
+    fee_payments = portfolio_data[FEE_PAYMENT_COLUMN_NAME].to_numpy(dtype=float)
+
+    # security expense without transaction fee is a transaction payment of rows where the security was bought or sold
+    # payments of sells are negative so expense is the net cash invested in the security
+    expenses = np.where(np.abs(counts) > 0, transaction_payments[:, None], np.nan)
+
+    # sum counts, expenses and payments of all rows for each date in a single grouping
+    # grouping sum is used instead of plain numpy sum to get exactly the same results as calculate_portfolio_values
+    dates_sums = (
+        pd.DataFrame(
+            np.column_stack([counts, expenses, transaction_payments, fee_payments])
+        )
+        .groupby(portfolio_data.index.to_numpy())
+        .sum()
+        .to_numpy()
+    )
+    counts = dates_sums[:, :securities_number]
+    expenses = dates_sums[:, securities_number : 2 * securities_number]
+    payments = dates_sums[:, -2] + dates_sums[:, -1]
+
+    # continue counts and expenses from the initial state by adding them to the first date before cummulative sums
+    if initial_state is not None:
+        counts[0] += initial_state[securities_count].to_numpy()
+        expenses[0] += initial_state[securities_expense].to_numpy()
+        payments[0] += initial_state[PORTFOLIO + EXPENSE_SUFFIX]
+
+    # cummulative counts, expenses and portfolio expense
+    counts = counts.cumsum(axis=0)
+    expenses = expenses.cumsum(axis=0)
+    portfolio_expense = payments.cumsum()
+
+    # values of securities are counts multiplied by unit values, missing unit values result in 0 values
+    values = np.nan_to_num(counts * unit_values, nan=0.0)
+    unit_values = np.nan_to_num(unit_values, nan=0.0)
+
+    # portfolio value is a sum of securities values added one security after another
+    portfolio_value = np.zeros(len(dates))
+    for security_index in range(securities_number):
+        portfolio_value = portfolio_value + values[:, security_index]
+
+    # peaks of values before the first date are taken from the initial state
+    initial_peaks = (
+        initial_state[securities_value + [PORTFOLIO + VALUE_SUFFIX]].to_numpy()
+        if initial_state is not None
+        else np.zeros(securities_number + 1)
+    )
+
+    # drawdowns of securities and portfolio values from their running peaks
+    all_values = np.column_stack([values, portfolio_value])
+    running_peaks = np.maximum(np.maximum.accumulate(all_values, axis=0), initial_peaks)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        drawdowns = np.where(
+            running_peaks == 0, 0.0, (all_values - running_peaks) / running_peaks
+        )
+
+    # create DataFrame with the same columns as calculate_portfolio_values
+    portfolio_data = pd.DataFrame(
+        np.column_stack(
+            [
+                counts,
+                values,
+                unit_values,
+                expenses,
+                values - expenses,
+                drawdowns[:, :-1],
+                portfolio_value,
+                portfolio_expense,
+                portfolio_value - portfolio_expense,
+                drawdowns[:, -1],
+            ]
+        ),
+        index=dates,
+        columns=securities_count
+        + securities_value
+        + securities_unit_value
+        + securities_expense
+        + securities_profit
+        + securities_drawdown
+        + [
+            PORTFOLIO + VALUE_SUFFIX,
+            PORTFOLIO + EXPENSE_SUFFIX,
+            PORTFOLIO + PROFIT_SUFFIX,
+            PORTFOLIO + DRAWDOWN_SUFFIX,
+        ],
+    )
+
+    return portfolio_data
+
+
+# engines calculating portfolio values available by name, all of them take the same parameters and return the same DataFrame
+PORTFOLIO_VALUES_ENGINES = {
+    "pandas": calculate_portfolio_values,
+    "arrays": calculate_portfolio_values_arrays,
+}
+
+
+def match_lots(counts, payments, method="fifo", held_lots=None):
+    """
+    Matches sells of a single security with its bought lots processing trades in date order
+
+    Each lot is added to and removed from the queue only once, so matching takes amortized constant time per trade
+
+    Parameters
+    ----------
+    counts : ndarray
+        Array with counts of trades, positive for buys and negative for sells
+    payments : ndarray
+        Array with payments of trades without fees, negative for sells
+    method : str
+        Method from LOT_MATCHING_METHODS, "fifo" sells the oldest lots first and "average" sells units at the average cost of held units (default is "fifo")
+    held_lots : list
+        List of [count, unit cost] of lots held before the first trade from the oldest one to continue matching from (default is None which means no lots are held)
+
+    Returns
+    -------
+    ndarray
+        Array with changes of cost basis of held lots made by each trade
+    ndarray
+        Array with realized profit of each trade, 0 for buys
+    float
+        Count of units sold above held units, their cost is assumed to be 0
+    list
+        List of [count, unit cost] of lots held after the last trade from the oldest one, a single lot at the average cost for "average"
+    """
+    # results are collected in lists as appending to them is faster than assigning single array elements
+    cost_basis_changes = []
+    realized_profits = []
+
+    # queue of [count, unit cost] of held lots from the oldest one, used only by fifo
+    lots = collections.deque([list(lot) for lot in held_lots or []])
+    held_count = float(sum(count for count, _ in lots))
+    held_cost = float(sum(count * unit_cost for count, unit_cost in lots))
+    if method != "fifo":
+        lots.clear()
+    oversold_count = 0.0
+
+    for count, payment in zip(counts.tolist(), payments.tolist()):
+        if count > 0:
+            if method == "fifo":
+                lots.append([count, payment / count])
+            held_count += count
+            held_cost += payment
+            cost_basis_changes.append(payment)
+            realized_profits.append(0.0)
+            continue
+
+        sold_count = -count
+        matched_count = min(sold_count, held_count)
+
+        # cost of sold units is taken from the oldest lots or from the average cost of held units
+        if method == "fifo":
+            sold_cost = 0.0
+            remaining_count = matched_count
+            while remaining_count > 0 and lots:
+                lot = lots[0]
+                lot_count = min(remaining_count, lot[0])
+                sold_cost += lot_count * lot[1]
+                remaining_count -= lot_count
+                if lot_count == lot[0]:
+                    lots.popleft()
+                else:
+                    lot[0] -= lot_count
+        else:
+            sold_cost = held_cost * matched_count / held_count if held_count else 0.0
+
+        oversold_count += sold_count - matched_count
+        held_count -= matched_count
+        held_cost -= sold_cost
+
+        # proceeds of a sell are the negative payment
+        cost_basis_changes.append(-sold_cost)
+        realized_profits.append(-payment - sold_cost)
+
+    # lots held at the average cost are kept as a single lot
+    if method != "fifo":
+        lots = [[held_count, held_cost / held_count]] if held_count > 0 else []
+
+    return (
+        np.array(cost_basis_changes),
+        np.array(realized_profits),
+        oversold_count,
+        [list(lot) for lot in lots],
+    )
+
+
+@instrumented
+def calculate_lots_ledger(
+    portfolio_data, securities, securities_count, method="fifo", held_lots=None
+):
+    """
+    Calculates cost basis of held lots and realized profit of each security matching sells with bought lots
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio data with transactions sorted by dates
+    securities : list
+        List of securities names
+    securities_count : list
+        List of securities count names
+    method : str
+        Method from LOT_MATCHING_METHODS to match sold units with bought lots (default is "fifo")
+    held_lots : dict
+        Dictionary with lots of each security held before the first date of portfolio_data to continue matching from, see match_lots function (default is None which means no lots are held)
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with cumulative cost basis and realized profit of each security for each date, accumulated from 0 at the first date
+    dict
+        Dictionary with lots of each security held after the last date of portfolio_data, securities without held lots are left out
+    """
+    select_names([method], LOT_MATCHING_METHODS, "lot matching method")
+    held_lots = held_lots or {}
+
+    counts = np.nan_to_num(portfolio_data[securities_count].to_numpy(dtype=float))
+    payments = np.nan_to_num(
+        portfolio_data[TRANSACTION_PAYMENT_COLUMN_NAME].to_numpy(dtype=float)
+    )
+
+    # without sells cost basis of held lots is just the sum of payments of buys, so lots are matched only for securities with sells
+    cost_basis_changes = np.where(counts > 0, payments[:, None], 0.0)
+    realized_profits = np.zeros_like(counts)
+    new_held_lots = {}
+    for security_index, security in enumerate(securities):
+        trades = np.flatnonzero(counts[:, security_index])
+        security_counts = counts[trades, security_index]
+        security_lots = held_lots.get(security, [])
+
+        if (security_counts < 0).any():
+            (
+                cost_basis_changes[trades, security_index],
+                realized_profits[trades, security_index],
+                oversold_count,
+                security_lots,
+            ) = match_lots(security_counts, payments[trades], method, security_lots)
+            if oversold_count:
+                warnings.warn(
+                    f"{oversold_count:g} units of {security} were sold above held units, their cost basis is assumed to be 0"
+                )
+
+        # bought lots are only added to held lots, for average cost they are merged into a single lot
+        elif len(trades) > 0:
+            security_lots = security_lots + [
+                [count, payment / count]
+                for count, payment in zip(
+                    security_counts.tolist(), payments[trades].tolist()
+                )
+            ]
+            if method != "fifo":
+                held_count = sum(count for count, _ in security_lots)
+                held_cost = sum(count * unit_cost for count, unit_cost in security_lots)
+                security_lots = [[held_count, held_cost / held_count]]
+
+        if security_lots:
+            new_held_lots[security] = security_lots
+
+    # sum changes of all trades of each date and accumulate them over dates
+    lots_ledger = (
+        pd.DataFrame(
+            np.column_stack([cost_basis_changes, realized_profits]),
+            index=portfolio_data.index,
+            columns=[security + COST_BASIS_SUFFIX for security in securities]
+            + [security + REALIZED_PROFIT_SUFFIX for security in securities],
+        )
+        .groupby(level=0)
+        .sum()
+        .cumsum()
+    )
+
+    return lots_ledger, new_held_lots
+
+
+def portfolio_state(
+    portfolio_data, securities_count, securities_value, securities_expense
+):
+    """
+    Takes portfolio state needed to continue calculations of portfolio values after the last date of portfolio_data DataFrame
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio data with calculated values
+    securities_count : list
+        List of securities count names
+    securities_value : list
+        List of securities value names
+    securities_expense : list
+        List of securities expense names
+
+    Returns
+    -------
+    Series
+        Series with the last cummulative counts and expenses of securities, the last portfolio expense and running peaks of securities and portfolio values
+    """
+    values_columns = securities_value + [PORTFOLIO + VALUE_SUFFIX]
+
+    return pd.concat(
+        [
+            portfolio_data[
+                securities_count + securities_expense + [PORTFOLIO + EXPENSE_SUFFIX]
+            ].iloc[-1],
+            portfolio_data[values_columns].max(),
+        ]
+    )
+
+
+def transactions_fingerprint(portfolio_data, securities):
+    """
+    Calculates fingerprint of transactions for each date to detect new, changed or removed transactions
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio data prepared for analysis
+    securities : list
+        List of securities names
+
+    Returns
+    -------
+    Series
+        Series with a hash of all transactions for each date with transactions
+    """
+    # take only rows with transactions without securities unit values
+    transactions = portfolio_data.drop(securities, axis=1).dropna(how="all")
+
+    # hash of each transaction summed for each date does not depend on the order of transactions within a date
+    transactions_hashes = pd.util.hash_pandas_object(transactions, index=False)
+
+    return transactions_hashes.groupby(level=0).sum()
+
+
+def first_changed_date(
+    portfolio_data,
+    previous_portfolio_data,
+    previous_transactions_fingerprint,
+    securities,
+    securities_unit_value,
+):
+    """
+    Finds the earliest date from which previously calculated portfolio values are no longer valid due to new or back-dated transactions, new or changed unit values or new dates
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio data prepared for analysis
+    previous_portfolio_data : DataFrame
+        DataFrame with previously calculated portfolio data
+    previous_transactions_fingerprint : Series
+        Series with transactions fingerprint used to calculate previous_portfolio_data
+    securities : list
+        List of securities names
+    securities_unit_value : list
+        List of securities unit value names
+
+    Returns
+    -------
+    Timestamp
+        The earliest changed date or None if nothing has changed
+    """
+    # compare unit values for all dates, dates missing in one of the DataFrames are also changed
+    unit_values = portfolio_data.loc[~portfolio_data.index.duplicated(), securities]
+    unit_values.columns = securities_unit_value
+    dates = unit_values.index.union(previous_portfolio_data.index)
+    changed_unit_values = (
+        unit_values.reindex(dates)
+        .ne(previous_portfolio_data[securities_unit_value].reindex(dates))
+        .any(axis=1)
+    )
+
+    # compare transactions fingerprints for all dates with transactions
+    fingerprint = transactions_fingerprint(portfolio_data, securities)
+    transactions_dates = fingerprint.index.union(
+        previous_transactions_fingerprint.index
+    )
+    changed_transactions = fingerprint.reindex(transactions_dates).ne(
+        previous_transactions_fingerprint.reindex(transactions_dates)
+    )
+
+    changed_dates = changed_unit_values.index[changed_unit_values].union(
+        changed_transactions.index[changed_transactions]
+    )
+
+    return changed_dates[0] if len(changed_dates) > 0 else None
+
+
+@instrumented
+def update_portfolio_values(
+    portfolio_data,
+    portfolio_state_folder_path,
+    securities,
+    securities_count,
+    securities_value,
+    securities_unit_value,
+    securities_expense,
+    securities_profit,
+    securities_drawdown,
+    calculation_engine="arrays",
+):
+    """
+    Updates previously calculated and saved portfolio values by recalculating them only from the earliest changed date and saves the result for the next update
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio data prepared for analysis
+    portfolio_state_folder_path : str
+        Path to folder where calculated portfolio values and transactions fingerprint are saved
+    securities : list
+        List of securities names
+    securities_count : list
+        List of securities count names
+    securities_value : list
+        List of securities value names
+    securities_unit_value : list
+        List of securities unit value names
+    securities_expense : list
+        List of securities expense names
+    securities_profit : list
+        List of securities profit names
+    securities_drawdown : list
+        List of securities drawdown names
+    calculation_engine : str
+        Name of the engine from PORTFOLIO_VALUES_ENGINES to calculate portfolio values with (default is "arrays")
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with portfolio data with calculated values
+    """
+    portfolio_values_path = os.path.join(
+        portfolio_state_folder_path, PORTFOLIO_VALUES_FILE_NAME
+    )
+    transactions_fingerprint_path = os.path.join(
+        portfolio_state_folder_path, TRANSACTIONS_FINGERPRINT_FILE_NAME
+    )
+    portfolio_state_path = os.path.join(
+        portfolio_state_folder_path, PORTFOLIO_STATE_FILE_NAME
+    )
+
+    # saved values can be continued only if they were calculated the same way for the same securities
+    # as removed or added securities change portfolio values and drawdowns of all dates
+    state_settings = {
+        "portfolio_state_version": PORTFOLIO_STATE_VERSION,
+        "calculation_engine": calculation_engine,
+        "securities": list(securities),
+    }
+    previous_state_settings = None
+    if os.path.exists(portfolio_state_path):
+        with open(portfolio_state_path) as portfolio_state_file:
+            previous_state_settings = json.load(portfolio_state_file)
+
+    # by default all portfolio values are calculated from the first date
+    previous_portfolio_data = None
+    changed_date = portfolio_data.index[0]
+
+    # find the earliest changed date if portfolio values were saved with the same settings
+    if (
+        previous_state_settings == state_settings
+        and os.path.exists(portfolio_values_path)
+        and os.path.exists(transactions_fingerprint_path)
+    ):
+        previous_portfolio_data = pd.read_parquet(portfolio_values_path)
+        previous_transactions_fingerprint = pd.read_parquet(
+            transactions_fingerprint_path
+        ).iloc[:, 0]
+
+        changed_date = first_changed_date(
+            portfolio_data,
+            previous_portfolio_data,
+            previous_transactions_fingerprint,
+            securities,
+            securities_unit_value,
+        )
+
+    # nothing has changed since the previous calculation
+    if changed_date is None:
+        return previous_portfolio_data
+
+    # take previous portfolio values before the changed date and the state to continue calculations from
+    unchanged_portfolio_data = None
+    initial_state = None
+    if previous_portfolio_data is not None:
+        unchanged_portfolio_data = previous_portfolio_data[
+            previous_portfolio_data.index < changed_date
+        ]
+        if not unchanged_portfolio_data.empty:
+            initial_state = portfolio_state(
+                unchanged_portfolio_data,
+                securities_count,
+                securities_value,
+                securities_expense,
+            )
+
+    # calculate portfolio values only from the changed date
+    changed_portfolio_data = PORTFOLIO_VALUES_ENGINES[calculation_engine](
+        portfolio_data[portfolio_data.index >= changed_date].copy(),
+        securities,
+        securities_count,
+        securities_value,
+        securities_unit_value,
+        securities_expense,
+        securities_profit,
+        securities_drawdown,
+        initial_state,
+    )
+    portfolio_data_fingerprint = transactions_fingerprint(portfolio_data, securities)
+
+    if initial_state is not None:
+        changed_portfolio_data = pd.concat(
+            [unchanged_portfolio_data, changed_portfolio_data]
+        )
+
+    # save calculated portfolio values and transactions fingerprint for the next update
+    if not os.path.exists(portfolio_state_folder_path):
+        os.makedirs(portfolio_state_folder_path)
+    changed_portfolio_data.to_parquet(portfolio_values_path)
+    portfolio_data_fingerprint.to_frame(
+        TRANSACTIONS_FINGERPRINT_COLUMN_NAME
+    ).to_parquet(transactions_fingerprint_path)
+    with open(portfolio_state_path, "w") as portfolio_state_file:
+        json.dump(state_settings, portfolio_state_file, indent=4)
+
+    # save aggregates of portfolio values recalculating only the periods from the changed date
+    save_portfolio_aggregates(
+        changed_portfolio_data,
+        portfolio_state_folder_path,
+        changed_date if initial_state is not None else None,
+    )
+
+    return changed_portfolio_data
+
+
+@instrumented
+def update_lots_ledger(
+    portfolio_data, portfolio_state_folder_path, securities, securities_count, method
+):
+    """
+    Updates previously calculated and saved lots ledger by matching only trades after the date of saved held lots and saves the result for the next update
+
+    The ledger is calculated from all trades if trades until the date of saved held lots have changed
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio data prepared for analysis
+    portfolio_state_folder_path : str
+        Path to folder where calculated lots ledger and held lots are saved
+    securities : list
+        List of securities names
+    securities_count : list
+        List of securities count names
+    method : str
+        Method from LOT_MATCHING_METHODS to match sold units with bought lots
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with cumulative cost basis and realized profit of each security for each date
+    """
+    lots_ledger_path = os.path.join(portfolio_state_folder_path, LOTS_LEDGER_FILE_NAME)
+    lots_state_path = os.path.join(portfolio_state_folder_path, LOTS_STATE_FILE_NAME)
+
+    # saved held lots can be continued only if they were matched the same way for the same securities
+    state_settings = {
+        "portfolio_state_version": PORTFOLIO_STATE_VERSION,
+        "lot_matching": method,
+        "securities": list(securities),
+    }
+    previous_lots_state = None
+    if os.path.exists(lots_state_path) and os.path.exists(lots_ledger_path):
+        with open(lots_state_path) as lots_state_file:
+            previous_lots_state = json.load(lots_state_file)
+
+    # hash of transactions fingerprints of all dates detects any new, changed or removed transaction
+    fingerprint = transactions_fingerprint(portfolio_data, securities)
+
+    def transactions_hash(dates_fingerprint):
+        return int(pd.util.hash_pandas_object(dates_fingerprint).sum())
+
+    # by default all trades are matched from the first date
+    lots_ledger = None
+    dates = portfolio_data.index.unique()
+    if (
+        previous_lots_state is not None
+        and previous_lots_state["settings"] == state_settings
+    ):
+        state_date = pd.Timestamp(previous_lots_state["state_date"])
+        previous_lots_ledger = pd.read_parquet(lots_ledger_path)
+
+        # continue from saved held lots only if dates and transactions until their date have not changed
+        if previous_lots_ledger.index.equals(
+            dates[dates <= state_date]
+        ) and previous_lots_state["transactions_hash"] == transactions_hash(
+            fingerprint[fingerprint.index <= state_date]
+        ):
+            new_portfolio_data = portfolio_data[portfolio_data.index > state_date]
+
+            # nothing has changed since the previous calculation
+            if new_portfolio_data.empty:
+                return previous_lots_ledger
+
+            # cumulative cost basis and realized profit of new dates continue from the last saved date
+            new_lots_ledger, held_lots = calculate_lots_ledger(
+                new_portfolio_data,
+                securities,
+                securities_count,
+                method,
+                previous_lots_state["held_lots"],
+            )
+            lots_ledger = pd.concat(
+                [previous_lots_ledger, new_lots_ledger + previous_lots_ledger.iloc[-1]]
+            )
 
-    # calculate new goal values and counts for each weight group and its securities
-    portfolio_new_goal = pd.DataFrame()
-    for weight_group_name, weight_group_securities in weight_groups.items():
-        new_goal_value = new_goal_percentage_point_value * weights.get(
-            weight_group_name
+    if lots_ledger is None:
+        lots_ledger, held_lots = calculate_lots_ledger(
+            portfolio_data, securities, securities_count, method
         )
 
-        # for storing new goal count and current count for each security in a given weight group
-        weight_groups_securities_counts_dict = {}
+    # save calculated lots ledger and lots held at its last date for the next update
+    if not os.path.exists(portfolio_state_folder_path):
+        os.makedirs(portfolio_state_folder_path)
+    lots_ledger.to_parquet(lots_ledger_path)
+    with open(lots_state_path, "w") as lots_state_file:
+        json.dump(
+            {
+                "settings": state_settings,
+                "state_date": str(dates[-1]),
+                "transactions_hash": transactions_hash(fingerprint),
+                "held_lots": held_lots,
+            },
+            lots_state_file,
+            indent=4,
+        )
 
-        # take indexes of securities in securities list
-        weight_group_securities_indexes = [
-            securities.index(security) for security in weight_group_securities
-        ]
+    return lots_ledger
 
-        # calculate current value for a given securities weight group
-        weight_group_securities_current_value = 0
-        for index in weight_group_securities_indexes:
-            weight_group_securities_current_value += portfolio_data[
-                securities_value[index]
-            ].iloc[-1]
-
-        # calculate new goal count and current count for each security in a given weight group
-        for weight_group_security in weight_group_securities:
-            if weight_group_security not in securities:
-                continue
-
-            # find index of a given security in securities list
-            list_index_of_security = securities.index(weight_group_security)
-
-            # take security unit value column name
-            security_unit_value = securities_unit_value[list_index_of_security]
-
-            # calculate new goal count for a given security by taking the lacking value of securities to meet the desired weight divided by current unit value of a given security
-            new_goal_approximated_count = (
-                new_goal_value - weight_group_securities_current_value
-            ) / portfolio_data[security_unit_value].iloc[-1]
-
-            # take security count column name
-            security_count = securities_count[list_index_of_security]
-
-            # take current count for a given security
-            security_current_count = portfolio_data[security_count].iloc[-1]
-
-            # add new goal count and current count for a given security to dictionary
-            weight_groups_securities_counts_dict.update(
-                {
-                    weight_group_security: [
-                        new_goal_approximated_count,
-                        security_current_count,
-                    ]
-                }
-            )
 
-        # add new goal value and current value for a given weight group to list
-        weight_group_name_values_list = [
-            new_goal_value,
-            weight_groups_current_values.get(weight_group_name),
-        ]
+@instrumented
+def convert_portfolio_values(
+    portfolio_data,
+    exchange_rates,
+    analysis_currency,
+    report_currencies,
+    securities_value,
+    securities_unit_value,
+    securities_expense,
+    securities_profit,
+    securities_drawdown,
+    securities_cost_basis=(),
+    securities_realized_profit=(),
+    securities_unrealized_profit=(),
+):
+    """
+    Converts calculated portfolio values from analysis currency to other currencies in one vectorized pass over all of them
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio values calculated in analysis currency
+    exchange_rates : DataFrame
+        DataFrame with exchange rates of currency pairs to analysis currency
+    analysis_currency : str
+        Currency in which portfolio values were calculated
+    report_currencies : list
+        List of currencies to convert portfolio values to
+    securities_value : list
+        List of columns with values of securities
+    securities_unit_value : list
+        List of columns with unit values of securities
+    securities_expense : list
+        List of columns with expenses of securities
+    securities_profit : list
+        List of columns with profits of securities
+    securities_drawdown : list
+        List of columns with drawdowns of securities
+    securities_cost_basis : list
+        List of columns with cost basis of held lots of securities from the lots ledger (default is ())
+    securities_realized_profit : list
+        List of columns with realized profits of securities from the lots ledger (default is ())
+    securities_unrealized_profit : list
+        List of columns with unrealized profits of securities from the lots ledger (default is ())
+
+    Returns
+    -------
+    dict
+        Dictionary with report currencies as keys and DataFrames with portfolio data in each currency as values, counts are the same in all of them
+    """
+    values_columns = securities_value + [PORTFOLIO + VALUE_SUFFIX]
+    expenses_columns = securities_expense + [PORTFOLIO + EXPENSE_SUFFIX]
+    profits_columns = securities_profit + [PORTFOLIO + PROFIT_SUFFIX]
+    drawdowns_columns = securities_drawdown + [PORTFOLIO + DRAWDOWN_SUFFIX]
+
+    # expenses and cumulative columns of the lots ledger are converted the same way
+    cumulative_columns = (
+        expenses_columns
+        + list(securities_cost_basis)
+        + list(securities_realized_profit)
+    )
 
-        # string with new goal count for each security in a given weight group
-        goal_count = ""
+    # value of a unit of analysis currency in each report currency on each date
+    # the last known rate is used for dates without exchange rates as securities prices are filled the same way
+    currency_pairs_names = [
+        currency + analysis_currency for currency in report_currencies
+    ]
+    report_rates = (
+        (1 / exchange_rates[currency_pairs_names])
+        .sort_index()
+        .ffill()
+        .reindex(portfolio_data.index, method="ffill")
+    )
+
+    # dates before the first exchange rate would make cumulative expenses NaN for the whole later history
+    # so they are converted with the first available rate and reported
+    missing_rates = report_rates.isna()
+    for currency, currency_pair in zip(report_currencies, currency_pairs_names):
+        if missing_rates[currency_pair].all():
+            raise ValueError(
+                f"Portfolio values can not be converted to {currency} as there are no exchange rates of {currency_pair}"
+            )
+        if missing_rates[currency_pair].any():
+            missing_dates = report_rates.index[missing_rates[currency_pair]]
+            warnings.warn(
+                f"{len(missing_dates)} dates of portfolio data from {missing_dates[0]:%Y-%m-%d} to {missing_dates[-1]:%Y-%m-%d} "
+                f"are before the first exchange rate of {currency_pair} and are converted to {currency} with that first rate"
+            )
+    report_rates = report_rates.bfill()
 
-        # string with current count for each security in a given weight group
-        current_count = ""
+    # rates with shape (currencies, dates, 1) to convert all currencies at once
+    rates = report_rates.to_numpy().T[:, :, np.newaxis]
 
-        # for each security in a given weight group add new goal count and current count to strings
-        for key, value in weight_groups_securities_counts_dict.items():
-            goal_count += f"{key}: {value[0]:.2f}\n"
-            current_count += f"{key}: {value[1]}\n"
+    # values are converted at the rate of their date
+    values = portfolio_data[values_columns].to_numpy() * rates
+    unit_values = portfolio_data[securities_unit_value].to_numpy() * rates
 
-        # create DataFrame with new goal values, current values, new goal count and current count for a given weight group
-        weight_group_dataframe = pd.DataFrame(
-            [
-                round(weight_group_name_values_list[0], 2),  # new goal value
-                round(weight_group_name_values_list[1], 2),  # current value
-                goal_count,
-                current_count,
-            ],
-            columns=[weight_group_name],
-            index=["VALUE", "CURRENT VALUE", "COUNT TO BUY", "CURRENT COUNT"],
+    # expenses are converted at the rate of the date when they changed, so that each transaction keeps its historical cost
+    cumulative_values = np.cumsum(
+        np.diff(portfolio_data[cumulative_columns].to_numpy(), axis=0, prepend=0)
+        * rates,
+        axis=1,
+    )
+    expenses = cumulative_values[:, :, : len(expenses_columns)]
+    cost_basis = cumulative_values[
+        :, :, len(expenses_columns) : len(expenses_columns) + len(securities_cost_basis)
+    ]
+
+    # drawdowns are calculated from running peaks of converted values as the peaks differ between currencies
+    running_peaks = np.maximum.accumulate(values, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        drawdowns = np.where(
+            running_peaks == 0, 0.0, (values - running_peaks) / running_peaks
         )
 
-        # concatenate new goals DataFrame for a given weight group with new goals DataFrame for all weight groups
-        portfolio_new_goal = pd.concat(
-            [portfolio_new_goal, pd.DataFrame(weight_group_dataframe)], axis=1
+    # counts and other columns are shared, only currency dependent columns are replaced
+    currencies_portfolio_data = {}
+    for currency_index, currency in enumerate(report_currencies):
+        currency_portfolio_data = portfolio_data.copy()
+        currency_portfolio_data[values_columns] = values[currency_index]
+        currency_portfolio_data[securities_unit_value] = unit_values[currency_index]
+        currency_portfolio_data[cumulative_columns] = cumulative_values[currency_index]
+        currency_portfolio_data[profits_columns] = (
+            values[currency_index] - expenses[currency_index]
         )
+        currency_portfolio_data[drawdowns_columns] = drawdowns[currency_index]
+        if securities_unrealized_profit:
+            currency_portfolio_data[securities_unrealized_profit] = (
+                values[currency_index, :, : len(securities_cost_basis)]
+                - cost_basis[currency_index]
+            )
+        currencies_portfolio_data[currency] = currency_portfolio_data
 
-    # new portfolio goal value is calculated by multiplying new goal p.p. value by 100
-    goal_sum = round(new_goal_percentage_point_value * 100, 2)
+    return currencies_portfolio_data
 
-    # concatenate new goals DataFrame for all weight groups with DataFrame with portfolio's new goal value and current value
-    portfolio_new_goal = pd.concat(
-        [
-            portfolio_new_goal,
-            pd.DataFrame(
-                [goal_sum, round(portfolio_current_value, 2), *2 * [""]],
-                columns=["SUM"],
-                index=["VALUE", "CURRENT VALUE", "COUNT TO BUY", "CURRENT COUNT"],
-            ),
-        ],
-        axis=1,
+
+def aggregate_portfolio_data(portfolio_data, resolution, flows_columns=()):
+    """
+    Aggregates daily portfolio data to a lower resolution
+
+    Levels (counts, values, cumulative expenses, profits, etc.) take the last value of each period with its date,
+    flows take the sum of each period and drawdowns take the deepest drawdown of each period.
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with daily portfolio data
+    resolution : str
+        Resolution from RESOLUTIONS to aggregate portfolio data to
+    flows_columns : list
+        List of columns with flows, e.g. payments, to sum in each period (default is ())
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with a single row for each period indexed by the last date of the period
+    """
+    if RESOLUTIONS[resolution] is None:
+        return portfolio_data
+
+    periods = portfolio_data.index.to_period(RESOLUTIONS[resolution])
+    grouped_portfolio_data = portfolio_data.groupby(periods)
+
+    # last row of each period keeps the last date of the period as index
+    aggregated_portfolio_data = grouped_portfolio_data.tail(1).copy()
+
+    drawdown_columns = [
+        column for column in portfolio_data.columns if column.endswith(DRAWDOWN_SUFFIX)
+    ]
+    aggregated_portfolio_data[drawdown_columns] = (
+        grouped_portfolio_data[drawdown_columns].min().to_numpy()
+    )
+    flows_columns = [
+        column for column in flows_columns if column in portfolio_data.columns
+    ]
+    aggregated_portfolio_data[flows_columns] = (
+        grouped_portfolio_data[flows_columns].sum().to_numpy()
     )
-    portfolio_new_goal.index.name = f"GOAL [{analysis_currency}]"
-    print(portfolio_new_goal.to_markdown(tablefmt="psql", floatfmt=".2f"))
 
+    return aggregated_portfolio_data
 
-def print_portfolio_performance(portfolio_data, analysis_currency):
+
+def save_portfolio_aggregates(
+    portfolio_data, portfolio_state_folder_path, changed_date=None
+):
     """
-    Prints portfolio performance with current value, expense, profit and profit in percentage
+    Saves weekly, monthly and yearly aggregates of portfolio values to be loaded with load_portfolio_aggregates without running the analysis
+
+    The analysis itself does not read them, it aggregates portfolio data of the analysis period with its risk metrics in memory
 
     Parameters
     ----------
     portfolio_data : DataFrame
-        DataFrame with portfolio data
-    analysis_currency : str
-        Currency of the analysis
+        DataFrame with daily portfolio values
+    portfolio_state_folder_path : str
+        Path to folder where aggregates are saved
+    changed_date : Timestamp
+        Date from which portfolio values changed since aggregates were saved, only periods from this date are aggregated again if specified (default is None)
 
     Returns
     -------
     None
     """
-    # take current portfolio value and expense
-    portfolio_current_value = portfolio_data[PORTFOLIO + VALUE_SUFFIX].iloc[-1]
-    portfolio_current_expense = portfolio_data[PORTFOLIO + EXPENSE_SUFFIX].iloc[-1]
+    for resolution, frequency in RESOLUTIONS.items():
+        if frequency is None:
+            continue
 
-    # create DataFrame with portfolio performance
-    portfolio_performance = pd.DataFrame(
-        [
-            portfolio_current_value,
-            portfolio_current_expense,
-            portfolio_current_value - portfolio_current_expense,
-            100
-            * (portfolio_current_value - portfolio_current_expense)
-            / portfolio_current_expense,
-        ],
-        columns=["VALUES"],
-        index=["VALUE", "EXPENSE", "PROFIT", "PROFIT [%]"],
+        aggregates_path = os.path.join(
+            portfolio_state_folder_path,
+            PORTFOLIO_AGGREGATES_FILE_NAME.format(resolution),
+        )
+
+        # keep saved aggregates of the periods before the period of the changed date
+        if changed_date is not None and os.path.exists(aggregates_path):
+            changed_period_start = pd.Period(changed_date, frequency).start_time
+            previous_aggregates = pd.read_parquet(aggregates_path)
+            aggregates = pd.concat(
+                [
+                    previous_aggregates[
+                        previous_aggregates.index < changed_period_start
+                    ],
+                    aggregate_portfolio_data(
+                        portfolio_data[portfolio_data.index >= changed_period_start],
+                        resolution,
+                    ),
+                ]
+            )
+        else:
+            aggregates = aggregate_portfolio_data(portfolio_data, resolution)
+
+        aggregates.to_parquet(aggregates_path)
+
+
+def load_portfolio_aggregates(portfolio_state_folder_path, resolution):
+    """
+    Loads saved aggregates of portfolio values
+
+    Parameters
+    ----------
+    portfolio_state_folder_path : str
+        Path to folder where aggregates are saved
+    resolution : str
+        Resolution from RESOLUTIONS other than "day"
+
+    Returns
+    -------
+    DataFrame
+        DataFrame with a single row of portfolio values for each period indexed by the last date of the period
+    """
+    return pd.read_parquet(
+        os.path.join(
+            portfolio_state_folder_path,
+            PORTFOLIO_AGGREGATES_FILE_NAME.format(resolution),
+        )
     )
-    portfolio_performance.index.name = f"PORTFOLIO PERFORMANCE [{analysis_currency}]"
-    print(portfolio_performance.to_markdown(tablefmt="psql", floatfmt=".2f"))
 
 
-def calculate_portfolio_values(
+@instrumented
+def save_portfolio_export(
+    export_folder_path,
     portfolio_data,
-    securities,
-    securities_count,
-    securities_value,
-    securities_unit_value,
-    securities_expense,
-    securities_profit,
+    securities_data,
+    exchange_rates,
+    analysis_currency,
+    compression="zstd",
 ):
     """
-    Calculates portfolio components' property values for each security and portfolio as a whole and adds them to portfolio_data DataFrame
+    Saves computed portfolio data with securities data and exchange rates aligned to its dates to Arrow IPC (Feather) files
 
     Parameters
     ----------
+    export_folder_path : str
+        Path to folder where exported tables will be saved, it will be created if does not exist
     portfolio_data : DataFrame
-        DataFrame with portfolio data
-    securities : list
-        List of securities names
-    securities_count : list
-        List of securities count names
-    securities_value : list
-        List of securities value names
-    securities_unit_value : list
-        List of securities unit value names
-    securities_expense : list
-        List of securities expense names
-    securities_profit : list
-        List of securities profit names
+        DataFrame with computed portfolio data
+    securities_data : DataFrame
+        DataFrame with securities data in analysis currency
+    exchange_rates : DataFrame
+        DataFrame with exchange rates, exchange rates table is not exported if None
+    analysis_currency : str
+        Currency of the analysis
+    compression : str
+        Compression of the columns ("zstd", "lz4" or "uncompressed"), only uncompressed tables are memory-mapped without copying, compressed ones are decompressed when loaded (default is "zstd")
 
     Returns
     -------
-    DataFrame
-        DataFrame with portfolio data with calculated values
+    None
     """
-    # assign values from securities_count to securities_value and securities_expense as values and expenses will be calculated later using these count values
-    portfolio_data[securities_value] = portfolio_data[securities_count]
-    portfolio_data[securities_expense] = portfolio_data[securities_count]
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    os.makedirs(export_folder_path, exist_ok=True)
+
+    tables = {
+        "portfolio_data": portfolio_data,
+        "securities_data": securities_data.reindex(portfolio_data.index),
+    }
+    if exchange_rates is not None:
+        tables["exchange_rates"] = exchange_rates.reindex(portfolio_data.index)
+    metadata = {
+        "export_schema_version": str(EXPORT_SCHEMA_VERSION),
+        "analysis_currency": analysis_currency,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+
+    for table_name in EXPORT_TABLES:
+        export_file_path = os.path.join(export_folder_path, f"{table_name}.arrow")
+
+        # table of a previous export which is not exported now is removed, so that it is not loaded with the new tables
+        if table_name not in tables:
+            if os.path.exists(export_file_path):
+                os.remove(export_file_path)
+            continue
 
-    # rename columns to more informative names
-    portfolio_data = portfolio_data.rename(
-        columns=dict(zip(securities, securities_unit_value))
-    )
+        table = pa.Table.from_pandas(tables[table_name])
+        table = table.replace_schema_metadata({**table.schema.metadata, **metadata})
 
-    # temporarily reset index to get rid of duplicate index values
-    portfolio_data = portfolio_data.reset_index()
+        # the file is replaced at once, so that readers which memory-mapped the previous file keep reading it
+        feather.write_feather(table, export_file_path + ".tmp", compression=compression)
+        os.replace(export_file_path + ".tmp", export_file_path)
 
-    # security expense without transaction fee
-    for security_expense in securities_expense:
-        portfolio_data[security_expense] = portfolio_data[
-            portfolio_data[security_expense] > 0
-        ][TRANSACTION_PAYMENT_COLUMN_NAME]
 
-    # set index back to DATE
-    portfolio_data = portfolio_data.set_index(DATE)
+def load_portfolio_export(
+    export_folder_path, table_name="portfolio_data", columns=None
+):
+    """
+    Loads exported table of computed results by memory-mapping its file without running the analysis, compressed tables are decompressed into memory
 
-    # separate securities unit values from other columns and drop duplicates in DATE column from these separated securities unit values
-    duplicated_idx = portfolio_data.index.duplicated()
-    unit_values_data = portfolio_data.loc[~duplicated_idx, securities_unit_value].copy()
+    Parameters
+    ----------
+    export_folder_path : str
+        Path to folder where exported tables are saved
+    table_name : str
+        Name of the table from EXPORT_TABLES (default is "portfolio_data")
+    columns : list
+        List of columns to load, only these columns are read from the file, all columns are loaded if not specified (default is None)
 
-    # drop securities unit values from portfolio_data DataFrame
-    portfolio_data = portfolio_data.drop(securities_unit_value, axis=1)
+    Returns
+    -------
+    DataFrame
+        DataFrame with the exported table indexed by dates, analysis currency and creation time of the export are kept in its attrs
+    """
+    import pyarrow.feather as feather
 
-    # group by DATE and sum all the values for each DATE
-    portfolio_data = portfolio_data.groupby(DATE).sum()
+    select_names([table_name], EXPORT_TABLES, "exported table")
 
-    # join portfolio_data DataFrame with separated earlier securities unit values
-    portfolio_data = portfolio_data.join(unit_values_data)
+    export_file_path = os.path.join(export_folder_path, f"{table_name}.arrow")
+    if not os.path.exists(export_file_path):
+        raise FileNotFoundError(
+            f"Exported table {table_name} does not exist in {export_folder_path}, "
+            "exchange rates table is exported only if exchange rates are given"
+        )
 
-    # currently in securities values there is only count of securities securities as an auxiliary column to calculate portfolio values later
-    # we fill NaN values with 0 and calculate cummulative sum to get the number of securities in the portfolio at a given time
-    portfolio_data[securities_value] = (
-        portfolio_data[securities_value].fillna(0).cumsum()
+    table = feather.read_table(
+        export_file_path,
+        columns=None if columns is None else [*columns, DATE],
+        memory_map=True,
     )
 
-    # calculate portfolio values for each security using currently stored count of securities and unit value
-    for security_value, security_unit_value in zip(
-        securities_value, securities_unit_value
-    ):
-        portfolio_data[security_value] = (
-            portfolio_data[security_value] * portfolio_data[security_unit_value]
+    # tables exported with a different layout could be silently misread
+    metadata = {
+        key.decode(): value.decode() for key, value in table.schema.metadata.items()
+    }
+    if metadata.get("export_schema_version") != str(EXPORT_SCHEMA_VERSION):
+        raise ValueError(
+            f"Exported table {table_name} has schema version {metadata.get('export_schema_version')}, "
+            f"expected {EXPORT_SCHEMA_VERSION}, export it again"
         )
 
-    # fill all the remaining NaN values with 0
-    portfolio_data = portfolio_data.fillna(0)
+    exported_data = table.to_pandas()
+    exported_data.attrs = {
+        "analysis_currency": metadata["analysis_currency"],
+        "created": metadata["created"],
+    }
 
-    # calculate cummulative sum of expenses and count of securities
-    portfolio_data[securities_expense] = portfolio_data[securities_expense].cumsum()
-    portfolio_data[securities_count] = portfolio_data[securities_count].cumsum()
+    return exported_data
 
-    # add fees to transaction payments
-    portfolio_data[TRANSACTION_PAYMENT_COLUMN_NAME] = (
-        portfolio_data[TRANSACTION_PAYMENT_COLUMN_NAME]
-        + portfolio_data[FEE_PAYMENT_COLUMN_NAME]
-    )
 
-    # calculate cummulative sum of portfolio expenses as a sum of transaction payments and fees
-    portfolio_data[PORTFOLIO + EXPENSE_SUFFIX] = portfolio_data[
-        TRANSACTION_PAYMENT_COLUMN_NAME
-    ].cumsum()
+def build_portfolio_query(portfolio_data, securities=None, weight_groups=None):
+    """
+    Builds point-in-time query of holdings and valuation from computed portfolio data, so that any dates can be queried without calculating anything again
 
-    # calculate portfolio value as a sum of securities values
-    portfolio_data[PORTFOLIO + VALUE_SUFFIX] = portfolio_data[securities_value].sum(
-        axis=1
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with computed portfolio values indexed by sorted dates, e.g. loaded with load_portfolio_export
+    securities : list
+        List of securities names, securities with count columns in portfolio_data are taken if not specified (default is None)
+    weight_groups : dict
+        Dictionary with securities names for each weight group, weights of groups are not queried if not specified (default is None)
+
+    Returns
+    -------
+    dict
+        Dictionary with names of securities and weight groups and arrays with dates, counts, values, expenses and profits of securities and portfolio and values of weight groups
+    """
+    if securities is None:
+        securities = [
+            column[: -len(COUNT_SUFFIX)]
+            for column in portfolio_data.columns
+            if column.endswith(COUNT_SUFFIX)
+        ]
+    names = [*securities, PORTFOLIO]
+
+    # values of weight groups are summed once, so that each query only takes rows
+    values = portfolio_data[[name + VALUE_SUFFIX for name in names]].to_numpy(
+        dtype=float
     )
+    membership = weight_groups_membership(securities, weight_groups or {})
+
+    return {
+        "securities": securities,
+        "weight_groups": [*membership.columns],
+        "dates": portfolio_data.index.to_numpy(dtype="datetime64[ns]"),
+        "counts": portfolio_data[[name + COUNT_SUFFIX for name in securities]].to_numpy(
+            dtype=float
+        ),
+        "values": values,
+        "expenses": portfolio_data[[name + EXPENSE_SUFFIX for name in names]].to_numpy(
+            dtype=float
+        ),
+        "profits": portfolio_data[[name + PROFIT_SUFFIX for name in names]].to_numpy(
+            dtype=float
+        ),
+        "weight_groups_values": values[:, :-1] @ membership.to_numpy(dtype=float),
+    }
+
+
+def query_portfolio(portfolio_query, dates):
+    """
+    Queries holdings and valuation of the portfolio at the end of each date
 
-    # calculate portfolio profit as a difference between portfolio value and portfolio expense
-    portfolio_data[PORTFOLIO + PROFIT_SUFFIX] = (
-        portfolio_data[PORTFOLIO + VALUE_SUFFIX]
-        - portfolio_data[PORTFOLIO + EXPENSE_SUFFIX]
+    Parameters
+    ----------
+    portfolio_query : dict
+        Dictionary returned by build_portfolio_query
+    dates : str or list
+        Date or list of dates in any format accepted by numpy datetime64, e.g. "2023-06-30", Timestamp or an array of dates
+
+    Returns
+    -------
+    dict
+        Dictionary with arrays of the last known dates not later than the queried dates, counts of securities, values, expenses and profits of securities and portfolio
+        and weights of weight groups in percent, with a row for each queried date or without the dates axis for a single date
+        and with NaN values for dates before the first date of portfolio data
+    """
+    queried_dates = np.asarray(dates, dtype="datetime64[ns]")
+
+    # binary search of the last date not later than each queried date, which also covers days without prices
+    rows = (
+        np.searchsorted(
+            portfolio_query["dates"], queried_dates.reshape(-1), side="right"
+        )
+        - 1
     )
+    known = rows >= 0
+    rows = np.maximum(rows, 0)
 
-    # calculate profit for each security as a difference between security value and security expense
-    for security_value, security_expense, security_profit in zip(
-        securities_value, securities_expense, securities_profit
-    ):
-        portfolio_data[security_profit] = (
-            portfolio_data[security_value] - portfolio_data[security_expense]
+    query_result = {
+        "dates": np.where(
+            known, portfolio_query["dates"][rows], np.datetime64("NaT", "ns")
         )
+    }
+    for key in ["counts", "values", "expenses", "profits", "weight_groups_values"]:
+        query_result[key] = np.where(known[:, None], portfolio_query[key][rows], np.nan)
 
-    # calculate portfolio drawdowns
-    for date in portfolio_data.index:
-        max_value = portfolio_data.loc[:date, PORTFOLIO + VALUE_SUFFIX].max()
-        current_value = portfolio_data.loc[date, PORTFOLIO + VALUE_SUFFIX]
+    # weights of groups in portfolio value in percent
+    with np.errstate(divide="ignore", invalid="ignore"):
+        query_result["weights"] = (
+            100
+            * query_result.pop("weight_groups_values")
+            / query_result["values"][:, -1:]
+        )
 
-        if max_value == 0:
-            portfolio_data.loc[date, PORTFOLIO + DRAWDOWN_SUFFIX] = 0
-            continue
+    # single date gives a single row
+    if queried_dates.ndim == 0:
+        query_result = {key: value[0] for key, value in query_result.items()}
+
+    return query_result
+
+
+def select_names(selected_names, available_names, kind):
+    """
+    Validates names selected by the user against the available names
 
-        portfolio_data.loc[date, PORTFOLIO + DRAWDOWN_SUFFIX] = (
-            current_value - max_value
-        ) / max_value
+    Parameters
+    ----------
+    selected_names : list
+        List of selected names, all available names are selected if it is None
+    available_names : list
+        List of available names
+    kind : str
+        Kind of names used in the error message, e.g. "output"
 
-    # concatenate columns to leave into one list
-    columns_to_leave = [
-        securities_count
-        + securities_value
-        + securities_unit_value
-        + securities_expense
-        + securities_profit
-        + [
-            PORTFOLIO + VALUE_SUFFIX,
-            PORTFOLIO + EXPENSE_SUFFIX,
-            PORTFOLIO + PROFIT_SUFFIX,
-            PORTFOLIO + DRAWDOWN_SUFFIX,
-        ]
-    ]
+    Returns
+    -------
+    list
+        List of selected names
+    """
+    if selected_names is None:
+        return list(available_names)
 
-    # leave only specified columns
-    portfolio_data = portfolio_data[columns_to_leave[0]]
+    unknown_names = [name for name in selected_names if name not in available_names]
+    if unknown_names:
+        raise ValueError(
+            f"Unknown {kind} {', '.join(map(str, unknown_names))}, available are: {', '.join(available_names)}"
+        )
 
-    return portfolio_data
+    return list(selected_names)
 
 
+@instrumented
 def portfolio_analysis(
     portfolio_data,
     securities_data,
@@ -955,6 +4822,28 @@ def portfolio_analysis(
     analysis_start_date,
     analysis_end_date,
     plots_folder_path,
+    plots_workers=1,
+    portfolio_state_folder_path=None,
+    calculation_engine="arrays",
+    outputs=None,
+    output_securities=None,
+    plot_types=None,
+    contribution=None,
+    contribution_fee_rate=0,
+    contribution_fixed_fee=0,
+    returns_period=None,
+    returns_rolling_periods=None,
+    risk_windows=(63, 252),
+    risk_free_rate=0,
+    resolution="day",
+    plots_max_points=None,
+    force_plots=False,
+    prune_plots=False,
+    exchange_rates=None,
+    export_folder_path=None,
+    export_compression="zstd",
+    report_currencies=None,
+    lot_matching=None,
 ):
     """
     Manages portfolio analysis
@@ -979,68 +4868,907 @@ def portfolio_analysis(
         End date of the analysis
     plots_folder_path : str
         Path to folder where plots will be saved
+    plots_workers : int
+        Number of worker processes to render plots with, plots are rendered one after another if it is 1 and all CPUs are used if it is None (default is 1)
+    portfolio_state_folder_path : str
+        Path to folder where calculated portfolio values are saved to update them incrementally in the next run, all values are calculated from scratch if not specified (default is None)
+    calculation_engine : str
+        Name of the engine from PORTFOLIO_VALUES_ENGINES to calculate portfolio values with (default is "arrays")
+    outputs : list
+        List of outputs from OUTPUTS to print and save, all outputs are produced if not specified (default is None)
+    output_securities : list
+        List of securities names to show in status and drawdowns tables and plots, all securities are shown if not specified (default is None)
+    plot_types : list
+        List of types of plots from PLOT_TYPES to create, all types are created if not specified (default is None)
+    contribution : float
+        Cash to allocate to whole units of securities with the weights output, nothing is allocated if not specified (default is None)
+    contribution_fee_rate : float
+        Fee as a fraction of the value of each purchase of the contribution (default is 0)
+    contribution_fixed_fee : float
+        Fixed fee of a purchase of each security of the contribution (default is 0)
+    returns_period : str
+        Calendar period from RETURNS_PERIODS to print returns for with the performance output, only returns of the whole analysis period are printed if not specified (default is None)
+    returns_rolling_periods : int
+        Number of calendar periods in each rolling window of returns, returns of single calendar periods are printed if not specified (default is None)
+    risk_windows : list
+        List of numbers of daily returns in each rolling window of risk metrics with the risk output (default is (63, 252))
+    risk_free_rate : float
+        Annual risk free rate as a fraction used in Sharpe and Sortino ratios (default is 0)
+    resolution : str
+        Resolution from RESOLUTIONS of portfolio data used in tables and plots, values and risk metrics are always calculated daily (default is "day")
+    plots_max_points : int
+        Maximum number of points of each plotted line, all points are plotted if not specified (default is None)
+    force_plots : bool
+        Whether to render all plots, otherwise only plots with changed data or styling are rendered (default is False)
+    prune_plots : bool
+        Whether to remove plots of securities which are no longer in the portfolio (default is False)
+    exchange_rates : DataFrame
+        DataFrame with exchange rates exported with portfolio data (default is None which means exchange rates are not exported)
+    export_folder_path : str
+        Path to folder where computed portfolio data, securities data and exchange rates are exported with the export output, nothing is exported if not specified (default is None)
+    export_compression : str
+        Compression of exported tables ("zstd", "lz4" or "uncompressed") (default is "zstd")
+    report_currencies : list
+        List of other currencies to print tables and create plots in besides analysis currency, values are calculated in analysis currency and converted to them (default is None)
+    lot_matching : str
+        Method from LOT_MATCHING_METHODS to match sold units with bought lots to calculate cost basis and realized and unrealized profits with the status and export outputs, lots are not matched if not specified (default is None)
 
     Returns
     -------
     None
     """
+    outputs = select_names(outputs, OUTPUTS, "output")
+    output_securities = select_names(output_securities, securities, "security")
+
     # list of columns for portfolio different values for each security
     securities_count = [col + COUNT_SUFFIX for col in securities]
     securities_value = [col + VALUE_SUFFIX for col in securities]
     securities_unit_value = [col + UNIT_VALUE_SUFFIX for col in securities]
     securities_expense = [col + EXPENSE_SUFFIX for col in securities]
     securities_profit = [col + PROFIT_SUFFIX for col in securities]
+    securities_drawdown = [col + DRAWDOWN_SUFFIX for col in securities]
+
+    # list of columns of the lots ledger, empty if lots are not matched
+    securities_cost_basis = []
+    securities_realized_profit = []
+    securities_unrealized_profit = []
+
+    # the lots ledger is shown only in the status table and exported, so it is not calculated for other outputs
+    if "status" not in outputs and not ("export" in outputs and export_folder_path):
+        lot_matching = None
+
+    # match sells with bought lots using single transactions before they are summed for each date
+    # in update mode lots held at the last saved date are continued and only later trades are matched
+    if lot_matching:
+        securities_cost_basis = [col + COST_BASIS_SUFFIX for col in securities]
+        securities_realized_profit = [
+            col + REALIZED_PROFIT_SUFFIX for col in securities
+        ]
+        securities_unrealized_profit = [
+            col + UNREALIZED_PROFIT_SUFFIX for col in securities
+        ]
+        if portfolio_state_folder_path:
+            lots_ledger = update_lots_ledger(
+                portfolio_data,
+                portfolio_state_folder_path,
+                securities,
+                securities_count,
+                lot_matching,
+            )
+        else:
+            lots_ledger, _ = calculate_lots_ledger(
+                portfolio_data, securities, securities_count, lot_matching
+            )
 
     # calculate portfolio values, expenses, profits, etc. for each security since the first transaction date
-    portfolio_data = calculate_portfolio_values(
-        portfolio_data,
-        securities,
-        securities_count,
-        securities_value,
-        securities_unit_value,
-        securities_expense,
-        securities_profit,
-    )
+    # in update mode previously saved values are recalculated only from the earliest changed date
+    if portfolio_state_folder_path:
+        portfolio_data = update_portfolio_values(
+            portfolio_data,
+            portfolio_state_folder_path,
+            securities,
+            securities_count,
+            securities_value,
+            securities_unit_value,
+            securities_expense,
+            securities_profit,
+            securities_drawdown,
+            calculation_engine,
+        )
+    else:
+        portfolio_data = PORTFOLIO_VALUES_ENGINES[calculation_engine](
+            portfolio_data,
+            securities,
+            securities_count,
+            securities_value,
+            securities_unit_value,
+            securities_expense,
+            securities_profit,
+            securities_drawdown,
+        )
+
+    # unrealized profit is the difference between value and cost basis of held lots
+    if lot_matching:
+        portfolio_data = portfolio_data.join(lots_ledger)
+        portfolio_data[securities_unrealized_profit] = (
+            portfolio_data[securities_value].to_numpy()
+            - portfolio_data[securities_cost_basis].to_numpy()
+        )
+
+    # values in other currencies are converted from the calculated ones at once, so that counts and values are calculated only once
+    currencies_data = {
+        analysis_currency: (portfolio_data, securities_data, exchange_rates)
+    }
+    if report_currencies:
+        currencies_portfolio_data = convert_portfolio_values(
+            portfolio_data,
+            exchange_rates,
+            analysis_currency,
+            report_currencies,
+            securities_value,
+            securities_unit_value,
+            securities_expense,
+            securities_profit,
+            securities_drawdown,
+            securities_cost_basis,
+            securities_realized_profit,
+            securities_unrealized_profit,
+        )
+
+        # exchange rates to analysis currency are a rates matrix with analysis currency as the base, so rates to other currencies are derived by triangulation
+        rates_matrix = exchange_rates.rename(
+            columns=lambda currency_pair: currency_pair[: -len(analysis_currency)]
+        )
+        for currency in report_currencies:
+            currency_exchange_rates = cross_rates(rates_matrix, currency)
+            currencies_data[currency] = (
+                currencies_portfolio_data[currency],
+                convert_securities_data(
+                    securities_data,
+                    currency_exchange_rates,
+                    [analysis_currency] * len(securities_data.columns),
+                    currency,
+                ),
+                currency_exchange_rates,
+            )
+
+    # print tables and create plots in each currency, plots and exports of each currency are saved in its own subfolder
+    for currency, (
+        currency_portfolio_data,
+        currency_securities_data,
+        currency_exchange_rates,
+    ) in currencies_data.items():
+        if report_currencies:
+            print(currency)
+        report_portfolio(
+            currency_portfolio_data,
+            currency_securities_data,
+            currency,
+            securities,
+            weights,
+            weights_groups,
+            analysis_start_date,
+            analysis_end_date,
+            (
+                os.path.join(plots_folder_path, currency)
+                if report_currencies
+                else plots_folder_path
+            ),
+            plots_workers,
+            outputs,
+            output_securities,
+            plot_types,
+            # contribution is given in analysis currency so it is allocated only there
+            contribution if currency == analysis_currency else None,
+            contribution_fee_rate,
+            contribution_fixed_fee,
+            returns_period,
+            returns_rolling_periods,
+            risk_windows,
+            risk_free_rate,
+            resolution,
+            plots_max_points,
+            force_plots,
+            prune_plots,
+            currency_exchange_rates,
+            (
+                os.path.join(export_folder_path, currency)
+                if export_folder_path and report_currencies
+                else export_folder_path
+            ),
+            export_compression,
+            lot_matching,
+        )
+
+
+def report_portfolio(
+    portfolio_data,
+    securities_data,
+    analysis_currency,
+    securities,
+    weights,
+    weights_groups,
+    analysis_start_date,
+    analysis_end_date,
+    plots_folder_path,
+    plots_workers=1,
+    outputs=None,
+    output_securities=None,
+    plot_types=None,
+    contribution=None,
+    contribution_fee_rate=0,
+    contribution_fixed_fee=0,
+    returns_period=None,
+    returns_rolling_periods=None,
+    risk_windows=(63, 252),
+    risk_free_rate=0,
+    resolution="day",
+    plots_max_points=None,
+    force_plots=False,
+    prune_plots=False,
+    exchange_rates=None,
+    export_folder_path=None,
+    export_compression="zstd",
+    lot_matching=None,
+):
+    """
+    Prints tables and creates plots of portfolio with already calculated values in a single currency
+
+    Parameters
+    ----------
+    portfolio_data : DataFrame
+        DataFrame with portfolio values calculated since the first transaction date
+    securities_data : DataFrame
+        DataFrame with securities data
+    analysis_currency : str
+        Currency of portfolio values
+    securities : list
+        List of securities names
+    weights : dict
+        Dictionary with weights for each security group
+    weights_groups : dict
+        Dictionary with securities names for each security group
+    analysis_start_date : str
+        Start date of the analysis
+    analysis_end_date : str
+        End date of the analysis
+    plots_folder_path : str
+        Path to folder where plots will be saved
+    plots_workers : int
+        Number of worker processes to render plots with (default is 1)
+    outputs : list
+        List of outputs from OUTPUTS to print and save (default is None)
+    output_securities : list
+        List of securities names to show in status and drawdowns tables and plots (default is None)
+    plot_types : list
+        List of types of plots from PLOT_TYPES to create (default is None)
+    contribution : float
+        Cash to allocate to whole units of securities with the weights output (default is None)
+    contribution_fee_rate : float
+        Fee as a fraction of the value of each purchase of the contribution (default is 0)
+    contribution_fixed_fee : float
+        Fixed fee of a purchase of each security of the contribution (default is 0)
+    returns_period : str
+        Calendar period from RETURNS_PERIODS to print returns for (default is None)
+    returns_rolling_periods : int
+        Number of calendar periods in each rolling window of returns (default is None)
+    risk_windows : list
+        List of numbers of daily returns in each rolling window of risk metrics (default is (63, 252))
+    risk_free_rate : float
+        Annual risk free rate as a fraction used in Sharpe and Sortino ratios (default is 0)
+    resolution : str
+        Resolution from RESOLUTIONS of portfolio data used in tables and plots (default is "day")
+    plots_max_points : int
+        Maximum number of points of each plotted line (default is None)
+    force_plots : bool
+        Whether to render all plots (default is False)
+    prune_plots : bool
+        Whether to remove plots of securities which are no longer in the portfolio (default is False)
+    exchange_rates : DataFrame
+        DataFrame with exchange rates exported with portfolio data (default is None which means exchange rates are not exported)
+    export_folder_path : str
+        Path to folder where computed data is exported with the export output (default is None)
+    export_compression : str
+        Compression of exported tables (default is "zstd")
+    lot_matching : str
+        Method from LOT_MATCHING_METHODS which was used to match sold units with bought lots, the lots table is printed only if specified (default is None)
+
+    Returns
+    -------
+    None
+    """
+    outputs = select_names(outputs, OUTPUTS, "output")
+    output_securities = select_names(output_securities, securities, "security")
+
+    # list of columns for portfolio different values for each security
+    securities_count = [col + COUNT_SUFFIX for col in securities]
+    securities_value = [col + VALUE_SUFFIX for col in securities]
+    securities_unit_value = [col + UNIT_VALUE_SUFFIX for col in securities]
+
+    # calculate rolling risk metrics of values and unit values before taking the analysis period, so that the first windows of the period are complete
+    if "risk" in outputs:
+        output_securities_unit_value = [
+            col + UNIT_VALUE_SUFFIX for col in output_securities
+        ]
+        portfolio_data = portfolio_data.join(
+            calculate_rolling_risk_metrics(
+                portfolio_data,
+                output_securities + [PORTFOLIO] + output_securities_unit_value,
+                [col + VALUE_SUFFIX for col in output_securities]
+                + [PORTFOLIO + VALUE_SUFFIX]
+                + output_securities_unit_value,
+                [col + EXPENSE_SUFFIX for col in output_securities]
+                + [PORTFOLIO + EXPENSE_SUFFIX]
+                + [None] * len(output_securities),
+                risk_windows,
+                risk_free_rate,
+            )
+        )
+
+    # export whole daily history of computed values for querying it later without running the analysis
+    if "export" in outputs and export_folder_path:
+        save_portfolio_export(
+            export_folder_path,
+            portfolio_data,
+            securities_data,
+            exchange_rates,
+            analysis_currency,
+            export_compression,
+        )
 
     # take portfolio data only from the analysis period
     portfolio_data = portfolio_period_to_analysis(
         portfolio_data, analysis_start_date, analysis_end_date
     )
 
+    # returns and drawdown statistics are calculated from daily data, as aggregating moves cash flows to the ends of periods and hides intra-period peaks
+    daily_portfolio_data = portfolio_data
+
+    # aggregate portfolio data and securities data to the chosen resolution, so that tables and plots use fewer rows
+    portfolio_data = aggregate_portfolio_data(portfolio_data, resolution)
+    securities_data = aggregate_portfolio_data(securities_data, resolution)
+
+    # list of columns for different values of securities shown in tables and plots
+    output_securities_count = [col + COUNT_SUFFIX for col in output_securities]
+    output_securities_value = [col + VALUE_SUFFIX for col in output_securities]
+    output_securities_expense = [col + EXPENSE_SUFFIX for col in output_securities]
+    output_securities_profit = [col + PROFIT_SUFFIX for col in output_securities]
+
     # print portfolio status at the end of the analysis period
-    print_portfolio_status(
-        portfolio_data,
+    if "status" in outputs:
+        print_portfolio_status(
+            portfolio_data,
+            analysis_currency,
+            output_securities,
+            output_securities_count,
+            output_securities_value,
+            output_securities_expense,
+            output_securities_profit,
+        )
+
+    # print cost basis of held lots and realized and unrealized profits at the end of the analysis period
+    if "status" in outputs and lot_matching:
+        print_portfolio_lots(
+            portfolio_data, analysis_currency, output_securities, lot_matching
+        )
+
+    # print portfolio current weights compared to the model weights and accumulation goal (so what should be bought to meet the desired weights without selling anything)
+    # all securities are needed here as weights are calculated for whole securities groups
+    if "weights" in outputs:
+        print_portfolio_weights_and_goal(
+            portfolio_data,
+            analysis_currency,
+            weights,
+            weights_groups,
+            securities,
+            securities_count,
+            securities_value,
+            securities_unit_value,
+        )
+
+    # print whole counts of securities to buy for the contribution to get as close as possible to the model weights
+    if "weights" in outputs and contribution:
+        print_portfolio_contribution(
+            portfolio_data,
+            analysis_currency,
+            weights,
+            weights_groups,
+            securities,
+            securities_value,
+            securities_unit_value,
+            contribution,
+            contribution_fee_rate,
+            contribution_fixed_fee,
+        )
+
+    # print portfolio performance summary
+    if "performance" in outputs:
+        print_portfolio_performance(portfolio_data, analysis_currency)
+
+    # print money-weighted and time-weighted returns for each security and portfolio as a whole
+    if "performance" in outputs:
+        print_portfolio_returns(
+            daily_portfolio_data,
+            output_securities,
+            output_securities_value,
+            output_securities_expense,
+            returns_period,
+            returns_rolling_periods,
+        )
+
+    # print drawdown statistics for each security and portfolio as a whole
+    if "drawdowns" in outputs:
+        print_portfolio_drawdowns(
+            daily_portfolio_data, output_securities, output_securities_value
+        )
+
+    # print the latest rolling risk metrics for each security and portfolio as a whole
+    if "risk" in outputs:
+        print_portfolio_risk(
+            portfolio_data, output_securities + [PORTFOLIO], risk_windows
+        )
+
+    # create plots for portfolio
+    if "plots" in outputs:
+        create_plots(
+            portfolio_data,
+            securities_data,
+            plots_folder_path,
+            analysis_currency,
+            output_securities,
+            output_securities_value,
+            output_securities_expense,
+            output_securities_profit,
+            plots_workers,
+            plot_types,
+            plots_max_points,
+            force_plots,
+            securities if prune_plots else None,
+        )
+
+
+def portfolio_symbols(portfolio_config):
+    """
+    Takes securities names, tickers and distinct currencies from portfolio configuration
+
+    Parameters
+    ----------
+    portfolio_config : dict
+        Dictionary with portfolio parameters as specified in portfolio.py
+
+    Returns
+    -------
+    list
+        List of securities names
+    list
+        List of tickers
+    list
+        List of distinct currencies of securities and payments
+    """
+    tickers_and_currencies = portfolio_config["tickers_and_currencies"]
+
+    # take securities names from tickers_and_currencies dictionary
+    securities = [
+        security_name.split(".")[0] for security_name in tickers_and_currencies
+    ]
+
+    # take tickers and currencies from tickers_and_currencies dictionary
+    tickers = [*tickers_and_currencies.keys()]
+    currencies_securities = [*tickers_and_currencies.values()]
+
+    # take currencies from transaction_payments dictionary
+    currencies_transation_payments = [
+        *portfolio_config["transaction_payments"].values()
+    ]
+
+    # take currencies from fee_payments dictionary
+    currencies_fee_payments = [*portfolio_config["fee_payments"].values()]
+
+    # combine currencies of securities and payments
+    currencies = (
+        currencies_securities + currencies_transation_payments + currencies_fee_payments
+    )
+
+    # take distinct currencies
+    distinct_currencies = list(set(currencies))
+
+    return securities, tickers, distinct_currencies
+
+
+def analysis_currencies(portfolio_config):
+    """
+    Takes analysis currencies from portfolio configuration
+
+    Parameters
+    ----------
+    portfolio_config : dict
+        Dictionary with portfolio parameters as specified in portfolio.py
+
+    Returns
+    -------
+    list
+        List of distinct analysis currencies, portfolio values are calculated in the first one and converted to the others
+    """
+    analysis_currency = portfolio_config["analysis_currency"]
+
+    # a single currency can be given without a list
+    if isinstance(analysis_currency, str):
+        return [analysis_currency]
+
+    if not analysis_currency:
+        raise ValueError("At least one analysis currency has to be specified")
+
+    return list(dict.fromkeys(analysis_currency))
+
+
+def load_config_file(config_file_path, portfolio_config, analysis_settings):
+    """
+    Loads portfolios parameters and analysis settings from a .json config file on top of the default ones
+
+    Parameters
+    ----------
+    config_file_path : str
+        Path to .json file with keys named as the parameters in portfolio.py, parameters of many portfolios can be specified as a list under the "portfolios" key
+    portfolio_config : dict
+        Dictionary with default portfolio parameters as specified in portfolio.py
+    analysis_settings : dict
+        Dictionary with default settings of the whole analysis as specified in portfolio.py
+
+    Returns
+    -------
+    list
+        List of dictionaries with parameters of each portfolio
+    dict
+        Dictionary with settings of the whole analysis
+    """
+    with open(config_file_path) as config_file:
+        config = json.load(config_file)
+
+    # the parameters which can be specified for each portfolio separately
+    portfolio_keys = [
+        *portfolio_config.keys(),
+        "outputs",
+        "output_securities",
+        "plot_types",
+        "force_plots",
+    ]
+
+    # fail before downloading anything if some parameter is misspelled
+    select_names(
+        [key for key in config if key != "portfolios"],
+        portfolio_keys + [*analysis_settings.keys()],
+        "config parameter",
+    )
+    for config_portfolio in config.get("portfolios", []):
+        select_names(config_portfolio, portfolio_keys, "portfolio parameter")
+
+    # settings of the whole analysis are overridden by the top level parameters
+    analysis_settings = {
+        key: config.get(key, value) for key, value in analysis_settings.items()
+    }
+
+    # top level portfolio parameters are shared by all portfolios and each portfolio can override them
+    portfolio_config = {
+        **portfolio_config,
+        **{key: value for key, value in config.items() if key in portfolio_keys},
+    }
+    portfolios_configs = [
+        {**portfolio_config, **config_portfolio}
+        for config_portfolio in config.get("portfolios", [{}])
+    ]
+
+    return portfolios_configs, analysis_settings
+
+
+def separate_portfolios_folders(portfolios_configs):
+    """
+    Moves folders shared by many portfolios to subfolders of each portfolio, so that portfolios do not overwrite or prune files of each other
+
+    Parameters
+    ----------
+    portfolios_configs : list
+        List of dictionaries with portfolio parameters as specified in portfolio.py, each with an optional "name" key
+
+    Returns
+    -------
+    list
+        List of dictionaries with portfolio parameters with folders shared by many portfolios replaced by subfolders named after
+        the portfolio, with its number if it has no name or its name is not distinct
+    """
+    # subfolders are named after portfolios, portfolios with the same name are told apart by their numbers
+    portfolios_names = [
+        portfolio_config.get("name") for portfolio_config in portfolios_configs
+    ]
+    subfolders_names = [
+        (
+            str(name)
+            if name is not None and portfolios_names.count(name) == 1
+            else f"{'portfolio' if name is None else name} {portfolio_index + 1}"
+        )
+        for portfolio_index, name in enumerate(portfolios_names)
+    ]
+
+    portfolios_configs = [
+        {**portfolio_config} for portfolio_config in portfolios_configs
+    ]
+    for folder_parameter in PORTFOLIO_FOLDERS_PARAMETERS:
+        folders_paths = [
+            portfolio_config.get(folder_parameter)
+            for portfolio_config in portfolios_configs
+        ]
+        for portfolio_config, folder_path, subfolder_name in zip(
+            portfolios_configs, folders_paths, subfolders_names
+        ):
+            if folder_path is not None and folders_paths.count(folder_path) > 1:
+                portfolio_config[folder_parameter] = os.path.join(
+                    folder_path, subfolder_name
+                )
+
+    return portfolios_configs
+
+
+@instrumented
+def run_portfolio_analysis(portfolio_config, market_data, plots_workers=1):
+    """
+    Runs the whole analysis of a single portfolio using already downloaded market data
+
+    Parameters
+    ----------
+    portfolio_config : dict
+        Dictionary with portfolio parameters as specified in portfolio.py
+    market_data : dict
+        Dictionary with symbols as keys and DataFrames with all open, high, low, close data as values
+    plots_workers : int
+        Number of worker processes to render plots with (default is 1)
+
+    Returns
+    -------
+    None
+    """
+    analysis_currency, *report_currencies = analysis_currencies(portfolio_config)
+    securities, tickers, distinct_currencies = portfolio_symbols(portfolio_config)
+
+    # select securities data and exchange rates of the portfolio from downloaded market data
+    # exchange rates of report currencies are needed to convert portfolio values to them
+    securities_data, exchange_rates = select_market_data(
+        market_data,
+        tickers,
+        list(dict.fromkeys([*distinct_currencies, *report_currencies])),
+        portfolio_config["ohlc"],
         analysis_currency,
         securities,
-        securities_count,
-        securities_value,
-        securities_expense,
-        securities_profit,
+        portfolio_config.get("fx_base_currency"),
     )
 
-    # print portfolio current weights compared to the model weights and accumulation goal (so what should be bought to meet the desired weights without selling anything)
-    print_portfolio_weights_and_goal(
-        portfolio_data,
+    # calculate values of securities in analysis currency
+    securities_data = convert_securities_data(
+        securities_data,
+        exchange_rates,
+        [*portfolio_config["tickers_and_currencies"].values()],
         analysis_currency,
-        weights,
-        weights_groups,
-        securities,
-        securities_count,
-        securities_value,
-        securities_unit_value,
     )
 
-    # print portfolio performance summary
-    print_portfolio_performance(portfolio_data, analysis_currency)
+    # prepare portfolio data for analysis using downloaded data and portfolio data files
+    portfolio_data = prepare_portfolio_data(
+        securities_data,
+        exchange_rates,
+        portfolio_config["transaction_payments"],
+        portfolio_config["fee_payments"],
+        analysis_currency,
+        portfolio_config["portfolio_data_files_names_and_payments_columns"],
+        portfolio_config["data_folder_path"],
+        portfolio_config["first_transaction_date"],
+        portfolio_config.get("ingestion_chunk_size"),
+        portfolio_config.get("print_ingestion_report", False),
+    )
 
-    # create plots for portfolio
-    create_plots(
+    # run portfolio analysis
+    portfolio_analysis(
         portfolio_data,
         securities_data,
-        plots_folder_path,
         analysis_currency,
         securities,
-        securities_value,
-        securities_expense,
-        securities_profit,
+        portfolio_config["weights"],
+        portfolio_config["weight_groups"],
+        portfolio_config["start_date"],
+        portfolio_config["end_date"],
+        portfolio_config["plots_folder_path"],
+        plots_workers,
+        portfolio_config.get("portfolio_state_folder_path"),
+        portfolio_config.get("calculation_engine", "arrays"),
+        portfolio_config.get("outputs"),
+        portfolio_config.get("output_securities"),
+        portfolio_config.get("plot_types"),
+        portfolio_config.get("contribution"),
+        portfolio_config.get("contribution_fee_rate", 0),
+        portfolio_config.get("contribution_fixed_fee", 0),
+        portfolio_config.get("returns_period"),
+        portfolio_config.get("returns_rolling_periods"),
+        portfolio_config.get("risk_windows", (63, 252)),
+        portfolio_config.get("risk_free_rate", 0),
+        portfolio_config.get("resolution", "day"),
+        portfolio_config.get("plots_max_points"),
+        portfolio_config.get("force_plots", False),
+        portfolio_config.get("prune_plots", False),
+        exchange_rates,
+        portfolio_config.get("export_folder_path"),
+        portfolio_config.get("export_compression", "zstd"),
+        report_currencies,
+        portfolio_config.get("lot_matching"),
+    )
+
+
+def run_portfolio_analysis_with_output(portfolio_config, market_data):
+    """
+    Runs the analysis of a single portfolio in a worker process and captures its printed tables
+
+    Parameters
+    ----------
+    portfolio_config : dict
+        Dictionary with portfolio parameters as specified in portfolio.py
+    market_data : dict
+        Dictionary with symbols as keys and DataFrames with all open, high, low, close data as values
+
+    Returns
+    -------
+    str
+        Printed tables of the portfolio
+    """
+    init_plot_worker()
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        run_portfolio_analysis(portfolio_config, market_data)
+
+    return output.getvalue()
+
+
+@instrumented
+def batch_portfolio_analysis(
+    portfolios_configs,
+    cache_folder_path=None,
+    cache_max_age_hours=12,
+    offline=False,
+    provider="yahoo",
+    provider_options=None,
+    portfolios_workers=1,
+    plots_workers=1,
+    fetch_workers=1,
+    fetch_timeout_s=None,
+    fetch_retries=0,
+    fetch_retry_delay_s=1,
+):
+    """
+    Runs analysis of many portfolios downloading market data for all of them only once
+
+    Parameters
+    ----------
+    portfolios_configs : list
+        List of dictionaries with portfolio parameters as specified in portfolio.py, each with an additional "name" key
+    cache_folder_path : str
+        Path to folder where downloaded data is cached, the data is not cached if not specified (default is None)
+    cache_max_age_hours : float
+        Number of hours after which cached data is refreshed (default is 12)
+    offline : bool
+        Whether to use only cached data without downloading anything (default is False)
+    provider : str
+        Name of the market data provider from MARKET_DATA_PROVIDERS (default is "yahoo")
+    provider_options : dict
+        Keyword options passed to the provider (default is None)
+    portfolios_workers : int
+        Number of worker processes to analyze portfolios with, portfolios are analyzed one after another if it is 1 and all CPUs are used if it is None (default is 1)
+    plots_workers : int
+        Number of worker processes to render plots of each portfolio with when portfolios are analyzed one after another (default is 1)
+    fetch_workers : int
+        Maximum number of symbols fetched at once (default is 1)
+    fetch_timeout_s : float
+        Number of seconds to wait for a response for each request, the provider default is used if not specified (default is None)
+    fetch_retries : int
+        Number of additional attempts after a failed request of each symbol (default is 0)
+    fetch_retry_delay_s : float
+        Number of seconds to wait before the first retry, each next retry waits twice as long (default is 1)
+
+    Returns
+    -------
+    dict
+        Dictionary with positions in portfolios_configs of portfolios which failed to analyze as keys and the corresponding errors as values
+    """
+    # each portfolio saves plots, exports and state to its own folders
+    portfolios_configs = separate_portfolios_folders(portfolios_configs)
+
+    # take symbols of securities and currency pairs of all portfolios
+    portfolios_symbols = []
+    for portfolio_config in portfolios_configs:
+        securities, tickers, distinct_currencies = portfolio_symbols(portfolio_config)
+
+        # fail before downloading anything if some selected output is misspelled
+        select_names(portfolio_config.get("outputs"), OUTPUTS, "output")
+        select_names(portfolio_config.get("output_securities"), securities, "security")
+        select_names(portfolio_config.get("plot_types"), PLOT_TYPES, "plot type")
+        select_names(
+            [portfolio_config.get("resolution", "day")], RESOLUTIONS, "resolution"
+        )
+        if portfolio_config.get("returns_period"):
+            select_names(
+                [portfolio_config["returns_period"]], RETURNS_PERIODS, "returns period"
+            )
+        if portfolio_config.get("lot_matching"):
+            select_names(
+                [portfolio_config["lot_matching"]],
+                LOT_MATCHING_METHODS,
+                "lot matching method",
+            )
+
+        currencies = analysis_currencies(portfolio_config)
+        _, distinct_currency_pairs_format = currency_pairs(
+            list(dict.fromkeys([*distinct_currencies, *currencies])),
+            portfolio_config.get("fx_base_currency") or currencies[0],
+        )
+        portfolios_symbols.append(tickers + distinct_currency_pairs_format)
+
+    # download the union of symbols of all portfolios only once
+    market_data = download_market_data(
+        list(dict.fromkeys(sum(portfolios_symbols, []))),
+        cache_folder_path,
+        cache_max_age_hours,
+        offline,
+        provider,
+        provider_options,
+        fetch_workers,
+        fetch_timeout_s,
+        fetch_retries,
+        fetch_retry_delay_s,
     )
+
+    failed_portfolios = {}
+
+    if portfolios_workers == 1:
+        for portfolio_index, portfolio_config in enumerate(portfolios_configs):
+            if "name" in portfolio_config:
+                print(portfolio_config["name"])
+            try:
+                run_portfolio_analysis(portfolio_config, market_data, plots_workers)
+            except Exception as error:
+                failed_portfolios[portfolio_index] = error
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=portfolios_workers
+        ) as executor:
+            # each worker gets only market data of the symbols of its portfolio
+            # symbols which failed to download are missing, so that only portfolios which need them fail in their workers
+            futures = [
+                executor.submit(
+                    run_portfolio_analysis_with_output,
+                    portfolio_config,
+                    {
+                        symbol: market_data[symbol]
+                        for symbol in symbols
+                        if symbol in market_data
+                    },
+                )
+                for portfolio_config, symbols in zip(
+                    portfolios_configs, portfolios_symbols
+                )
+            ]
+
+            # print tables of portfolios in the order of configurations
+            for portfolio_index, (portfolio_config, future) in enumerate(
+                zip(portfolios_configs, futures)
+            ):
+                if "name" in portfolio_config:
+                    print(portfolio_config["name"])
+                try:
+                    print(future.result(), end="")
+                except Exception as error:
+                    failed_portfolios[portfolio_index] = error
+
+    # report portfolios which failed to analyze with their tracebacks without aborting the other portfolios
+    # errors of worker processes carry the traceback of the worker as their cause
+    for portfolio_index, error in failed_portfolios.items():
+        portfolio_name = portfolios_configs[portfolio_index].get(
+            "name", f"number {portfolio_index + 1}"
+        )
+        traceback.print_exception(error, file=sys.stderr)
+        warnings.warn(f"Portfolio {portfolio_name} could not be analyzed: {error!r}")
+
+    return failed_portfolios
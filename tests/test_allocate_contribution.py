@@ -0,0 +1,82 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from portfolio_functions import *
+
+
+def test_allocate_contribution_buys_whole_units_closest_to_weights():
+    # a unit of the expensive security with a unit of the cheap one is closer to equal weights than units of the cheap one only
+    counts, fees = allocate_contribution(100, [90, 10], [0, 0], np.eye(2), [50, 50])
+
+    np.testing.assert_array_equal(counts, [1, 1])
+    np.testing.assert_array_equal(fees, [0, 0])
+
+
+def test_allocate_contribution_fills_groups_most_below_weights():
+    # the first group is above its weight, so the contribution goes to the second group and its security with the lowest value
+    membership = np.array([[1, 0], [0, 1], [0, 1]])
+    counts, _ = allocate_contribution(
+        100, [10, 10, 10], [300, 50, 150], membership, [50, 50]
+    )
+
+    np.testing.assert_array_equal(counts, [0, 10, 0])
+
+
+def test_allocate_contribution_with_fees():
+    # each unit costs 10.1 with the fee, so the contribution buys exactly 10 units
+    counts, fees = allocate_contribution(
+        101, [10], [0], np.eye(1), [100], fee_rate=0.01
+    )
+
+    np.testing.assert_array_equal(counts, [10])
+    np.testing.assert_allclose(fees, [1])
+
+
+def test_allocate_contribution_lowers_budget_by_fixed_fees():
+    # 10 units would not leave cash for the fixed fee, so one unit less is bought
+    counts, fees = allocate_contribution(100, [10], [0], np.eye(1), [100], fixed_fee=5)
+
+    np.testing.assert_array_equal(counts, [9])
+    np.testing.assert_array_equal(fees, [5])
+
+
+def test_allocate_contribution_never_exceeds_contribution():
+    random_generator = np.random.default_rng(0)
+    for _ in range(50):
+        unit_values = random_generator.uniform(5, 500, 30)
+        membership = np.zeros((30, 5))
+        membership[np.arange(30), random_generator.integers(0, 5, 30)] = 1
+        counts, fees = allocate_contribution(
+            5000,
+            unit_values,
+            unit_values * random_generator.integers(0, 20, 30),
+            membership,
+            random_generator.uniform(0, 1, 5),
+            fee_rate=0.001,
+            fixed_fee=1,
+        )
+
+        assert (counts == np.floor(counts)).all() and (counts >= 0).all()
+        assert (counts * unit_values).sum() + fees.sum() <= 5000
+
+
+def test_allocate_contribution_without_weights():
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        counts, fees = allocate_contribution(100, [90, 10], [0, 0], np.eye(2), [0, 0])
+
+    np.testing.assert_array_equal(counts, [0, 0])
+    np.testing.assert_array_equal(fees, [0, 0])
+
+
+def test_water_filling_fills_each_segment_to_common_level():
+    amounts = water_filling(
+        np.array([4.0, 6.0]),
+        np.array([5.0, 1.0, 0.0, 3.0]),
+        np.ones(4),
+        np.array([1, 0, 1, 0]),
+    )
+
+    np.testing.assert_allclose(amounts, [0.5, 3, 5.5, 1])
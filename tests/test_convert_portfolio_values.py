@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from portfolio_functions import *
+
+
+def portfolio_data_with_rates(rates_start_date):
+    """
+    Creates portfolio data of a single security bought twice and exchange rates of PLN starting at the given date
+    """
+    dates = pd.bdate_range("2020-01-01", "2020-12-31", name=DATE)
+    securities = ["SEC"]
+    columns = dict(
+        securities_value=["SEC" + VALUE_SUFFIX],
+        securities_unit_value=["SEC" + UNIT_VALUE_SUFFIX],
+        securities_expense=["SEC" + EXPENSE_SUFFIX],
+        securities_profit=["SEC" + PROFIT_SUFFIX],
+        securities_drawdown=["SEC" + DRAWDOWN_SUFFIX],
+    )
+
+    portfolio_data = pd.DataFrame(index=dates)
+    portfolio_data["SEC" + COUNT_SUFFIX] = np.where(dates >= "2020-07-01", 2.0, 1.0)
+    portfolio_data["SEC" + UNIT_VALUE_SUFFIX] = 10.0
+    portfolio_data["SEC" + VALUE_SUFFIX] = portfolio_data["SEC" + COUNT_SUFFIX] * 10.0
+    portfolio_data["SEC" + EXPENSE_SUFFIX] = portfolio_data["SEC" + VALUE_SUFFIX]
+    portfolio_data["SEC" + PROFIT_SUFFIX] = 0.0
+    portfolio_data["SEC" + DRAWDOWN_SUFFIX] = 0.0
+    for suffix in [VALUE_SUFFIX, EXPENSE_SUFFIX, PROFIT_SUFFIX, DRAWDOWN_SUFFIX]:
+        portfolio_data[PORTFOLIO + suffix] = portfolio_data["SEC" + suffix]
+
+    # a unit of EUR is worth 4 PLN
+    exchange_rates = pd.DataFrame(
+        {"PLNEUR": 0.25, "EUREUR": 1.0}, index=dates[dates >= rates_start_date]
+    )
+
+    return portfolio_data, exchange_rates, securities, columns
+
+
+def test_convert_portfolio_values_with_late_exchange_rates():
+    portfolio_data, exchange_rates, _, columns = portfolio_data_with_rates("2020-06-01")
+
+    with pytest.warns(UserWarning, match="before the first exchange rate of PLNEUR"):
+        converted = convert_portfolio_values(
+            portfolio_data, exchange_rates, "EUR", ["PLN"], **columns
+        )["PLN"]
+
+    assert not converted.isna().any().any()
+    assert converted[PORTFOLIO + EXPENSE_SUFFIX].iloc[-1] == pytest.approx(80.0)
+    assert converted[PORTFOLIO + PROFIT_SUFFIX].iloc[-1] == pytest.approx(0.0)
+
+
+def test_convert_portfolio_values_without_exchange_rates():
+    portfolio_data, exchange_rates, _, columns = portfolio_data_with_rates("2021-01-01")
+
+    with pytest.raises(ValueError, match="no exchange rates of PLNEUR"):
+        convert_portfolio_values(
+            portfolio_data, exchange_rates, "EUR", ["PLN"], **columns
+        )
@@ -0,0 +1,139 @@
+import collections
+import http.server
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from portfolio_functions import *
+
+# number of seconds each symbol takes to be served by the stub server
+RESPONSE_DELAY_S = 0.5
+
+
+class StubMarketDataHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves .csv files with market data of symbols after a delay, symbols starting with FAIL always fail,
+    symbols starting with FLAKY fail on the first two requests and symbols starting with HANG respond after a long time
+    """
+
+    requests_numbers = collections.Counter()
+
+    def do_GET(self):
+        symbol = self.path.strip("/").removesuffix(".csv")
+        self.requests_numbers[symbol] += 1
+
+        if symbol.startswith("HANG"):
+            time.sleep(5)
+        else:
+            time.sleep(RESPONSE_DELAY_S)
+        if symbol.startswith("FAIL") or (
+            symbol.startswith("FLAKY") and self.requests_numbers[symbol] <= 2
+        ):
+            self.send_error(500)
+            return
+
+        symbol_data = pd.DataFrame(
+            {"Open": 1.0, "High": 1.0, "Low": 1.0, "Close": 1.0},
+            index=pd.bdate_range("2020-01-01", periods=5, name="Date"),
+        )
+        body = symbol_data.to_csv().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server_url():
+    StubMarketDataHandler.requests_numbers.clear()
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubMarketDataHandler)
+    server.daemon_threads = True
+    server.block_on_close = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/{{symbol}}.csv"
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_market_data_time_is_bounded_by_slowest_symbol(stub_server_url):
+    symbols = [f"SEC{index}" for index in range(8)]
+
+    start_time = time.perf_counter()
+    market_data = download_market_data(
+        symbols,
+        provider="http",
+        provider_options={"url": stub_server_url},
+        fetch_workers=len(symbols),
+    )
+    wall_time = time.perf_counter() - start_time
+
+    assert sorted(market_data) == symbols
+    assert wall_time < 3 * RESPONSE_DELAY_S
+
+
+def test_download_market_data_reports_timed_out_and_failed_symbols(stub_server_url):
+    with pytest.warns(UserWarning) as warnings_records:
+        market_data = download_market_data(
+            ["SEC", "HANG", "FAIL"],
+            provider="http",
+            provider_options={"url": stub_server_url},
+            fetch_workers=3,
+            fetch_timeout_s=2 * RESPONSE_DELAY_S,
+        )
+
+    assert list(market_data) == ["SEC"]
+    warnings_messages = " ".join(str(record.message) for record in warnings_records)
+    assert "HANG could not be fetched" in warnings_messages
+    assert "FAIL could not be fetched" in warnings_messages
+
+
+def test_download_market_data_retries_with_backoff(stub_server_url):
+    start_time = time.perf_counter()
+    market_data = download_market_data(
+        ["FLAKY"],
+        provider="http",
+        provider_options={"url": stub_server_url},
+        fetch_retries=2,
+        fetch_retry_delay_s=0.1,
+    )
+    wall_time = time.perf_counter() - start_time
+
+    # two failed requests are followed by retries waiting 0.1 and 0.2 seconds
+    assert list(market_data) == ["FLAKY"]
+    assert StubMarketDataHandler.requests_numbers["FLAKY"] == 3
+    assert wall_time >= 3 * RESPONSE_DELAY_S + 0.3
+
+
+def test_download_market_data_fetches_serial_provider_one_symbol_at_a_time():
+    active_fetches = []
+    max_active_fetches = []
+
+    def fetch_counting(symbols, start_date=None):
+        active_fetches.append(symbols)
+        max_active_fetches.append(len(active_fetches))
+        time.sleep(0.05)
+        active_fetches.pop()
+        return {
+            symbol: pd.DataFrame(
+                {"Close": [1.0]}, index=pd.DatetimeIndex(["2020-01-01"])
+            )
+            for symbol in symbols
+        }
+
+    register_market_data_provider("serial_stub", fetch_counting, thread_safe=False)
+    try:
+        market_data = download_market_data(
+            ["SEC1", "SEC2", "SEC3"], provider="serial_stub", fetch_workers=3
+        )
+    finally:
+        del MARKET_DATA_PROVIDERS["serial_stub"]
+        SERIAL_MARKET_DATA_PROVIDERS.remove("serial_stub")
+
+    assert sorted(market_data) == ["SEC1", "SEC2", "SEC3"]
+    assert max(max_active_fetches) == 1
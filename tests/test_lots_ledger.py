@@ -0,0 +1,211 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import portfolio_functions
+from portfolio_functions import *
+
+SECURITIES = ["SEC1", "SEC2"]
+SECURITIES_COUNT = [security + COUNT_SUFFIX for security in SECURITIES]
+
+
+def portfolio_data_with_trades(trades, end_date="2020-03-31", seed=0):
+    """
+    Creates portfolio data prepared for analysis with random unit values of SEC1 and SEC2 and rows of the given (date, security, count, payment) trades
+    """
+    dates = pd.bdate_range("2020-01-01", end_date, name=DATE)
+    rng = np.random.default_rng(seed)
+    unit_values = pd.DataFrame(
+        10 * np.cumprod(1 + rng.normal(0, 0.01, (len(dates), 2)), axis=0),
+        index=dates,
+        columns=SECURITIES,
+    )
+
+    # each date has a row without transactions followed by rows of its trades
+    rows = unit_values.assign(
+        **{column: np.nan for column in SECURITIES_COUNT},
+        **{TRANSACTION_PAYMENT_COLUMN_NAME: np.nan, FEE_PAYMENT_COLUMN_NAME: np.nan},
+    )
+    trades_rows = []
+    for date, security, count, payment in trades:
+        trade_row = rows.loc[[pd.Timestamp(date)]].copy()
+        trade_row[security + COUNT_SUFFIX] = count
+        trade_row[TRANSACTION_PAYMENT_COLUMN_NAME] = payment
+        trade_row[FEE_PAYMENT_COLUMN_NAME] = 0.0
+        trades_rows.append(trade_row)
+
+    return pd.concat([rows] + trades_rows).sort_index(kind="stable")
+
+
+def random_trades(end_date, seed=0):
+    """
+    Creates random buys and sells of SEC1 and SEC2 which never sell more units than held
+    """
+    rng = np.random.default_rng(seed)
+    held_counts = dict.fromkeys(SECURITIES, 0)
+    trades = []
+    for date in pd.bdate_range("2020-01-01", end_date)[::3]:
+        security = SECURITIES[rng.integers(2)]
+        count = int(rng.integers(-held_counts[security], 10))
+        if count:
+            held_counts[security] += count
+            trades.append((date, security, count, count * rng.uniform(8, 12)))
+    return trades
+
+
+@pytest.mark.parametrize(
+    "method, sold_cost, held_lots",
+    [("fifo", 50, [[5, 10], [10, 20]]), ("average", 75, [[15, 15]])],
+)
+def test_match_lots_fifo_and_average_cost(method, sold_cost, held_lots):
+    # 5 of 20 units bought at 10 and 20 are sold for 100
+    cost_basis_changes, realized_profits, oversold_count, new_held_lots = match_lots(
+        np.array([10.0, 10.0, -5.0]), np.array([100.0, 200.0, -100.0]), method
+    )
+
+    np.testing.assert_allclose(cost_basis_changes, [100, 200, -sold_cost])
+    np.testing.assert_allclose(realized_profits, [0, 0, 100 - sold_cost])
+    assert oversold_count == 0
+    np.testing.assert_allclose(new_held_lots, held_lots)
+
+
+def test_match_lots_partial_sell_across_lots():
+    # 7 units are taken from the whole first lot and 2 units of the second one
+    counts = np.array([5.0, 5.0, 5.0, -7.0])
+    payments = np.array([50.0, 60.0, 70.0, -140.0])
+    cost_basis_changes, realized_profits, _, held_lots = match_lots(counts, payments)
+
+    assert cost_basis_changes[-1] == pytest.approx(-74)
+    assert realized_profits[-1] == pytest.approx(66)
+    np.testing.assert_allclose(held_lots, [[3, 12], [5, 14]])
+
+    # matching continued from held lots after the second trade gives the same results
+    _, _, _, first_held_lots = match_lots(counts[:2], payments[:2])
+    continued_results = match_lots(counts[2:], payments[2:], held_lots=first_held_lots)
+    np.testing.assert_allclose(continued_results[0], cost_basis_changes[2:])
+    np.testing.assert_allclose(continued_results[1], realized_profits[2:])
+    np.testing.assert_allclose(continued_results[3], held_lots)
+
+
+@pytest.mark.parametrize("method", LOT_MATCHING_METHODS)
+def test_calculate_lots_ledger_warns_about_sells_above_held_units(method):
+    portfolio_data = portfolio_data_with_trades(
+        [("2020-01-02", "SEC1", 5, 50.0), ("2020-01-03", "SEC1", -8, -96.0)]
+    )
+
+    with pytest.warns(UserWarning, match="3 units of SEC1 were sold above held units"):
+        lots_ledger, held_lots = calculate_lots_ledger(
+            portfolio_data, SECURITIES, SECURITIES_COUNT, method
+        )
+
+    # cost of the 3 oversold units is 0, so all their proceeds are realized profit
+    assert lots_ledger["SEC1" + COST_BASIS_SUFFIX].iloc[-1] == pytest.approx(0)
+    assert lots_ledger["SEC1" + REALIZED_PROFIT_SUFFIX].iloc[-1] == pytest.approx(46)
+    assert held_lots == {}
+
+
+@pytest.mark.parametrize("method", LOT_MATCHING_METHODS)
+def test_realized_and_unrealized_profit_sum_to_profit(method):
+    portfolio_data = portfolio_data_with_trades(random_trades("2020-03-31"))
+    lots_ledger, _ = calculate_lots_ledger(
+        portfolio_data, SECURITIES, SECURITIES_COUNT, method
+    )
+    portfolio_values = calculate_portfolio_values_arrays(
+        portfolio_data,
+        SECURITIES,
+        SECURITIES_COUNT,
+        *(
+            [security + suffix for security in SECURITIES]
+            for suffix in [
+                VALUE_SUFFIX,
+                UNIT_VALUE_SUFFIX,
+                EXPENSE_SUFFIX,
+                PROFIT_SUFFIX,
+                DRAWDOWN_SUFFIX,
+            ]
+        ),
+    )
+
+    # value minus net cash invested is the realized profit plus value minus cost of held lots
+    for security in SECURITIES:
+        unrealized_profit = (
+            portfolio_values[security + VALUE_SUFFIX]
+            - lots_ledger[security + COST_BASIS_SUFFIX]
+        )
+        np.testing.assert_allclose(
+            lots_ledger[security + REALIZED_PROFIT_SUFFIX] + unrealized_profit,
+            portfolio_values[security + VALUE_SUFFIX]
+            - portfolio_values[security + EXPENSE_SUFFIX],
+            atol=1e-9,
+        )
+
+
+@pytest.mark.parametrize("method", LOT_MATCHING_METHODS)
+def test_update_lots_ledger_matches_only_new_trades(tmp_path, method, monkeypatch):
+    trades = random_trades("2020-03-31")
+    full_portfolio_data = portfolio_data_with_trades(trades)
+    expected_lots_ledger, expected_held_lots = calculate_lots_ledger(
+        full_portfolio_data, SECURITIES, SECURITIES_COUNT, method
+    )
+
+    # the first run saves lots held at the end of February
+    update_lots_ledger(
+        portfolio_data_with_trades(
+            [trade for trade in trades if trade[0] <= pd.Timestamp("2020-02-28")],
+            "2020-02-28",
+        ),
+        tmp_path,
+        SECURITIES,
+        SECURITIES_COUNT,
+        method,
+    )
+    with open(tmp_path / LOTS_STATE_FILE_NAME) as lots_state_file:
+        assert json.load(lots_state_file)["state_date"] == "2020-02-28 00:00:00"
+
+    # the second run matches only trades of March
+    matched_trades_numbers = []
+
+    def counting_match_lots(counts, *args, **kwargs):
+        matched_trades_numbers.append(len(counts))
+        return match_lots(counts, *args, **kwargs)
+
+    monkeypatch.setattr(portfolio_functions, "match_lots", counting_match_lots)
+    lots_ledger = update_lots_ledger(
+        full_portfolio_data, tmp_path, SECURITIES, SECURITIES_COUNT, method
+    )
+
+    pd.testing.assert_frame_equal(lots_ledger, expected_lots_ledger, atol=1e-9)
+    march_trades = [trade for trade in trades if trade[0] > pd.Timestamp("2020-02-28")]
+    assert 0 < sum(matched_trades_numbers) <= len(march_trades)
+    with open(tmp_path / LOTS_STATE_FILE_NAME) as lots_state_file:
+        np.testing.assert_allclose(
+            sum(json.load(lots_state_file)["held_lots"].values(), []),
+            sum(expected_held_lots.values(), []),
+        )
+
+
+def test_update_lots_ledger_rematches_back_dated_trades(tmp_path):
+    trades = [("2020-01-02", "SEC1", 10, 100.0), ("2020-02-03", "SEC1", -5, -60.0)]
+    update_lots_ledger(
+        portfolio_data_with_trades(trades),
+        tmp_path,
+        SECURITIES,
+        SECURITIES_COUNT,
+        "fifo",
+    )
+
+    # a buy added before the saved date changes the cost of sold units of the later sell
+    changed_portfolio_data = portfolio_data_with_trades(
+        [("2020-01-01", "SEC1", 10, 50.0)] + trades
+    )
+    lots_ledger = update_lots_ledger(
+        changed_portfolio_data, tmp_path, SECURITIES, SECURITIES_COUNT, "fifo"
+    )
+
+    expected_lots_ledger, _ = calculate_lots_ledger(
+        changed_portfolio_data, SECURITIES, SECURITIES_COUNT, "fifo"
+    )
+    pd.testing.assert_frame_equal(lots_ledger, expected_lots_ledger)
+    assert lots_ledger["SEC1" + REALIZED_PROFIT_SUFFIX].iloc[-1] == pytest.approx(35)
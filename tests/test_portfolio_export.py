@@ -0,0 +1,34 @@
+import pandas as pd
+import pytest
+
+from portfolio_functions import *
+
+
+def export_data():
+    """
+    Creates portfolio data, securities data and exchange rates of a single security
+    """
+    dates = pd.bdate_range("2020-01-01", "2020-01-31", name=DATE)
+    portfolio_data = pd.DataFrame(
+        {"SEC" + VALUE_SUFFIX: 10.0, PORTFOLIO + VALUE_SUFFIX: 10.0}, index=dates
+    )
+    securities_data = pd.DataFrame({"SEC": 10.0}, index=dates)
+    exchange_rates = pd.DataFrame({"PLNEUR": 0.25}, index=dates)
+
+    return portfolio_data, securities_data, exchange_rates
+
+
+def test_save_portfolio_export_without_exchange_rates(tmp_path):
+    portfolio_data, securities_data, exchange_rates = export_data()
+    save_portfolio_export(
+        tmp_path, portfolio_data, securities_data, exchange_rates, "EUR"
+    )
+
+    # exchange rates of the previous export are removed, so that they are not loaded with the new tables
+    save_portfolio_export(tmp_path, portfolio_data, securities_data, None, "EUR")
+
+    exported_data = load_portfolio_export(tmp_path)
+    pd.testing.assert_frame_equal(exported_data, portfolio_data, check_freq=False)
+    assert exported_data.attrs["analysis_currency"] == "EUR"
+    with pytest.raises(FileNotFoundError, match="exchange_rates does not exist"):
+        load_portfolio_export(tmp_path, "exchange_rates")
@@ -0,0 +1,180 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from portfolio_functions import *
+
+
+def xirr_reference(cash_flows, years):
+    """
+    Solves annual rate of return of a single series of cash flows by plain bisection of net present value
+    """
+    cash_flows = np.asarray(cash_flows, dtype=float)
+    years = np.asarray(years, dtype=float)
+
+    def net_present_value(rate):
+        return (cash_flows / (1 + rate) ** years).sum()
+
+    lower, upper = -0.999999, 999.0
+    for _ in range(200):
+        middle = (lower + upper) / 2
+        if np.sign(net_present_value(middle)) == np.sign(net_present_value(lower)):
+            lower = middle
+        else:
+            upper = middle
+    return (lower + upper) / 2
+
+
+def max_drawdown_reference(values, window):
+    """
+    Calculates maximum drawdown of each rolling window with a loop over windows and running maximums
+    """
+    max_drawdowns = np.full(values.shape, np.nan)
+    for end in range(window - 1, len(values)):
+        window_values = values[end - window + 1 : end + 1]
+        max_drawdowns[end] = (
+            window_values / np.maximum.accumulate(window_values, axis=0) - 1
+        ).min(axis=0)
+    return max_drawdowns
+
+
+def portfolio_data_example(values, expenses, dates):
+    """
+    Creates portfolio data of a single security named SEC and the portfolio with the same values and expenses
+    """
+    return pd.DataFrame(
+        {
+            "SEC" + VALUE_SUFFIX: values,
+            "SEC" + EXPENSE_SUFFIX: expenses,
+            PORTFOLIO + VALUE_SUFFIX: values,
+            PORTFOLIO + EXPENSE_SUFFIX: expenses,
+        },
+        index=pd.DatetimeIndex(dates),
+    )
+
+
+def test_calculate_xirr_of_two_cash_flows():
+    # 100 paid and 110 taken out a year later is 10% a year
+    xirr = calculate_xirr(np.array([[-100.0], [110.0]]), np.array([[0.0], [1.0]]))
+
+    np.testing.assert_allclose(xirr, [0.1], rtol=1e-9)
+
+
+def test_calculate_xirr_falls_back_to_bisection():
+    # the first Newton step from 0% is far outside the bracket, so the rate near -100% is found by bisection
+    cash_flows = np.array([[-100.0, -100.0], [0.01, 50.0], [0.0, 1e4]])
+    years = np.array([[0.0], [1.0], [1.5]])
+    net_present_value, derivative = -100 + 0.01, -0.01 * 1.0
+    assert 0 - net_present_value / derivative < np.log(1e-6)
+
+    xirr = calculate_xirr(cash_flows, years)
+
+    np.testing.assert_allclose(
+        xirr,
+        [
+            xirr_reference(cash_flows[:, 0], years[:, 0]),
+            xirr_reference(cash_flows[:, 1], years[:, 0]),
+        ],
+        rtol=1e-7,
+    )
+    np.testing.assert_allclose(xirr[0], -0.9999, rtol=1e-7)
+
+
+def test_calculate_xirr_is_nan_without_sign_change():
+    xirr = calculate_xirr(np.array([[-100.0], [-10.0]]), np.array([[0.0], [1.0]]))
+
+    assert np.isnan(xirr).all()
+
+
+@pytest.mark.parametrize("window", [1, 2, 5, 7, 50])
+def test_rolling_max_drawdown_matches_running_maximum_loop(window):
+    rng = np.random.default_rng(window)
+    values = np.cumprod(1 + rng.normal(0, 0.02, (50, 3)), axis=0)
+
+    np.testing.assert_allclose(
+        rolling_max_drawdown(values, window), max_drawdown_reference(values, window)
+    )
+
+
+def test_rolling_max_drawdown_of_too_long_window_is_nan():
+    assert np.isnan(rolling_max_drawdown(np.ones((3, 1)), 4)).all()
+
+
+def test_calculate_returns_excludes_cash_flows_from_time_weighted_return():
+    # value doubles and then falls by 15% to 170 before 100 is paid in, so TWR is 2 * 0.85 - 1 = 70%
+    portfolio_data = portfolio_data_example(
+        [100, 200, 270], [100, 100, 200], ["2020-01-01", "2020-07-01", "2021-01-01"]
+    )
+
+    xirr, time_weighted_returns = calculate_returns(
+        portfolio_data,
+        ["SEC", PORTFOLIO],
+        ["SEC" + VALUE_SUFFIX, PORTFOLIO + VALUE_SUFFIX],
+        ["SEC" + EXPENSE_SUFFIX, PORTFOLIO + EXPENSE_SUFFIX],
+        returns_windows(portfolio_data.index),
+    )
+
+    np.testing.assert_allclose(time_weighted_returns.to_numpy(), 0.7)
+    # 100 paid on the last date is netted with 270 taken out
+    years = (portfolio_data.index - portfolio_data.index[0]).days / 365.25
+    np.testing.assert_allclose(
+        xirr.to_numpy(), xirr_reference([-100, 0, 170], years), rtol=1e-7
+    )
+
+
+def test_calculate_returns_of_calendar_and_rolling_windows():
+    dates = pd.bdate_range("2020-01-01", "2020-04-30")
+    rng = np.random.default_rng(0)
+    values = 100 * np.cumprod(1 + rng.normal(0, 0.01, len(dates)))
+    portfolio_data = portfolio_data_example(values, np.full(len(dates), 100.0), dates)
+    arguments = (
+        portfolio_data,
+        ["SEC", PORTFOLIO],
+        ["SEC" + VALUE_SUFFIX, PORTFOLIO + VALUE_SUFFIX],
+        ["SEC" + EXPENSE_SUFFIX, PORTFOLIO + EXPENSE_SUFFIX],
+    )
+
+    # each month starts at the last date of the previous month
+    windows = returns_windows(dates, "month")
+    month_ends = [dates[dates.month == month][-1] for month in range(1, 5)]
+    assert [label for label, _, _ in windows] == [
+        "2020-01",
+        "2020-02",
+        "2020-03",
+        "2020-04",
+    ]
+    assert [dates[end] for _, _, end in windows] == month_ends
+    assert [dates[start] for _, start, _ in windows] == [dates[0]] + month_ends[:-1]
+
+    _, time_weighted_returns = calculate_returns(*arguments, windows)
+    np.testing.assert_allclose(
+        time_weighted_returns["SEC"].to_numpy(),
+        [values[end] / values[start] - 1 for _, start, end in windows],
+    )
+
+    # rolling windows of 3 months exist only from the third month
+    rolling_windows = returns_windows(dates, "month", 3)
+    assert [label for label, _, _ in rolling_windows] == [
+        "2020-01 - 2020-03",
+        "2020-02 - 2020-04",
+    ]
+    _, time_weighted_returns = calculate_returns(*arguments, rolling_windows)
+    np.testing.assert_allclose(
+        time_weighted_returns["SEC"].to_numpy(),
+        [values[end] / values[start] - 1 for _, start, end in rolling_windows],
+    )
+
+
+def test_print_portfolio_returns_of_single_date(capsys):
+    portfolio_data = portfolio_data_example([100], [100], ["2020-01-01"])
+
+    print_portfolio_returns(
+        portfolio_data, ["SEC"], ["SEC" + VALUE_SUFFIX], ["SEC" + EXPENSE_SUFFIX]
+    )
+
+    annualized_line = next(
+        line
+        for line in capsys.readouterr().out.splitlines()
+        if "TWR ANNUALIZED" in line
+    )
+    assert "nan" in annualized_line
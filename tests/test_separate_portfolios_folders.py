@@ -0,0 +1,39 @@
+import os
+
+from portfolio_functions import *
+
+
+def test_separate_portfolios_folders_moves_shared_folders_to_subfolders():
+    portfolios_configs = separate_portfolios_folders(
+        [
+            {"name": "A", "plots_folder_path": "plots", "export_folder_path": None},
+            {"name": "B", "plots_folder_path": "plots", "export_folder_path": None},
+            {"plots_folder_path": "plots", "export_folder_path": "export"},
+        ]
+    )
+
+    assert [
+        portfolio_config["plots_folder_path"] for portfolio_config in portfolios_configs
+    ] == [
+        os.path.join("plots", "A"),
+        os.path.join("plots", "B"),
+        os.path.join("plots", "portfolio 3"),
+    ]
+    assert [
+        portfolio_config["export_folder_path"]
+        for portfolio_config in portfolios_configs
+    ] == [None, None, "export"]
+
+
+def test_separate_portfolios_folders_tells_apart_portfolios_with_same_name():
+    portfolios_configs = separate_portfolios_folders(
+        [
+            {"name": "PORTFOLIO", "portfolio_state_folder_path": "state"},
+            {"name": "PORTFOLIO", "portfolio_state_folder_path": "state"},
+        ]
+    )
+
+    assert [
+        portfolio_config["portfolio_state_folder_path"]
+        for portfolio_config in portfolios_configs
+    ] == [os.path.join("state", "PORTFOLIO 1"), os.path.join("state", "PORTFOLIO 2")]